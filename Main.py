@@ -11,346 +11,54 @@ Todo list:
 3.) Port out the modules into support files.
 """
 import os
-import time
+import json
 import yaml
-import boto3
 import botocore.exceptions
-import paramiko
-import subprocess
-import random
-import string
-import logging
-import datetime
-
-def log(message):
-    """Print a message with a timestamp."""
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
-    logger.info(message)  # Log to the file using the logger
-
-logging.basicConfig(
-    filename="process.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger()
-
-def install_dependencies():
-    """Install Python dependencies if not already installed."""
-    dependencies = ["boto3", "PyYAML", "paramiko"]
-
-    for package in dependencies:
-        try:
-            # Check if the package is already installed
-            result = subprocess.run(["pip", "show", package], capture_output=True, text=True, check=True)
-            if result.stdout:
-                log(f"{package} is already installed.")
-            else:
-                raise subprocess.CalledProcessError(1, "pip show")
-        except subprocess.CalledProcessError:
-            log(f"Installing {package}...")
-            subprocess.run(["pip", "install", package], check=True)
-            log(f"{package} installed successfully.")
-
-def install_aws_cli():
-    """Download and install AWS CLI if not already installed."""
-    try:
-        # Check if AWS CLI is already installed
-        result = subprocess.run(["aws", "--version"], capture_output=True, text=True, check=True)
-        log(f"AWS CLI is already installed: {result.stdout.strip()}")
-        return  # Skip installation if already installed
-    except FileNotFoundError:
-        log("AWS CLI is not installed. Proceeding with installation.")
-
-    system = platform.system().lower()
-
-    if "windows" in system:
-        # Download AWS CLI installer for Windows
-        installer_url = "https://awscli.amazonaws.com/AWSCLIV2.msi"
-        installer_path = "AWSCLIV2.msi"
-        urllib.request.urlretrieve(installer_url, installer_path)
-        log("AWS CLI installer downloaded.")
-
-        # Run the installer with administrative privileges
-        subprocess.run(["powershell", "Start-Process", "msiexec.exe", "-ArgumentList", f"/i {installer_path} /quiet /norestart", "-Verb", "runAs"], check=True)
-        os.remove(installer_path)
-        log("AWS CLI installed successfully.")
-
-    elif "linux" in system or "darwin" in system:
-        # Download AWS CLI installer for Linux/Mac
-        installer_url = "https://awscli.amazonaws.com/awscli-exe-linux-x86_64.zip" if "linux" in system else "https://awscli.amazonaws.com/AWSCLIV2.pkg"
-        installer_path = "AWSCLIV2.zip" if "linux" in system else "AWSCLIV2.pkg"
-        urllib.request.urlretrieve(installer_url, installer_path)
-        log("AWS CLI installer downloaded.")
-
-        if "linux" in system:
-            # Extract and install for Linux with administrative privileges
-            with zipfile.ZipFile(installer_path, 'r') as zip_ref:
-                zip_ref.extractall("awscli-install")
-            subprocess.run(["sudo", "./awscli-install/aws/install"], check=True)
-            os.remove(installer_path)
-            log("AWS CLI installed successfully.")
-        else:
-            # Install for Mac with administrative privileges
-            subprocess.run(["sudo", "installer", "-pkg", installer_path, "-target", "/"], check=True)
-            os.remove(installer_path)
-            log("AWS CLI installed successfully.")
-    else:
-        raise OSError("Unsupported Operating System")
-
-    # Verify installation
-    subprocess.run(["aws", "--version"], check=True)
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import manifest
+import metadata_cache
+from accounts import account_context
+from ami_resolver import image_reference, resolve_images
+from checkpoint import resume_checkpoint, start_checkpoint
+from clients import configure_clients, get_client
+from dependencies import ensure_dependencies
+from iam_engine import provision_iam
+from instrumentation import log_call_summary, write_trace
+from launch_templates import ensure_launch_template
+from listing import iter_resources
+from logs import carry_context, log, logger
+from plan import compute_plan, describe_change, desired_state, live_state, print_plan
+from readiness import GONE_STATES, wait_until
+from retry import configure_rate_limits, log_retry_report
+from scheduler import Stage, run_stages
+from sg_rules import apply_ingress_rules
+from stacks import build_template, deploy_stack, plan_stack
+from tags import build_tags, tag_specifications
+from teardown import delete_customer_resources, delete_iam_user
+
+READINESS_TIMEOUT = 1800  # Seconds to wait for a resource to become ready
 
 def validate_config(config):
     for env in config['environments']:
         for node in env['nodes']:
-            if 'instance_type' not in node or 'ami_id' not in node:
-                raise ValueError(f"Missing 'instance_type' or 'ami_id' for {node['type']} in {env['name']}")
-
-def delete_customer_resources(customer_code, region, config):
-    """Delete all AWS resources associated with a specific customer tag."""
-    ec2 = boto3.client('ec2', region_name=region)
-    tgw = boto3.client('ec2', region_name=region)  # Transit Gateway client
-    iam = boto3.client('iam')
-    budgets = boto3.client('budgets', region_name=region)
-
-    try:
-        log(f"Deleting resources for customer: {customer_code}")
-
-        # Detach and delete Transit Gateway Attachments
-        tgw_attachments = tgw.describe_transit_gateway_attachments(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for attachment in tgw_attachments['TransitGatewayAttachments']:
-            try:
-                tgw.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=attachment['TransitGatewayAttachmentId'])
-                log(f"Deleted Transit Gateway Attachment: {attachment['TransitGatewayAttachmentId']}")
-            except Exception as e:
-                log(f"Failed to delete Transit Gateway Attachment {attachment['TransitGatewayAttachmentId']}: {e}")
-
-        # Delete EC2 Instances
-        instances = ec2.describe_instances(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        instance_ids = [i['InstanceId'] for r in instances['Reservations'] for i in r['Instances']]
-        if instance_ids:
-            ec2.terminate_instances(InstanceIds=instance_ids)
-            log(f"Terminating instances: {instance_ids}")
-            try:
-                waiter = ec2.get_waiter('instance_terminated')
-                waiter.wait(InstanceIds=instance_ids, WaiterConfig={'Delay': 15, 'MaxAttempts': 20})
-                log("Instances terminated successfully.")
-            except botocore.exceptions.WaiterError as e:
-                log(f"Waiter for instance termination failed: {e}. Proceeding with deletion.")
-
-        # Delete IAM Users
-        iam_users = [f"{customer_code}-admin"]
-        for env in ['01', '04']:
-            for account_type in ['service', 'promotion', 'restricted']:
-                iam_users.append(f"{customer_code}-{env}-{account_type}")
-        for user in iam_users:
-            try:
-                attached_policies = iam.list_attached_user_policies(UserName=user).get('AttachedPolicies', [])
-                for policy in attached_policies:
-                    iam.detach_user_policy(UserName=user, PolicyArn=policy['PolicyArn'])
-
-                inline_policies = iam.list_user_policies(UserName=user).get('PolicyNames', [])
-                for policy in inline_policies:
-                    iam.delete_user_policy(UserName=user, PolicyName=policy)
-
-                iam.delete_login_profile(UserName=user)
-                iam.delete_user(UserName=user)
-                log(f"Deleted IAM user: {user}")
-            except Exception as e:
-                log(f"Failed to delete IAM user {user}: {e}")
-
-        # Delete Budgets
-        try:
-            response = budgets.describe_budgets(AccountId=config['account_id'])
-            for budget in response.get('Budgets', []):
-                if budget['BudgetName'].startswith(customer_code):
-                    budgets.delete_budget(AccountId=config['account_id'], BudgetName=budget['BudgetName'])
-                    log(f"Deleted Budget: {budget['BudgetName']}")
-        except Exception as e:
-            log(f"Failed to delete budgets: {e}")
-
-        # Delete Network Interfaces
-        network_interfaces = ec2.describe_network_interfaces(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for ni in network_interfaces['NetworkInterfaces']:
-            try:
-                ec2.delete_network_interface(NetworkInterfaceId=ni['NetworkInterfaceId'])
-                log(f"Deleted Network Interface: {ni['NetworkInterfaceId']}")
-            except Exception as e:
-                log(f"Failed to delete Network Interface {ni['NetworkInterfaceId']}: {e}")
-
-        # Delete NAT Gateways
-        nat_gateways = ec2.describe_nat_gateways(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for nat in nat_gateways['NatGateways']:
-            try:
-                ec2.delete_nat_gateway(NatGatewayId=nat['NatGatewayId'])
-                log(f"Deleted NAT Gateway: {nat['NatGatewayId']}")
-            except Exception as e:
-                log(f"Failed to delete NAT Gateway {nat['NatGatewayId']}: {e}")
-
-        # Delete Security Groups
-        security_groups = ec2.describe_security_groups(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for sg in security_groups['SecurityGroups']:
-            try:
-                ec2.delete_security_group(GroupId=sg['GroupId'])
-                log(f"Deleted Security Group: {sg['GroupId']}")
-            except Exception as e:
-                log(f"Failed to delete Security Group {sg['GroupId']}: {e}")
-
-        # Delete Route Tables
-        route_tables = ec2.describe_route_tables(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for rt in route_tables['RouteTables']:
-            try:
-                ec2.delete_route_table(RouteTableId=rt['RouteTableId'])
-                log(f"Deleted Route Table: {rt['RouteTableId']}")
-            except Exception as e:
-                log(f"Failed to delete Route Table {rt['RouteTableId']}: {e}")
-
-        # Delete Subnets
-        subnets = ec2.describe_subnets(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for subnet in subnets['Subnets']:
-            try:
-                ec2.delete_subnet(SubnetId=subnet['SubnetId'])
-                log(f"Deleted Subnet: {subnet['SubnetId']}")
-            except Exception as e:
-                log(f"Failed to delete Subnet {subnet['SubnetId']}: {e}")
-
-        # Delete Internet Gateways
-        igws = ec2.describe_internet_gateways(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for igw in igws['InternetGateways']:
-            try:
-                ec2.detach_internet_gateway(InternetGatewayId=igw['InternetGatewayId'], VpcId=igw['Attachments'][0]['VpcId'])
-                ec2.delete_internet_gateway(InternetGatewayId=igw['InternetGatewayId'])
-                log(f"Deleted Internet Gateway: {igw['InternetGatewayId']}")
-            except Exception as e:
-                log(f"Failed to delete Internet Gateway {igw['InternetGatewayId']}: {e}")
-
-        # Delete Transit Gateways
-        transit_gateways = tgw.describe_transit_gateways(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for tg in transit_gateways['TransitGateways']:
-            try:
-                tgw.delete_transit_gateway(TransitGatewayId=tg['TransitGatewayId'])
-                log(f"Deleted Transit Gateway: {tg['TransitGatewayId']}")
-            except Exception as e:
-                log(f"Failed to delete Transit Gateway {tg['TransitGatewayId']}: {e}")
-
-        # Delete VPCs
-        vpcs = ec2.describe_vpcs(Filters=[
-            {'Name': 'tag:Customer', 'Values': [customer_code]}
-        ])
-        for vpc in vpcs['Vpcs']:
-            try:
-                ec2.delete_vpc(VpcId=vpc['VpcId'])
-                log(f"Deleted VPC: {vpc['VpcId']}")
-            except Exception as e:
-                log(f"Failed to delete VPC {vpc['VpcId']}: {e}")
-
-        log(f"All resources for customer {customer_code} have been deleted.")
-
-    except Exception as e:
-        log(f"Error deleting resources for customer {customer_code}: {e}")
-        raise
-
-def create_ec2_instances(config, vpc_resources):
-    """Create EC2 instances for the customer's environments."""
-    ec2 = boto3.client('ec2', region_name=config['region'])
-
-    # Ensure the key pair exists or create it
-    key_name = f"{config['customer_code']}-key"
-    try:
-        existing_keys = ec2.describe_key_pairs(KeyNames=[key_name])
-        log(f"Key Pair {key_name} already exists.")
-    except botocore.exceptions.ClientError as e:
-        if 'InvalidKeyPair.NotFound' in str(e):
-            log(f"Key Pair {key_name} not found. Creating new key pair.")
-            key_pair = ec2.create_key_pair(KeyName=key_name)
-            with open(f"{key_name}.pem", "w") as key_file:
-                key_file.write(key_pair['KeyMaterial'])
-            log(f"Created Key Pair: {key_name}")
-        else:
-            log(f"Unexpected error while checking key pairs: {e}")
-            raise
-
-    for env in config['environments']:
-        env_name = env['name']
-        subnet_id = vpc_resources['subnets'][env_name]
-        for node in env['nodes']:
-            try:
-                # Validate instance parameters
-                if 'instance_type' not in node or 'ami_id' not in node:
-                    log(f"Error: Missing 'instance_type' or 'ami_id' for {node['type']} in {env_name}")
-                    continue
-
-                instance_type = node['instance_type']
-                ami_id = node['ami_id']
-                tags = [
-                    {'Key': 'Customer', 'Value': config['customer_code']},
-                    {'Key': 'Environment', 'Value': env_name},
-                    {'Key': 'Node', 'Value': node['type']}
-                ]
-
-                instance = ec2.run_instances(
-                    ImageId=ami_id,
-                    InstanceType=instance_type,
-                    KeyName=key_name,
-                    SubnetId=subnet_id,
-                    MinCount=1,
-                    MaxCount=1,
-                    TagSpecifications=[
-                        {
-                            'ResourceType': 'instance',
-                            'Tags': tags
-                        }
-                    ]
-                )
-                instance_id = instance['Instances'][0]['InstanceId']
-                log(f"Launched EC2 instance {instance_id} for {node['type']} in {env_name}")
-            except Exception as e:
-                log(f"Error launching EC2 instance for {node['type']} in {env_name}: {e}")
-
-def create_internet_gateway_with_retry(ec2, max_retries=3):
-    for attempt in range(max_retries):
-        try:
-            igw = ec2.create_internet_gateway()
-            logger.info(f"Successfully created Internet Gateway: {igw}")
-            return igw
-        except Exception as e:
-            logger.error(f"Attempt {attempt + 1} failed: {e}")
-            time.sleep(2 ** attempt)  # Exponential backoff
-    raise Exception("Failed to create Internet Gateway after multiple attempts.")
+            if 'instance_type' not in node or not image_reference(config, node):
+                raise ValueError(f"Missing 'instance_type' or image (ami_id or images) for {node['type']} in {env['name']}")
 
 def create_vpc_with_tgw(config):
     """Create a dedicated VPC and attach it to a specified Transit Gateway with Elastic Network Interfaces."""
-    ec2 = boto3.client('ec2', region_name=config['region'])
-    tgw = boto3.client('ec2', region_name=config['region'])  # Transit Gateway client
+    ec2 = get_client('ec2', config['region'])
 
     try:
         # Use the provided Transit Gateway ID from the config
         transit_gateway_id = config['transit_gateway_id']
         log(f"Using Transit Gateway: {transit_gateway_id}")
 
-        # Validate Transit Gateway
+        # Validate Transit Gateway (cached: it is shared by every customer in the region)
         try:
-            tgw_response = tgw.describe_transit_gateways(TransitGatewayIds=[transit_gateway_id])
-            if not tgw_response['TransitGateways']:
+            if not metadata_cache.transit_gateway(config['region'], transit_gateway_id):
                 log(f"Transit Gateway {transit_gateway_id} does not exist. Skipping attachment.")
                 return None  # Skip further TGW-related operations
             log(f"Validated Transit Gateway: {transit_gateway_id}")
@@ -359,32 +67,19 @@ def create_vpc_with_tgw(config):
             return None  # Skip further TGW-related operations
 
         # Create or retrieve Key Pair
-        try:
-            key_name = f"{config['customer_code']}-key"
-            existing_keys = ec2.describe_key_pairs()['KeyPairs']
-            if not any(k['KeyName'] == key_name for k in existing_keys):
-                key_pair = ec2.create_key_pair(KeyName=key_name)
-                with open(f"{key_name}.pem", "w") as key_file:
-                    key_file.write(key_pair['KeyMaterial'])
-                log(f"Created Key Pair: {key_name}")
-            else:
-                log(f"Key Pair {key_name} already exists.")
-        except Exception as e:
-            log(f"Error creating or retrieving Key Pair: {e}")
-            raise
+        key_name = ensure_key_pair(ec2, config)
 
         # Create VPC
-        vpc = ec2.create_vpc(CidrBlock="192.168.0.0/16")
+        vpc = ec2.create_vpc(
+            CidrBlock="192.168.0.0/16",
+            TagSpecifications=tag_specifications('vpc', config['customer_code'], name=f"{config['customer_code']}-vpc")
+        )
         vpc_id = vpc['Vpc']['VpcId']
-        ec2.create_tags(Resources=[vpc_id], Tags=[
-            {'Key': 'Customer', 'Value': config['customer_code']},
-            {'Key': 'Name', 'Value': f"{config['customer_code']}-vpc"}
-        ])
-        log(f"Created VPC: {vpc_id} with name {config['customer_code']}-vpc")
+        log(f"Created VPC: {vpc_id} with name {config['customer_code']}-vpc", resource_id=vpc_id)
+        manifest.record(config['customer_code'], 'vpc', vpc_id)
 
         # Retrieve all availability zones
-        azs = ec2.describe_availability_zones()['AvailabilityZones']
-        az_list = [az['ZoneName'] for az in azs]
+        az_list = metadata_cache.availability_zones(config['region'])
         log(f"Available AZs: {az_list}")
 
         # Create Subnets for each environment in unique AZs
@@ -392,32 +87,29 @@ def create_vpc_with_tgw(config):
         for i, env in enumerate(config['environments']):
             cidr_block = f"192.168.{i}.0/24"
             az = az_list[i % len(az_list)]  # Assign AZs in a round-robin fashion
-            subnet = ec2.create_subnet(VpcId=vpc_id, CidrBlock=cidr_block, AvailabilityZone=az)
+            subnet = ec2.create_subnet(
+                VpcId=vpc_id,
+                CidrBlock=cidr_block,
+                AvailabilityZone=az,
+                TagSpecifications=tag_specifications('subnet', config['customer_code'], environment=env['name'])
+            )
             subnet_id = subnet['Subnet']['SubnetId']
-            ec2.create_tags(Resources=[subnet_id], Tags=[
-                {'Key': 'Customer', 'Value': config['customer_code']},
-                {'Key': 'Environment', 'Value': env['name']}
-            ])
-            log(f"Created Subnet for {env['name']} in AZ {az}: {subnet_id} with CIDR {cidr_block}")
+            log(f"Created Subnet for {env['name']} in AZ {az}: {subnet_id} with CIDR {cidr_block}",
+                environment=env['name'], resource_id=subnet_id)
+            manifest.record(config['customer_code'], 'subnet', subnet_id, environment=env['name'])
             subnets[env['name']] = subnet_id
 
         # Attach VPC to Transit Gateway
         try:
-            tgw_attachment = tgw.create_transit_gateway_vpc_attachment(
+            tgw_attachment = ec2.create_transit_gateway_vpc_attachment(
                 TransitGatewayId=transit_gateway_id,
                 VpcId=vpc_id,
                 SubnetIds=list(subnets.values()),
-                TagSpecifications=[
-                    {
-                        'ResourceType': 'transit-gateway-attachment',
-                        'Tags': [
-                            {'Key': 'Customer', 'Value': config['customer_code']}
-                        ]
-                    }
-                ]
+                TagSpecifications=tag_specifications('transit-gateway-attachment', config['customer_code'])
             )
             attachment_id = tgw_attachment['TransitGatewayVpcAttachment']['TransitGatewayAttachmentId']
-            log(f"Attached VPC {vpc_id} to Transit Gateway with attachment ID: {attachment_id}")
+            log(f"Attached VPC {vpc_id} to Transit Gateway with attachment ID: {attachment_id}", resource_id=attachment_id)
+            manifest.record(config['customer_code'], 'transit_gateway_attachment', attachment_id)
         except Exception as e:
             log(f"Failed to attach VPC to Transit Gateway: {e}")
             raise
@@ -425,20 +117,14 @@ def create_vpc_with_tgw(config):
         # Create Security Group
         sg = ec2.create_security_group(GroupName=f"{config['customer_code']}-sg",
                                        Description="Customer Security Group",
-                                       VpcId=vpc_id)
+                                       VpcId=vpc_id,
+                                       TagSpecifications=tag_specifications('security-group', config['customer_code']))
         security_group_id = sg['GroupId']
-        ec2.create_tags(Resources=[security_group_id], Tags=[{'Key': 'Customer', 'Value': config['customer_code']}])
-        log(f"Created Security Group: {security_group_id}")
-
-        # Add rules to Security Group
-        for port in config['allowed_ports']:
-            ec2.authorize_security_group_ingress(
-                GroupId=security_group_id,
-                IpProtocol="tcp",
-                FromPort=port,
-                ToPort=port,
-                CidrIp="0.0.0.0/0"
-            )
+        log(f"Created Security Group: {security_group_id}", resource_id=security_group_id)
+        manifest.record(config['customer_code'], 'security_group', security_group_id)
+
+        # Add rules to Security Group; a new group has no ingress rules yet
+        apply_ingress_rules(ec2, security_group_id, config['allowed_ports'], existing=[])
         log(f"Configured Security Group with ports: {config['allowed_ports']}")
 
         return {
@@ -452,63 +138,11 @@ def create_vpc_with_tgw(config):
         log(f"Error creating VPC with Transit Gateway: {e}")
         raise
 
-def generate_cloudformation_template(config, vpc_resources):
-    """Generate a CloudFormation template based on VPC and related resources."""
+def generate_cloudformation_template(config):
+    """Write the CloudFormation template equivalent to the customer's deployment (see stacks.py)."""
     log("Generating CloudFormation template...")
-    
-    template = {
-        "AWSTemplateFormatVersion": "2010-09-09",
-        "Resources": {}
-    }
-
-    # Add VPC
-    template["Resources"]["VPC"] = {
-        "Type": "AWS::EC2::VPC",
-        "Properties": {
-            "CidrBlock": config.get("vpc_cidr", "192.168.0.0/16"),
-            "Tags": [{"Key": "Customer", "Value": config["customer_code"]}]
-        }
-    }
-
-    # Add Subnets
-    for subnet_id, subnet_data in vpc_resources.get("subnets", {}).items():
-        template["Resources"][f"Subnet{subnet_id}"] = {
-            "Type": "AWS::EC2::Subnet",
-            "Properties": {
-                "VpcId": {"Ref": "VPC"},
-                "CidrBlock": subnet_data["CidrBlock"],
-                "AvailabilityZone": subnet_data["AvailabilityZone"],
-                "Tags": [{"Key": "Customer", "Value": config["customer_code"]}]
-            }
-        }
-
-    # Add Security Groups
-    for sg_id, sg_data in vpc_resources.get("security_groups", {}).items():
-        template["Resources"][f"SecurityGroup{sg_id}"] = {
-            "Type": "AWS::EC2::SecurityGroup",
-            "Properties": {
-                "VpcId": {"Ref": "VPC"},
-                "GroupDescription": sg_data["Description"],
-                "SecurityGroupIngress": sg_data["IngressRules"],
-                "Tags": [{"Key": "Customer", "Value": config["customer_code"]}]
-            }
-        }
-
-    # Add Instances
-    for instance_id, instance_data in vpc_resources.get("instances", {}).items():
-        template["Resources"][f"Instance{instance_id}"] = {
-            "Type": "AWS::EC2::Instance",
-            "Properties": {
-                "InstanceType": instance_data["InstanceType"],
-                "SubnetId": {"Ref": f"Subnet{instance_data["SubnetId"]}"},
-                "ImageId": instance_data["ImageId"],
-                "KeyName": instance_data["KeyName"],
-                "Tags": [{"Key": "Customer", "Value": config["customer_code"]}]
-            }
-        }
-
-    # Save template to file
     try:
+        template = build_template(config)
         output_path = config.get("cloudformation_template_path", "cloudformation_template.json")
         with open(output_path, "w") as file:
             json.dump(template, file, indent=4)
@@ -519,7 +153,7 @@ def generate_cloudformation_template(config, vpc_resources):
 
 def create_key_pair(config):
     """Create a unique key pair for the customer."""
-    ec2 = boto3.client('ec2', region_name=config['region'])
+    ec2 = get_client('ec2', config['region'])
     key_pair_name = f"{config['customer_code']}_key"
 
     try:
@@ -531,7 +165,10 @@ def create_key_pair(config):
         if "InvalidKeyPair.NotFound" in str(e):
             # Create the key pair if it doesn't exist
             logger.info(f"Key pair '{key_pair_name}' not found. Creating it now.")
-            key_pair = ec2.create_key_pair(KeyName=key_pair_name)
+            key_pair = ec2.create_key_pair(
+                KeyName=key_pair_name,
+                TagSpecifications=tag_specifications('key-pair', config['customer_code'])
+            )
             key_material = key_pair['KeyMaterial']
 
             # Save the private key to a file
@@ -541,6 +178,7 @@ def create_key_pair(config):
             os.chmod(private_key_path, 0o400)  # Restrict permissions on the key file
 
             logger.info(f"Key pair '{key_pair_name}' created and saved as '{private_key_path}'.")
+            manifest.record(config['customer_code'], 'key_pair', key_pair_name)
             return key_pair_name
         else:
             logger.error(f"Error checking key pair: {e}")
@@ -548,7 +186,7 @@ def create_key_pair(config):
 
 def create_db_subnet_group(config, subnets):
     """Create a DB Subnet Group for RDS instances."""
-    rds = boto3.client('rds', region_name=config['region'])
+    rds = get_client('rds', config['region'])
     subnet_ids = list(subnets.values())  # Use subnet IDs from the VPC setup
 
     db_subnet_group_name = f"{config['customer_code']}_db_subnet_group"
@@ -564,237 +202,166 @@ def create_db_subnet_group(config, subnets):
                 DBSubnetGroupName=db_subnet_group_name,
                 SubnetIds=subnet_ids,
                 DBSubnetGroupDescription=f"DB Subnet Group for {config['customer_code']}",
-                Tags=[
-                    {'Key': 'Customer', 'Value': config['customer_code']}
-                ]
+                Tags=build_tags(config['customer_code'])
             )
             logger.info(f"Created DB Subnet Group '{db_subnet_group_name}' with subnets: {subnet_ids}")
+            manifest.record(config['customer_code'], 'db_subnet_group', db_subnet_group_name)
         except Exception as e:
             logger.error(f"Error creating DB Subnet Group: {e}")
             raise
 
     return db_subnet_group_name
 
-def create_secure_password():
-    characters = string.ascii_letters + string.digits + "!@#$%^&*()-_+=<>?[]{}"
-    password = ''.join(random.choices(characters, k=16))
-    while (not any(c.isupper() for c in password) or
-           not any(c.isdigit() for c in password) or
-           not any(c in "!@#$%^&*()-_+=<>?[]{}" for c in password)):
-        password = ''.join(random.choices(characters, k=16))
-    return password
-    
-def create_iam_users(config):
-    """Create IAM users for the customer with detailed permissions."""
-    iam = boto3.client("iam")
-    customer_code = config["customer_code"]
-
-    for env in config["environments"]:
-        env_name = env["name"]
-        env_code = env["code"]
-        
-        for account_type in ["admin", "service", "promotion", "restricted"]:
-            user_name = f"{customer_code}-{env_code}-{account_type}"
-            try:
-                # Create IAM user
-                iam.create_user(UserName=user_name)
-                log(f"Created IAM user: {user_name}")
-
-                # Generate policy document based on account type
-                policy_document = generate_policy_document(account_type, env_code, config)
-                
-                # Create an inline policy for the user
-                policy_name = f"{user_name}-policy"
-                iam.put_user_policy(
-                    UserName=user_name,
-                    PolicyName=policy_name,
-                    PolicyDocument=json.dumps(policy_document)
-                )
-                log(f"Attached policy to {user_name}")
-
-                # Create login profile for the user
-                password = generate_strong_password()
-                iam.create_login_profile(
-                    UserName=user_name,
-                    Password=password,
-                    PasswordResetRequired=True
-                )
-                log(f"Password for {user_name}: {password}")
-
-            except iam.exceptions.EntityAlreadyExistsException:
-                log(f"Error creating IAM user {user_name}: User already exists.")
-            except Exception as e:
-                log(f"Error creating IAM user {user_name}: {e}")
-
-def generate_policy_document(account_type, env_code, config):
-    """Generate IAM policy document based on account type and environment level."""
-    customer_code = config["customer_code"]
-    s3_arn_prefix = f"arn:aws:s3:::{customer_code}"
-    file_server_arn_prefix = f"arn:aws:fsx:*:*:file-system/{customer_code}"
-
-    policy = {
-        "Version": "2012-10-17",
-        "Statement": []
-    }
-
-    if account_type == "promotion":
-        next_env_code = f"{int(env_code) - 1:02}"  # Calculate the next higher environment
-        policy["Statement"].append({
-            "Effect": "Allow",
-            "Action": [
-                "s3:*",
-                "fsx:*"
-            ],
-            "Resource": [
-                f"{s3_arn_prefix}-{env_code}/*",
-                f"{file_server_arn_prefix}-{env_code}",
-                f"{s3_arn_prefix}-{next_env_code}/*",
-                f"{file_server_arn_prefix}-{next_env_code}"
-            ]
-        })
-
-    elif account_type == "admin":
-        policy["Statement"].append({
-            "Effect": "Allow",
-            "Action": "*",
-            "Resource": f"{s3_arn_prefix}-{env_code}/*"
-        })
-
-    elif account_type == "restricted":
-        policy["Statement"].append({
-            "Effect": "Allow",
-            "Action": [
-                "s3:Get*",
-                "s3:List*",
-                "fsx:DescribeFileSystems"
-            ],
-            "Resource": [
-                f"{s3_arn_prefix}-{env_code}/*",
-                f"{file_server_arn_prefix}-{env_code}"
-            ]
-        })
-
-    return policy
-                
-def create_service_accounts(config):
-    """Create service, promotion, and restricted accounts with specific permissions."""
-    iam = boto3.client('iam')
+def database_identifier(config, env):
+    return f"{config['customer_code']}-{env['code']}-db"
+
+def database_snapshot(config, env):
+    """The pre-seeded Qlik repository snapshot to restore for an environment, if any."""
+    return env.get('db_snapshot_identifier', config.get('db_snapshot_identifier'))
+
+def create_database(config, env, db_subnet_group_name, security_group_id):
+    """Start creating one environment's RDS instance; RDS builds it in the background."""
+    rds = get_client('rds', config['region'])
+    db_identifier = database_identifier(config, env)
+    settings = dict(
+        DBInstanceIdentifier=db_identifier,
+        DBInstanceClass=config.get('db_instance_class', 'db.t3.micro'),
+        VpcSecurityGroupIds=[security_group_id],
+        DBSubnetGroupName=db_subnet_group_name,
+        Tags=build_tags(config['customer_code'], environment=env['code'])
+    )
+    snapshot = database_snapshot(config, env)
+    if snapshot:
+        rds.restore_db_instance_from_db_snapshot(DBSnapshotIdentifier=snapshot, **settings)
+        logger.info(f"Restoring PostgreSQL instance {db_identifier} from snapshot {snapshot}",
+                    extra={'environment': env['name'], 'resource_id': db_identifier})
+    else:
+        rds.create_db_instance(
+            AllocatedStorage=20,
+            Engine='postgres',
+            MasterUsername=config['db_username'],
+            MasterUserPassword=config['db_password'],
+            **settings
+        )
+        logger.info(f"Created PostgreSQL instance: {db_identifier}",
+                    extra={'environment': env['name'], 'resource_id': db_identifier})
+    manifest.record(config['customer_code'], 'db_instance', db_identifier, environment=env['code'])
+    return db_identifier
 
-    for env in config['environments']:
-        for account_type in ['service', 'promotion', 'restricted']:
-            account_name = f"{config['customer_code']}-{env['code']}-{account_type}"
+def setup_postgres(config, vpc_resources):
+    """Set up PostgreSQL backend or configure default on central node.
 
+    Every environment's RDS instance is requested at once, restored from
+    db_snapshot_identifier when one is configured, and the identifiers are
+    returned without waiting; the repository_ready stages wait for each one.
+    """
+    if not config['use_aws_rds']:
+        logger.info("Using default PostgreSQL setup on the central node.")
+        return []
+
+    db_subnet_group_name = create_db_subnet_group(config, vpc_resources['subnets'])
+    environments = config['environments']
+    with ThreadPoolExecutor(max_workers=max(1, len(environments))) as pool:
+        jobs = {pool.submit(carry_context(create_database), config, env, db_subnet_group_name,
+                            vpc_resources['security_group_id']): env for env in environments}
+        databases, failed = [], []
+        for job, env in jobs.items():
             try:
-                user = iam.create_user(UserName=account_name)
-                log(f"Created IAM user: {account_name}")
-
-                password = os.urandom(16).hex()
-                iam.create_login_profile(
-                    UserName=account_name,
-                    Password=password,
-                    PasswordResetRequired=True
-                )
-                log(f"Password for {account_name}: {password}")
-
-                policy_arn = config['permissions'][account_type]
-                iam.attach_user_policy(
-                    UserName=account_name,
-                    PolicyArn=policy_arn
-                )
-                log(f"Attached policy {policy_arn} to {account_name}")
-
+                databases.append(job.result())
             except Exception as e:
-                log(f"Error creating IAM user {account_name}: {e}")
+                logger.error(f"Error creating PostgreSQL instance for {env['name']}: {e}",
+                             extra={'environment': env['name']})
+                failed.append(env['name'])
+    if failed:
+        # Created instances are in the manifest, so a teardown or resume still finds them
+        raise RuntimeError(f"Could not create the PostgreSQL instances of {', '.join(failed)}")
+    return databases
 
-def setup_postgres(config, vpc_resources):
-    """Set up PostgreSQL backend or configure default on central node."""
-    if config['use_aws_rds']:
-        rds = boto3.client('rds', region_name=config['region'])
+def create_ec2_instances(config, vpc_resources):
+    """Create EC2 instances for the customer's environments."""
+    ec2 = get_client('ec2', config['region'])
+    key_name = ensure_key_pair(ec2, config)
 
+    launched = {}
+    for (ami_id, instance_type, subnet_id, tags), group in group_node_launches(config, vpc_resources).items():
+        env_name, node_type = group['env_name'], group['node_type']
+        count = group['count']
         try:
-            # Create DB Subnet Group
-            db_subnet_group_name = create_db_subnet_group(config, vpc_resources['subnets'])
-
-            for env in config['environments']:
-                db_identifier = f"{config['customer_code']}-{env['code']}-db"
-
-                rds.create_db_instance(
-                    DBInstanceIdentifier=db_identifier,
-                    AllocatedStorage=20,
-                    DBInstanceClass='db.t3.micro',
-                    Engine='postgres',
-                    MasterUsername=config['db_username'],
-                    MasterUserPassword=config['db_password'],
-                    VpcSecurityGroupIds=[vpc_resources['security_group_id']],
-                    DBSubnetGroupName=db_subnet_group_name,
-                    Tags=[
-                        {'Key': 'Customer', 'Value': config['customer_code']},
-                        {'Key': 'Environment', 'Value': env['code']}
-                    ]
-                )
-                logger.info(f"Created PostgreSQL instance: {db_identifier}")
-
+            template = ensure_launch_template(ec2, config, group['node'], key_name, vpc_resources['security_group_id'])
+            instance_ids = launch_instances(ec2, config, template, subnet_id,
+                                            [{'Key': key, 'Value': value} for key, value in tags],
+                                            count, env_name, node_type)
+            launched.setdefault(env_name, {}).setdefault(node_type, []).extend(instance_ids)
         except Exception as e:
-            logger.error(f"Error setting up PostgreSQL on RDS: {e}")
-    else:
-        logger.info("Using default PostgreSQL setup on the central node.")
+            log(f"Error launching {count} EC2 instance(s) for {node_type} in {env_name}: {e}")
 
-def create_ec2_instances(config, vpc_resources):
-    """Create EC2 instances for the customer's environments."""
-    ec2 = boto3.client('ec2', region_name=config['region'])
+    return launched
 
-    # Ensure the key pair exists or create it
+def ensure_key_pair(ec2, config):
+    """Ensure the customer's key pair exists, creating it if needed, and return its name."""
     key_name = f"{config['customer_code']}-key"
-    try:
-        existing_keys = ec2.describe_key_pairs(KeyNames=[key_name])
+    if metadata_cache.key_pair(config['region'], key_name):
         log(f"Key Pair {key_name} already exists.")
-    except botocore.exceptions.ClientError as e:
-        if 'InvalidKeyPair.NotFound' in str(e):
-            log(f"Key Pair {key_name} not found. Creating new key pair.")
-            key_pair = ec2.create_key_pair(KeyName=key_name)
-            with open(f"{key_name}.pem", "w") as key_file:
-                key_file.write(key_pair['KeyMaterial'])
-            log(f"Created Key Pair: {key_name}")
-        else:
-            log(f"Unexpected error while checking key pairs: {e}")
-            raise
-
+    else:
+        log(f"Key Pair {key_name} not found. Creating new key pair.")
+        key_pair = ec2.create_key_pair(
+            KeyName=key_name,
+            TagSpecifications=tag_specifications('key-pair', config['customer_code'])
+        )
+        with open(f"{key_name}.pem", "w") as key_file:
+            key_file.write(key_pair['KeyMaterial'])
+        log(f"Created Key Pair: {key_name}")
+        manifest.record(config['customer_code'], 'key_pair', key_name)
+        metadata_cache.store('key_pair', config['region'], key_name,
+                             {'KeyName': key_name, 'KeyPairId': key_pair.get('KeyPairId')})
+    return key_name
+
+def launch_instances(ec2, config, template, subnet_id, tags, count, env_name, node_type):
+    """Launch up to count identical instances from a launch template with one run_instances call.
+
+    Returns the IDs of the launched instances.
+    """
+    response = ec2.run_instances(
+        LaunchTemplate=template,
+        SubnetId=subnet_id,
+        MinCount=1,  # Accept partial capacity rather than failing the whole group
+        MaxCount=count,
+        TagSpecifications=[
+            {
+                'ResourceType': 'instance',
+                'Tags': tags
+            }
+        ]
+    )
+    instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+    for instance_id in instance_ids:
+        manifest.record(config['customer_code'], 'instance', instance_id, environment=env_name, node=node_type)
+    log(f"Launched {len(instance_ids)} EC2 instance(s) {instance_ids} for {node_type} in {env_name}",
+        environment=env_name, resource_id=",".join(instance_ids))
+    if len(instance_ids) < count:
+        log(f"Partial capacity for {node_type} in {env_name}: requested {count}, launched {len(instance_ids)}")
+    return instance_ids
+
+def group_node_launches(config, vpc_resources):
+    """Group the configured nodes by (AMI, instance type, subnet, tags) and total their counts.
+
+    Each group is launched with a single run_instances call.  The nodes'
+    images and instance types were resolved and checked by resolve_images().
+    """
+    groups = {}
     for env in config['environments']:
         env_name = env['name']
         subnet_id = vpc_resources['subnets'][env_name]
         for node in env['nodes']:
-            try:
-                # Validate instance parameters
-                if 'instance_type' not in node or 'ami_id' not in node:
-                    log(f"Error: Missing 'instance_type' or 'ami_id' for {node['type']} in {env_name}")
-                    continue
-
-                instance_type = node['instance_type']
-                ami_id = node['ami_id']
-                tags = [
-                    {'Key': 'Customer', 'Value': config['customer_code']},
-                    {'Key': 'Environment', 'Value': env_name},
-                    {'Key': 'Node', 'Value': node['type']}
-                ]
-
-                instance = ec2.run_instances(
-                    ImageId=ami_id,
-                    InstanceType=instance_type,
-                    KeyName=key_name,
-                    SubnetId=subnet_id,
-                    MinCount=1,
-                    MaxCount=1,
-                    TagSpecifications=[
-                        {
-                            'ResourceType': 'instance',
-                            'Tags': tags
-                        }
-                    ]
-                )
-                instance_id = instance['Instances'][0]['InstanceId']
-                log(f"Launched EC2 instance {instance_id} for {node['type']} in {env_name}")
-            except Exception as e:
-                log(f"Error launching EC2 instance for {node['type']} in {env_name}: {e}")
+            count = int(node.get('count', 1))
+            if count < 1:
+                continue
+
+            tags = build_tags(config['customer_code'], environment=env_name, node_type=node['type'])
+            key = (node['ami_id'], node['instance_type'], subnet_id, tuple((t['Key'], t['Value']) for t in tags))
+            group = groups.setdefault(key, {'env_name': env_name, 'node_type': node['type'], 'node': node, 'count': 0})
+            group['count'] += count
+    return groups
 
 def setup_budgeting(config):
     setup_budget(
@@ -805,7 +372,7 @@ def setup_budgeting(config):
 
 def setup_budget(customer_code, region, account_id):
     """Set up budget alerts for a specific customer."""
-    budgets = boto3.client('budgets', region_name=region)
+    budgets = get_client('budgets', region)
 
     budget_name = f"{customer_code}-budget"
     log(f"Setting up budget: {budget_name}")
@@ -847,6 +414,7 @@ def setup_budget(customer_code, region, account_id):
             ]
         )
         log(f"Budget {budget_name} created successfully.")
+        manifest.record(customer_code, 'budget', budget_name, account_id=account_id)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'DuplicateRecordException':
             log(f"Budget {budget_name} already exists. Skipping creation.")
@@ -855,11 +423,10 @@ def setup_budget(customer_code, region, account_id):
 
 def delete_budget(customer_code, region, account_id):
     """Delete budgets associated with a specific customer."""
-    budgets = boto3.client('budgets', region_name=region)
+    budgets = get_client('budgets', region)
 
     try:
-        response = budgets.describe_budgets(AccountId=account_id)
-        for budget in response.get('Budgets', []):
+        for budget in iter_resources(budgets, 'describe_budgets', 'Budgets', AccountId=account_id):
             if budget['BudgetName'].startswith(customer_code):
                 try:
                     budgets.delete_budget(AccountId=account_id, BudgetName=budget['BudgetName'])
@@ -874,20 +441,250 @@ def load_config(config_file):
     with open(config_file, 'r') as file:
         return yaml.safe_load(file)
 
-def main():
-    config = load_config('config.yaml')
+def wait_for_transit_gateway_attachment(config, vpc_resources):
+    """Wait until the VPC's Transit Gateway attachment is available."""
+    attachment_id = vpc_resources['transit_gateway_attachment_id']
+    wait_until(config['region'], 'transit_gateway_attachment', [attachment_id],
+               timeout=config.get('readiness_timeout', READINESS_TIMEOUT))
+    return attachment_id
+
+def wait_for_instances(config, instances):
+    """Wait until every launched instance is running."""
+    instance_ids = [i for nodes in instances.values() for ids in nodes.values() for i in ids]
+    return wait_until(config['region'], 'instance', instance_ids,
+                      timeout=config.get('readiness_timeout', READINESS_TIMEOUT))
+
+def wait_for_database(config, env, databases):
+    """Wait until an environment's RDS instance is available and return how to reach it.
+
+    A database restored from a snapshot comes up with the snapshot's master
+    password, so it is reset to the configured one first.  Without RDS the
+    repository runs on the environment's central node, which is reported as
+    {'central': True} rather than None, so the stages waiting on it still run.
+    """
+    if not config['use_aws_rds']:
+        return {'identifier': None, 'address': None, 'port': None, 'central': True}
+    db_identifier = database_identifier(config, env)
+    if db_identifier not in databases:
+        return None
+    wait_until(config['region'], 'db_instance', [db_identifier],
+               timeout=config.get('readiness_timeout', READINESS_TIMEOUT))
+    rds = get_client('rds', config['region'])
+    if database_snapshot(config, env):
+        rds.modify_db_instance(DBInstanceIdentifier=db_identifier, MasterUserPassword=config['db_password'],
+                               ApplyImmediately=True)
+    endpoint = rds.describe_db_instances(DBInstanceIdentifier=db_identifier)['DBInstances'][0].get('Endpoint', {})
+    return {'identifier': db_identifier, 'address': endpoint.get('Address'), 'port': endpoint.get('Port')}
+
+def environment_ready(config, env, instances, **repository):
+    """Return what configuring an environment's nodes needs, once its nodes run and its repository is up.
+
+    repository holds the environment's repository:<env> output: the RDS
+    endpoint, or the central marker when the repository runs on the central node.
+    """
+    database = repository[f"repository:{env['name']}"]
+    nodes = instances.get(env['name'], {})
+    where = "the central node" if database.get('central') else f"{database['address']}:{database['port']}"
+    logger.info(f"Environment {env['name']} ready: {sum(len(ids) for ids in nodes.values())} node(s), "
+                f"repository on {where}", extra={'environment': env['name']})
+    return {'nodes': nodes, 'repository': database}
+
+def build_provisioning_stages(config):
+    """Declare the provisioning stages with the outputs each one consumes and produces."""
+    return [
+        Stage("vpc", partial(create_vpc_with_tgw, config), provides="vpc_resources"),
+        Stage("iam", partial(provision_iam, config)),
+        Stage("ec2_instances", partial(create_ec2_instances, config), requires=["vpc_resources"], provides="instances"),
+        Stage("postgres", partial(setup_postgres, config), requires=["vpc_resources"], provides="databases"),
+        Stage("budget", partial(setup_budget, customer_code=config['customer_code'], region=config['region'], account_id=config['account_id'])),
+        Stage("cloudformation_template", partial(generate_cloudformation_template, config)),
+        # Readiness: each resolves the moment its resources reach their target state
+        Stage("tgw_attachment_ready", partial(wait_for_transit_gateway_attachment, config),
+              requires=["vpc_resources"], provides="tgw_attachment"),
+        Stage("instances_running", partial(wait_for_instances, config), requires=["instances"]),
+    ] + [
+        # One pair per environment, so an environment is ready as soon as its own repository is,
+        # whatever the other environments' databases are still doing
+        stage for env in config['environments'] for stage in (
+            Stage(f"repository_ready:{env['name']}", partial(wait_for_database, config, env),
+                  requires=["databases"], provides=f"repository:{env['name']}"),
+            Stage(f"environment_ready:{env['name']}", partial(environment_ready, config, env),
+                  requires=["instances", f"repository:{env['name']}"], provides=f"environment:{env['name']}",
+                  after=["instances_running", "tgw_attachment_ready"]),
+        )
+    ]
+
+def apply_plan(config, changes, live):
+    """Execute a change set from plan.compute_plan() against the live deployment."""
     customer_code = config['customer_code']
-    region = config['region']
-    install_dependencies()
-    if config.get('delete_resources', True):
-        delete_customer_resources(customer_code, region, config)
-    vpc_resources = create_vpc_with_tgw(config)
-    create_iam_users(config)
-    create_service_accounts(config)
-    create_ec2_instances(config, vpc_resources)
-    setup_postgres(config, vpc_resources)
-    setup_budget(customer_code=config['customer_code'], region=config['region'], account_id=config['account_id'])
-    generate_cloudformation_template(config, vpc_resources)
+    ec2 = get_client('ec2', config['region'])
+    iam = get_client('iam')
+    environments = {env['name']: env for env in config['environments']}
+    subnets = {name: subnet['subnet_id'] for name, subnet in live['subnets'].items()}
+    vpc_resources = {'vpc_id': live['vpc_id'], 'subnets': subnets, 'security_group_id': live['security_group_id']}
+    terminating = {}
+    deleting_databases = []
+    readiness_timeout = config.get('readiness_timeout', READINESS_TIMEOUT)
+
+    if not live['security_group_id'] and any(change['action'] == 'launch' for change in changes):
+        raise RuntimeError(f"Security group {customer_code}-sg is missing, so no instance can be launched; "
+                           f"run a full deploy to recreate the customer")
+
+    def wait_for_deleted_databases():
+        # Their network interfaces hold the subnets until they are gone
+        if deleting_databases:
+            wait_until(config['region'], 'db_instance', deleting_databases, targets=GONE_STATES['db_instance'],
+                       failures=(), timeout=readiness_timeout)
+            deleting_databases.clear()
+
+    for change in changes:
+        action = change['action']
+        log(f"Applying: {describe_change(change)}")
+        try:
+            if action == 'create_customer':
+                run_stages(build_provisioning_stages(config), max_workers=config.get('max_workers', 4))
+            elif action == 'create_subnet':
+                used = {subnet['cidr'] for subnet in live['subnets'].values()}
+                index = next(i for i in range(256) if f"192.168.{i}.0/24" not in used)
+                az_list = metadata_cache.availability_zones(config['region'])
+                subnet = ec2.create_subnet(
+                    VpcId=live['vpc_id'],
+                    CidrBlock=f"192.168.{index}.0/24",
+                    AvailabilityZone=az_list[index % len(az_list)],
+                    TagSpecifications=tag_specifications('subnet', customer_code, environment=change['environment'])
+                )
+                subnet_id = subnet['Subnet']['SubnetId']
+                subnets[change['environment']] = subnet_id
+                live['subnets'][change['environment']] = {'subnet_id': subnet_id, 'cidr': f"192.168.{index}.0/24"}
+                manifest.record(customer_code, 'subnet', subnet_id, environment=change['environment'])
+                log(f"Created Subnet for {change['environment']}: {subnet_id}")
+            elif action == 'revoke_rules':
+                ec2.revoke_security_group_ingress(GroupId=change['security_group_id'], IpPermissions=change['permissions'])
+            elif action == 'authorize_ports':
+                apply_ingress_rules(ec2, change['security_group_id'], config['allowed_ports'])
+            elif action == 'terminate':
+                ec2.terminate_instances(InstanceIds=change['instance_ids'])
+                terminating.setdefault(change['environment'], []).extend(change['instance_ids'])
+            elif action == 'resize':
+                ec2.stop_instances(InstanceIds=change['instance_ids'])
+                wait_until(config['region'], 'instance', change['instance_ids'], targets={'stopped'},
+                           failures={'terminated'}, timeout=readiness_timeout)
+                for instance_id in change['instance_ids']:
+                    ec2.modify_instance_attribute(InstanceId=instance_id, InstanceType={'Value': change['instance_type']})
+                ec2.start_instances(InstanceIds=change['instance_ids'])
+            elif action == 'launch':
+                key_name = ensure_key_pair(ec2, config)
+                node = next(node for node in environments[change['environment']]['nodes']
+                            if node['type'] == change['node_type'])
+                template = ensure_launch_template(ec2, config, node, key_name, live['security_group_id'])
+                tags = build_tags(customer_code, environment=change['environment'], node_type=change['node_type'])
+                launch_instances(ec2, config, template, subnets[change['environment']], tags, change['count'],
+                                 change['environment'], change['node_type'])
+            elif action == 'delete_database':
+                get_client('rds', config['region']).delete_db_instance(
+                    DBInstanceIdentifier=change['db_identifier'], SkipFinalSnapshot=True, DeleteAutomatedBackups=True)
+                deleting_databases.append(change['db_identifier'])
+            elif action == 'update_db_subnet_group':
+                wait_for_deleted_databases()
+                get_client('rds', config['region']).modify_db_subnet_group(
+                    DBSubnetGroupName=change['name'], SubnetIds=change['subnet_ids'])
+            elif action == 'delete_db_subnet_group':
+                wait_for_deleted_databases()
+                get_client('rds', config['region']).delete_db_subnet_group(DBSubnetGroupName=change['name'])
+            elif action == 'delete_subnet':
+                wait_for_deleted_databases()
+                if terminating.get(change['environment']):
+                    wait_until(config['region'], 'instance', terminating[change['environment']],
+                               targets=GONE_STATES['instance'], failures=(), timeout=readiness_timeout)
+                ec2.delete_subnet(SubnetId=change['subnet_id'])
+            elif action == 'create_iam_users':
+                provision_iam({**config, 'environments': [environments[change['environment']]]})
+            elif action == 'delete_iam_user':
+                if delete_iam_user(iam, change['user']):
+                    raise RuntimeError(f"IAM user {change['user']} could not be deleted")
+            elif action == 'create_database':
+                setup_postgres({**config, 'environments': [environments[change['environment']]]}, vpc_resources)
+            elif action == 'create_budget':
+                setup_budget(customer_code=customer_code, region=config['region'], account_id=config['account_id'])
+        except Exception as e:
+            log(f"Failed to apply '{describe_change(change)}': {e}")
+            raise
+
+def run_customer(config, command='deploy', resume=False):
+    """Run deploy, plan or apply for one customer's configuration.
+
+    Returns the stage outputs for deploy and the change set for plan/apply.
+    With resume, deploy continues the customer's checkpointed run instead
+    of tearing down and starting over.  In the cloudformation provisioning
+    mode the customer is one stack: plan previews a change set and
+    deploy/apply create or update the stack in place.
+
+    Every node's image is resolved and checked first (ami_resolver.py), so
+    a bad AMI fails here rather than in the middle of a launch.  The
+    checkpoint fingerprints the configuration as written, so an SSM
+    parameter or name pattern that now resolves to a newer image does not
+    block a resume.
+    """
+    requested = config
+    config = resolve_images(config)
+    if config.get('provisioning_mode', 'api') == 'cloudformation':
+        if command == 'plan':
+            return plan_stack(config)
+        key_name = ensure_key_pair(get_client('ec2', config['region']), config)
+        return deploy_stack(config, key_name)
+
+    if command in ('plan', 'apply'):
+        live = live_state(config)
+        changes = compute_plan(config, desired_state(config), live)
+        print_plan(changes)
+        if command == 'apply' and changes:
+            apply_plan(config, changes, live)
+        return changes
+
+    if resume:
+        checkpoint = resume_checkpoint(requested)
+    else:
+        if config.get('delete_resources', True):
+            delete_customer_resources(config['customer_code'], config['region'], config)
+        checkpoint = start_checkpoint(requested)
+    outputs = run_stages(build_provisioning_stages(config), max_workers=config.get('max_workers', 4),
+                         checkpoint=checkpoint)
+    checkpoint.finish()
+    return outputs
+
+def main():
+    parser = argparse.ArgumentParser(description="Qlik Sense On Premise Rapid Onboarder")
+    parser.add_argument('command', nargs='?', default='deploy', choices=['deploy', 'plan', 'apply'],
+                        help="deploy: (re)build the customer from scratch; plan: show the changes needed to "
+                             "match Config.yaml; apply: make only those changes")
+    parser.add_argument('--config', default='config.yaml', help="Path to the configuration file")
+    parser.add_argument('--trace', help="Write a Chrome/Perfetto trace of every AWS call to this file")
+    parser.add_argument('--mode', choices=['api', 'cloudformation'],
+                        help="Provision through individual API calls or as one CloudFormation stack "
+                             "(default: provisioning_mode in the configuration, else api)")
+    parser.add_argument('--resume', action='store_true',
+                        help="deploy only: continue the last interrupted deploy from its checkpoint")
+    args = parser.parse_args()
+    if args.resume and args.command != 'deploy':
+        parser.error("--resume only applies to deploy")
+
+    config = load_config(args.config)
+    if args.mode:
+        config['provisioning_mode'] = args.mode
+    configure_clients(config)
+    configure_rate_limits(config)
+    metadata_cache.configure_metadata_cache(config)
+
+    if args.command == 'deploy':
+        ensure_dependencies()
+    try:
+        with account_context(config):
+            run_customer(config, args.command, resume=args.resume)
+    finally:
+        log_retry_report()
+        log_call_summary()
+        if args.trace:
+            write_trace(args.trace)
 
 if __name__ == "__main__":
     main()
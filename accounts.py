@@ -0,0 +1,104 @@
+"""
+Cross-account onboarding through STS AssumeRole.
+
+A customer's configuration may name a role in the AWS account the customer
+lives in:
+
+    role_arn: arn:aws:iam::111122223333:role/QlikOnboarding
+    external_id: qro-acme        # optional
+
+account_context(config) assumes that role once per process, registers the
+resulting session with clients.py under the role ARN and makes it the
+default for every get_client() call in the context, including work handed
+to thread pools with logs.carry_context().  Clients, connection pools and
+rate limit buckets are therefore kept per account.
+
+The session is backed by botocore's RefreshableCredentials: the STS
+credentials are cached and refreshed ahead of expiry under botocore's own
+lock, so long runs and concurrent stages never re-authenticate per call
+and never see expired credentials.  Customers without role_arn use the
+ambient credentials.
+"""
+import threading
+import contextlib
+
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+
+from clients import DEFAULT_CREDENTIALS, get_client, register_session, use_credentials
+from logs import log
+
+ROLE_SESSION_NAME = "qlik-rapid-onboarder"
+ROLE_SESSION_DURATION = 3600  # Seconds; botocore refreshes well before this runs out
+
+_lock = threading.Lock()
+_role_locks = {}
+_assumed = set()
+
+def role_account_id(role_arn):
+    """Return the account ID from a role ARN."""
+    return role_arn.split(':')[4]
+
+def target_account_id(config):
+    """Return the AWS account a customer is onboarded into."""
+    if config.get('role_arn'):
+        return role_account_id(config['role_arn'])
+    return config.get('account_id')
+
+def _credential_refresher(role_arn, external_id, duration):
+    def refresh():
+        sts = get_client('sts', credentials=DEFAULT_CREDENTIALS)  # Always assume from the base credentials
+        params = {
+            'RoleArn': role_arn,
+            'RoleSessionName': ROLE_SESSION_NAME,
+            'DurationSeconds': duration,
+        }
+        if external_id:
+            params['ExternalId'] = external_id
+        credentials = sts.assume_role(**params)['Credentials']
+        log(f"Assumed role {role_arn} until {credentials['Expiration']}")
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+    return refresh
+
+def assume_role_session(role_arn, external_id=None, duration=ROLE_SESSION_DURATION):
+    """Return a boto3 session whose credentials come from (and are refreshed through) AssumeRole."""
+    refresh = _credential_refresher(role_arn, external_id, duration)
+    credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(),
+        refresh_using=refresh,
+        method='sts-assume-role'
+    )
+    session = botocore.session.get_session()
+    session._credentials = credentials
+    return boto3.session.Session(botocore_session=session)
+
+def ensure_role_session(role_arn, external_id=None):
+    """Assume a role once per process and register its session; returns the credentials label."""
+    with _lock:
+        role_lock = _role_locks.setdefault(role_arn, threading.Lock())
+    with role_lock:  # Different accounts are assumed in parallel, each role only once
+        if role_arn not in _assumed:
+            register_session(role_arn, assume_role_session(role_arn, external_id))
+            _assumed.add(role_arn)
+    return role_arn
+
+@contextlib.contextmanager
+def account_context(config):
+    """Run the enclosed block with clients for the customer's target account."""
+    role_arn = config.get('role_arn')
+    if not role_arn:
+        yield DEFAULT_CREDENTIALS
+        return
+
+    account_id = role_account_id(role_arn)
+    if config.get('account_id') and str(config['account_id']) != account_id:
+        raise ValueError(f"account_id {config['account_id']} does not match role_arn account {account_id}")
+    config['account_id'] = account_id
+    with use_credentials(ensure_role_session(role_arn, config.get('external_id'))) as credentials:
+        yield credentials
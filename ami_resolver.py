@@ -0,0 +1,169 @@
+"""
+Resolution and preflight check of the AMIs the nodes launch from.
+
+A node's image is its own ami_id or, without one, the entry for its node
+type in the images section of Config.yaml.  An image reference can be
+
+    ami-0848083dfcac1b527                                           an image ID
+    /aws/service/ami-windows-latest/Windows_Server-2022-English-Full-Base
+                                                                    an SSM public parameter
+    Windows_Server-2022-English-Full-Base-*                         a name pattern; the newest match wins
+
+and an images entry may also map regions to references.  resolve_images()
+resolves all of a customer's references with at most one SSM call, one
+describe_images call per kind of reference and one describe_instance_types
+call, then checks that every image exists, is available and has the
+architecture of the instance types launched from it.  All problems are
+raised together before anything is created:
+
+    config = resolve_images(config)  # A copy with every node's ami_id set to an image ID
+
+Results are kept per account and region in the metadata cache
+(metadata_cache.py), so other customers and later runs in the region do
+not look them up again.
+"""
+import copy
+import fnmatch
+
+import metadata_cache
+from clients import get_client
+from listing import iter_resources
+from logs import log
+
+SSM_PREFIX = "resolve:ssm:"  # Optional, as in CloudFormation
+SSM_BATCH_SIZE = 10  # Most names get_parameters accepts
+DEFAULT_IMAGE_OWNERS = ['self', 'amazon']
+
+def image_reference(config, node, region=None):
+    """Return the configured image reference of a node, or None."""
+    reference = node.get('ami_id') or (config.get('images') or {}).get(node['type'])
+    if isinstance(reference, dict):  # Keyed by region
+        reference = reference.get(region or config['region'])
+    return reference
+
+def reference_kind(reference):
+    if reference.startswith('ami-'):
+        return 'id'
+    if reference.startswith('/') or reference.startswith(SSM_PREFIX):
+        return 'ssm'
+    return 'name'
+
+def _summary(image):
+    return {'ImageId': image['ImageId'], 'Name': image.get('Name'), 'Architecture': image.get('Architecture'),
+            'State': image.get('State')}
+
+def _resolve_parameters(region, references):
+    """Return {reference: image ID} for SSM parameter references."""
+    ssm = get_client('ssm', region)
+    names = {reference[len(SSM_PREFIX):] if reference.startswith(SSM_PREFIX) else reference: reference
+             for reference in references}
+    resolved = {}
+    batch = list(names)
+    for start in range(0, len(batch), SSM_BATCH_SIZE):
+        for parameter in ssm.get_parameters(Names=batch[start:start + SSM_BATCH_SIZE])['Parameters']:
+            resolved[names[parameter['Name']]] = parameter['Value']
+    return resolved
+
+def _describe_ids(region, image_ids):
+    """Return {image ID: summary}; IDs that do not exist are left out."""
+    ec2 = get_client('ec2', region)
+    # The image-id filter, unlike ImageIds, does not fail the whole call on one unknown ID
+    return {image['ImageId']: _summary(image) for image in iter_resources(
+        ec2, 'describe_images', 'Images', Filters=[{'Name': 'image-id', 'Values': sorted(image_ids)}])}
+
+def _describe_names(region, patterns, owners):
+    """Return {pattern: summary of the newest matching image}."""
+    ec2 = get_client('ec2', region)
+    newest = {}
+    for image in iter_resources(ec2, 'describe_images', 'Images', Owners=owners,
+                                Filters=[{'Name': 'name', 'Values': sorted(patterns)},
+                                         {'Name': 'state', 'Values': ['available']}]):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(image.get('Name', ''), pattern):
+                if pattern not in newest or image['CreationDate'] > newest[pattern]['CreationDate']:
+                    newest[pattern] = image
+    return {pattern: _summary(image) for pattern, image in newest.items()}
+
+def _instance_architectures(region, instance_types):
+    """Return {instance type: supported architectures}, from the cache where possible."""
+    architectures = {}
+    missing = []
+    for instance_type in instance_types:
+        cached = metadata_cache.cached_value('instance_type', region, instance_type)
+        if cached is None:
+            missing.append(instance_type)
+        else:
+            architectures[instance_type] = cached
+    if missing:
+        ec2 = get_client('ec2', region)
+        for info in iter_resources(ec2, 'describe_instance_types', 'InstanceTypes',
+                                   Filters=[{'Name': 'instance-type', 'Values': sorted(missing)}]):
+            supported = info.get('ProcessorInfo', {}).get('SupportedArchitectures', [])
+            architectures[info['InstanceType']] = supported
+            metadata_cache.store('instance_type', region, info['InstanceType'], supported)
+    return architectures
+
+def lookup_images(region, references, owners=DEFAULT_IMAGE_OWNERS):
+    """Return {reference: image summary} for the references that resolve to an image."""
+    images = {}
+    missing = {'id': set(), 'ssm': set(), 'name': set()}
+    for reference in set(references):
+        cached = metadata_cache.cached_value('image', region, reference)
+        if cached is None:
+            missing[reference_kind(reference)].add(reference)
+        else:
+            images[reference] = cached
+
+    if missing['name']:
+        images.update(_describe_names(region, missing['name'], owners))
+    parameters = _resolve_parameters(region, missing['ssm']) if missing['ssm'] else {}
+    image_ids = missing['id'] | set(parameters.values())
+    if image_ids:
+        described = _describe_ids(region, image_ids)
+        images.update({image_id: described[image_id] for image_id in missing['id'] if image_id in described})
+        images.update({reference: described[image_id] for reference, image_id in parameters.items()
+                       if image_id in described})
+
+    for reference in set().union(*missing.values()):
+        if reference in images:
+            if images[reference]['State'] == 'available':
+                metadata_cache.store('image', region, reference, images[reference])
+            if reference_kind(reference) != 'id':
+                log(f"Resolved image {reference} to {images[reference]['ImageId']} in {region}")
+    return images
+
+def resolve_images(config):
+    """Return a copy of the configuration with every node's ami_id resolved and checked.
+
+    Raises ValueError listing every node whose image is missing, not
+    available or built for another architecture than its instance type.
+    """
+    region = config['region']
+    resolved = copy.deepcopy(config)
+    nodes = [(env, node) for env in resolved['environments'] for node in env['nodes']]
+    references = {image_reference(config, node) for _, node in nodes} - {None}
+    images = lookup_images(region, references, config.get('image_owners', DEFAULT_IMAGE_OWNERS))
+    architectures = _instance_architectures(region, {node['instance_type'] for _, node in nodes
+                                                     if node.get('instance_type')})
+
+    problems = []
+    for env, node in nodes:
+        where = f"{node['type']} in {env['name']}"
+        reference = image_reference(config, node)
+        image = images.get(reference)
+        if not reference:
+            problems.append(f"{where}: no ami_id and no '{node['type']}' entry in images for {region}")
+        elif not image:
+            problems.append(f"{where}: image {reference} not found in {region}")
+        elif image['State'] != 'available':
+            problems.append(f"{where}: image {image['ImageId']} is {image['State']}")
+        elif node.get('instance_type') not in architectures:
+            problems.append(f"{where}: unknown instance type {node.get('instance_type')} in {region}")
+        elif image['Architecture'] not in architectures[node['instance_type']]:
+            problems.append(f"{where}: image {image['ImageId']} is {image['Architecture']} but "
+                            f"{node['instance_type']} supports {', '.join(architectures[node['instance_type']])}")
+        else:
+            node['ami_id'] = image['ImageId']
+    if problems:
+        raise ValueError("AMI preflight failed:\n  " + "\n  ".join(problems))
+    return resolved
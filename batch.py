@@ -0,0 +1,196 @@
+"""
+Batch onboarding: run many customers' configurations in one process.
+
+    python batch.py customers/                      # every *.yaml / *.yml in the directory
+    python batch.py acme.yaml globex.yaml --command plan
+    python batch.py customers/ --workers 20 --per-region 8 --per-account 10
+    python batch.py customers/ --resume            # continue deploys that failed part-way
+
+Each configuration is a complete Config.yaml for one customer.  Customers
+run concurrently on a thread pool and share the pooled AWS clients and the
+per-API-family rate limiter, so the whole wave stays inside each account's
+request budget.  Customers with a role_arn run in that account
+(accounts.py).  --per-region and --per-account cap how many customers
+provision at once against one region or one account.
+
+Every customer runs in its own logging context (logs/<customer>.log) and a
+failure is recorded in the summary instead of stopping the other
+customers.  Client and rate limit settings are process-wide and are taken
+from the first configuration.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from accounts import account_context, target_account_id
+from clients import configure_clients
+from dependencies import ensure_dependencies
+from instrumentation import log_call_summary, write_trace
+from logs import customer_log, log
+from Main import load_config, run_customer, validate_config
+from metadata_cache import configure_metadata_cache
+from retry import configure_rate_limits, log_retry_report
+
+DEFAULT_WORKERS = 10
+DEFAULT_PER_REGION = 5
+DEFAULT_PER_ACCOUNT = 10
+
+def collect_configs(paths):
+    """Load every customer configuration named by paths (files or directories)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(('.yaml', '.yml')))
+        else:
+            files.append(path)
+
+    configs = []
+    seen = {}
+    for file in files:
+        config = load_config(file)
+        customer_code = config['customer_code']
+        if customer_code in seen:
+            raise ValueError(f"Customer {customer_code} is configured in both {seen[customer_code]} and {file}")
+        seen[customer_code] = file
+        # Customers must not overwrite each other's output files
+        config.setdefault('cloudformation_template_path', f"{customer_code}_cloudformation_template.json")
+        configs.append(config)
+    return configs
+
+class ConcurrencyCaps:
+    """Bound how many customers run at once per account and per region."""
+
+    def __init__(self, per_region, per_account):
+        self.per_region = per_region
+        self.per_account = per_account
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, scope, key, limit):
+        with self._lock:
+            if (scope, key) not in self._semaphores:
+                self._semaphores[(scope, key)] = threading.BoundedSemaphore(limit)
+            return self._semaphores[(scope, key)]
+
+    @contextlib.contextmanager
+    def slot(self, account_id, region):
+        # Always account first, then region, so two customers can never wait on each other
+        account = self._semaphore('account', account_id, self.per_account)
+        region_slot = self._semaphore('region', region, self.per_region)
+        with account, region_slot:
+            yield
+
+def onboard_customer(config, command, caps, resume=False):
+    """Run one customer under the concurrency caps and return its summary row."""
+    customer_code = config['customer_code']
+    result = {
+        'customer_code': customer_code,
+        'account_id': target_account_id(config),
+        'region': config['region'],
+        'status': 'failed',
+        'queued_seconds': 0.0,
+        'seconds': 0.0,
+        'error': None,
+    }
+    queued = time.monotonic()
+    with caps.slot(result['account_id'], config['region']):
+        started = time.monotonic()
+        result['queued_seconds'] = round(started - queued, 1)
+        with customer_log(customer_code):
+            log(f"Starting {command} for customer {customer_code}")
+            try:
+                validate_config(config)
+                with account_context(config):
+                    run_customer(config, command, resume=resume)
+                result['status'] = 'succeeded'
+                log(f"Finished {command} for customer {customer_code}")
+            except Exception as e:
+                result['error'] = str(e)
+                log(f"{command} failed for customer {customer_code}: {e}")
+            result['seconds'] = round(time.monotonic() - started, 1)
+    return result
+
+def run_batch(configs, command='deploy', workers=DEFAULT_WORKERS,
+              per_region=DEFAULT_PER_REGION, per_account=DEFAULT_PER_ACCOUNT, resume=False):
+    """Onboard every configuration concurrently and return one summary row per customer."""
+    caps = ConcurrencyCaps(per_region, per_account)
+    results = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="customer") as pool:
+        futures = {pool.submit(onboard_customer, config, command, caps, resume): config['customer_code'] for config in configs}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:  # Only reachable if the summary bookkeeping itself fails
+                results.append({'customer_code': futures[future], 'status': 'failed', 'error': str(e)})
+    return sorted(results, key=lambda result: result['customer_code'])
+
+def log_summary(results, elapsed):
+    """Log one line per customer and the batch totals."""
+    log(f"{'Customer':<16} {'Account':<14} {'Region':<14} {'Status':<10} {'Queued':>8} {'Time':>8}  Error")
+    for r in results:
+        log(f"{r['customer_code']:<16} {str(r.get('account_id')):<14} {str(r.get('region')):<14} "
+            f"{r['status']:<10} {r.get('queued_seconds', 0):>7}s {r.get('seconds', 0):>7}s  {r.get('error') or ''}")
+    failed = [r['customer_code'] for r in results if r['status'] != 'succeeded']
+    log(f"Batch finished in {elapsed:.0f}s: {len(results) - len(failed)} succeeded, {len(failed)} failed"
+        + (f" ({', '.join(failed)})" if failed else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Onboard many customers concurrently")
+    parser.add_argument('paths', nargs='+', help="Customer configuration files or directories of them")
+    parser.add_argument('--command', default='deploy', choices=['deploy', 'plan', 'apply'])
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Customers in flight at once")
+    parser.add_argument('--per-region', type=int, default=DEFAULT_PER_REGION,
+                        help="Customers in flight at once in one region")
+    parser.add_argument('--per-account', type=int, default=DEFAULT_PER_ACCOUNT,
+                        help="Customers in flight at once in one AWS account")
+    parser.add_argument('--summary', default='batch_summary.json', help="Where to write the JSON summary")
+    parser.add_argument('--trace', help="Write a Chrome/Perfetto trace of every AWS call to this file")
+    parser.add_argument('--resume', action='store_true',
+                        help="deploy only: continue each customer's last deploy from its checkpoint")
+    args = parser.parse_args()
+    if args.resume and args.command != 'deploy':
+        parser.error("--resume only applies to deploy")
+
+    configs = collect_configs(args.paths)
+    if not configs:
+        log("No customer configurations found.")
+        return
+    configure_clients(configs[0])
+    configure_rate_limits(configs[0])
+    configure_metadata_cache(configs[0])
+    if args.command == 'deploy':
+        ensure_dependencies()
+
+    log(f"Running {args.command} for {len(configs)} customer(s) with {args.workers} worker(s)")
+    started = time.monotonic()
+    try:
+        results = run_batch(configs, args.command, args.workers, args.per_region, args.per_account, args.resume)
+    finally:
+        log_retry_report()
+        log_call_summary()
+        if args.trace:
+            write_trace(args.trace)
+    elapsed = time.monotonic() - started
+    log_summary(results, elapsed)
+
+    with open(args.summary, 'w') as file:
+        json.dump({
+            'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+            'command': args.command,
+            'seconds': round(elapsed, 1),
+            'customers': results,
+        }, file, indent=2)
+    log(f"Summary written to {args.summary}")
+
+    if any(r['status'] != 'succeeded' for r in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+Offline benchmark of provisioning and teardown against moto.
+
+Runs the full deploy (Main.run_customer) and delete_customer_resources()
+end to end against moto's in-process AWS stand-in, over a grid of
+environments x nodes per environment x allowed ports, and reports for each
+scenario the wall time of both phases, API calls per operation, HTTP
+attempts, injected throttles and the provisioning critical path.  It also
+times a fresh interpreter importing Main.py and Delete.py and running the
+dependency check, cold (no cached check) and warm, so startup regressions
+show up next to provisioning ones.
+
+    python benchmark.py
+    python benchmark.py --environments 1 4 --nodes 2 8 --ports 10 60
+    python benchmark.py --latency 0.05 --latency-op RunInstances=0.4 --throttle-rate 0.05
+    python benchmark.py --output results.json --compare baseline.json
+
+Latency and throttling are injected with botocore before-send hooks on
+every client, so the rate limiter and retry layer (retry.py) see exactly
+what they would see from AWS.  Results are written as JSON together with
+the git commit; --compare fails (exit code 1) when a scenario needs more
+API calls than the baseline or its wall time regressed beyond
+--max-slowdown, so call-count and parallelism regressions are caught
+before they reach a real account.
+
+Requires moto (pip install "moto[ec2,iam,rds,sts,budgets,resourcegroupstaggingapi]").
+moto keeps network interfaces of terminated instances attached, so each
+teardown ends with the network interface wave timing out after
+--wave-timeout seconds; keep it short and compare like with like.  moto
+is not fully thread-safe either, so a rare internal KeyError logged by a
+parallel delete is an artifact of the stand-in.  moto also launches only
+MinCount instances, so run_instances is sent with MinCount raised to
+MaxCount to launch every requested node, as AWS does when it has capacity.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import itertools
+import subprocess
+import tempfile
+import threading
+
+import yaml
+import boto3
+from botocore.awsrequest import AWSResponse
+
+import clients
+import instrumentation
+import metadata_cache
+import retry
+from logs import log
+from scheduler import clear_stage_history, critical_path, stage_history
+
+REGION = "us-east-1"
+ACCOUNT_ID = "123456789012"
+BENCHMARK_AMI = "ami-12c6146b"  # Present in moto's default image list
+STARTUP_RUNS = 3
+
+# Run in a fresh interpreter: everything a user waits for before the first AWS call
+STARTUP_SCRIPT = """
+import sys, json, time
+started = time.perf_counter()
+import Main, Delete
+imported = time.perf_counter()
+from dependencies import ensure_dependencies
+ensure_dependencies()
+with open(sys.argv[1], 'w') as file:
+    json.dump({'import_seconds': imported - started, 'dependency_seconds': time.perf_counter() - imported}, file)
+"""
+
+class _Body:
+    """Minimal raw HTTP body for a synthetic botocore response."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+def _throttle_response(request):
+    """Build the throttling error each AWS protocol returns, for the request's protocol."""
+    content_type = request.headers.get('Content-Type', b'')
+    content_type = content_type.decode() if isinstance(content_type, bytes) else content_type
+    if 'json' in content_type:
+        body = b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'
+    elif '//ec2.' in request.url:
+        body = (b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                b'<Message>Request limit exceeded.</Message></Error></Errors></Response>')
+    else:
+        body = (b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+                b'<Message>Rate exceeded</Message></Error></ErrorResponse>')
+    return AWSResponse(request.url, 400, {}, _Body(body))
+
+def _full_capacity(params, **kwargs):
+    # moto launches only MinCount instances where AWS launches up to MaxCount when it has the capacity
+    params['MinCount'] = params.get('MaxCount', params.get('MinCount', 1))
+
+class FaultInjector:
+    """Count API calls and inject latency and throttling on every client of a session."""
+
+    def __init__(self, latency=0.0, latency_by_operation=None, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.latency_by_operation = latency_by_operation or {}
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.attempts = 0
+        self.throttled = 0
+
+    def install(self, session):
+        session.events.register('before-call', self._before_call)
+        session.events.register('before-parameter-build.ec2.RunInstances', _full_capacity)
+        session.events.register_first('before-send', self._before_send)  # Ahead of moto's responder
+
+    def _before_call(self, model, **kwargs):
+        key = f"{model.service_model.service_name}:{model.name}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def _before_send(self, request, event_name, **kwargs):
+        operation = event_name.rsplit('.', 1)[-1]
+        delay = self.latency_by_operation.get(operation, self.latency)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.attempts += 1
+            throttle = self.throttle_rate and self.random.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        return _throttle_response(request) if throttle else None
+
+    def snapshot(self):
+        with self.lock:
+            return {'calls': dict(sorted(self.calls.items())), 'total_calls': sum(self.calls.values()),
+                    'attempts': self.attempts, 'throttled': self.throttled}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.attempts = 0
+            self.throttled = 0
+
+def scenario_config(base, customer_code, environments, nodes, ports, transit_gateway_id, use_rds):
+    """Build a customer configuration of the requested size from the base Config.yaml."""
+    config = dict(base)
+    config.update({
+        'customer_code': customer_code,
+        'region': REGION,
+        'account_id': ACCOUNT_ID,
+        'transit_gateway_id': transit_gateway_id,
+        'use_aws_rds': use_rds,
+        'delete_resources': False,
+        'cloudformation_template_path': f"{customer_code}_cloudformation_template.json",
+        # Spaced out so every port stays its own ingress range
+        'allowed_ports': [4000 + 2 * i for i in range(ports)],
+        'environments': [
+            {
+                'name': f"env{i + 1}",
+                'code': f"{i + 1:02d}",
+                'nodes': [
+                    {'type': 'central', 'instance_type': 't3.micro', 'ami_id': BENCHMARK_AMI, 'count': 1},
+                    {'type': 'worker', 'instance_type': 't3.micro', 'ami_id': BENCHMARK_AMI, 'count': nodes - 1},
+                ] if nodes > 1 else [
+                    {'type': 'central', 'instance_type': 't3.micro', 'ami_id': BENCHMARK_AMI, 'count': 1},
+                ],
+            }
+            for i in range(environments)
+        ],
+    })
+    return config
+
+def run_scenario(base, environments, nodes, ports, injector, use_rds, wave_timeout):
+    """Deploy and tear down one customer of the given size; returns the scenario's metrics."""
+    from moto import mock_aws
+    from Main import run_customer
+    from teardown import delete_customer_resources
+
+    customer_code = f"BENCH{environments}x{nodes}x{ports}"
+    with mock_aws():
+        session = boto3.session.Session(region_name=REGION)
+        injector.install(session)
+        clients.reset_clients()
+        clients.register_session(clients.DEFAULT_CREDENTIALS, session)
+        metadata_cache.invalidate()  # Every scenario starts from an empty moto account
+        retry.reset_counters()
+        clear_stage_history()
+
+        transit_gateway_id = session.client('ec2').create_transit_gateway()['TransitGateway']['TransitGatewayId']
+        config = scenario_config(base, customer_code, environments, nodes, ports, transit_gateway_id, use_rds)
+        config['teardown_wave_timeout'] = wave_timeout
+        injector.reset()
+
+        started = time.monotonic()
+        deploy_error = None
+        try:
+            run_customer(config, 'deploy')
+        except Exception as e:
+            deploy_error = str(e)
+        deploy_seconds = time.monotonic() - started
+        deploy_calls = injector.snapshot()
+        path = critical_path(stage_history())
+
+        injector.reset()
+        started = time.monotonic()
+        leftovers = delete_customer_resources(customer_code, REGION, config)
+        teardown_seconds = time.monotonic() - started
+        teardown_calls = injector.snapshot()
+
+        clients.reset_clients()
+
+    return {
+        'scenario': {'environments': environments, 'nodes': nodes, 'ports': ports},
+        'deploy': {
+            'seconds': round(deploy_seconds, 2),
+            'error': deploy_error,
+            'critical_path': [{'stage': e['name'], 'seconds': round(e['seconds'], 2)} for e in path],
+            'stages': {e['name']: round(e['seconds'], 2) for e in stage_history()},
+            **deploy_calls,
+        },
+        'teardown': {
+            'seconds': round(teardown_seconds, 2),
+            'leftovers': leftovers,
+            **teardown_calls,
+        },
+        'retry': retry.retry_counters(),
+    }
+
+def _startup_run(result_path):
+    repository = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repository, os.environ.get('PYTHONPATH')])))
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, result_path], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - started
+    with open(result_path, 'r') as file:
+        run = json.load(file)
+    return {'seconds': seconds, **run}
+
+def measure_startup(runs=STARTUP_RUNS):
+    """Time process startup to the first AWS call: once cold, then the best of runs warm."""
+    from dependencies import CACHE_FILE
+    if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
+    result_path = os.path.abspath('startup.json')
+    cold = _startup_run(result_path)
+    warm = min((_startup_run(result_path) for _ in range(runs)), key=lambda run: run['seconds'])
+    return {'cold': cold, 'warm': warm}
+
+def log_startup(startup):
+    for label in ('cold', 'warm'):
+        run = startup[label]
+        log(f"Startup ({label}): {run['seconds']:.2f}s total, {run['import_seconds']:.2f}s importing, "
+            f"{run['dependency_seconds']:.3f}s checking dependencies")
+
+def scenario_key(result):
+    s = result['scenario']
+    return f"{s['environments']}env x {s['nodes']}nodes x {s['ports']}ports"
+
+def log_results(results):
+    log(f"{'Scenario':<28} {'Deploy':>8} {'Calls':>6} {'Teardown':>9} {'Calls':>6} {'Throttled':>9}  Critical path")
+    for r in results:
+        path = " -> ".join(f"{e['stage']}({e['seconds']:.1f}s)" for e in r['deploy']['critical_path'])
+        log(f"{scenario_key(r):<28} {r['deploy']['seconds']:>7.1f}s {r['deploy']['total_calls']:>6} "
+            f"{r['teardown']['seconds']:>8.1f}s {r['teardown']['total_calls']:>6} "
+            f"{r['deploy']['throttled'] + r['teardown']['throttled']:>9}  {path}")
+        if r['deploy']['error']:
+            log(f"  deploy error: {r['deploy']['error']}")
+
+def compare(results, baseline, max_slowdown):
+    """Log differences against a baseline run; returns the list of regressions."""
+    previous = {scenario_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        key = scenario_key(r)
+        if key not in previous:
+            continue
+        for phase in ('deploy', 'teardown'):
+            old, new = previous[key][phase], r[phase]
+            log(f"{key} {phase}: {old['seconds']:.1f}s -> {new['seconds']:.1f}s, "
+                f"{old['total_calls']} -> {new['total_calls']} calls")
+            if new['total_calls'] > old['total_calls']:
+                grown = {op: n for op, n in new['calls'].items() if n > old['calls'].get(op, 0)}
+                regressions.append(f"{key} {phase}: API calls {old['total_calls']} -> {new['total_calls']} {grown}")
+            if old['seconds'] and new['seconds'] > old['seconds'] * (1 + max_slowdown):
+                regressions.append(f"{key} {phase}: wall time {old['seconds']:.1f}s -> {new['seconds']:.1f}s")
+    return regressions
+
+def compare_startup(startup, baseline, max_slowdown):
+    """Compare warm startup with a baseline run; returns the list of regressions."""
+    old = (baseline.get('startup') or {}).get('warm')
+    if not old or not startup:
+        return []
+    new = startup['warm']
+    log(f"startup: {old['seconds']:.2f}s -> {new['seconds']:.2f}s")
+    if new['seconds'] > old['seconds'] * (1 + max_slowdown):
+        return [f"startup: {old['seconds']:.2f}s -> {new['seconds']:.2f}s"]
+    return []
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def _operation_latency(value):
+    operation, _, seconds = value.partition('=')
+    return operation, float(seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark provisioning and teardown against moto")
+    parser.add_argument('--environments', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[2, 6], help="Instances per environment")
+    parser.add_argument('--ports', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every API request")
+    parser.add_argument('--latency-op', type=_operation_latency, action='append', default=[],
+                        metavar='OPERATION=SECONDS', help="Per-operation latency, e.g. RunInstances=0.5")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests throttled")
+    parser.add_argument('--no-rds', action='store_true', help="Benchmark without RDS instances")
+    parser.add_argument('--wave-timeout', type=float, default=2, help="Teardown wave timeout (see module notes)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Config.yaml'),
+                        help="Base configuration (rate limits, workers, credentials for RDS)")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="Baseline results JSON to compare against")
+    parser.add_argument('--trace-dir', help="Write a Chrome/Perfetto trace per scenario into this directory")
+    parser.add_argument('--no-startup', action='store_true', help="Skip the startup measurement")
+    parser.add_argument('--max-slowdown', type=float, default=0.25, help="Allowed wall time regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    try:
+        import moto  # noqa: F401
+    except ImportError:
+        sys.exit("benchmark.py needs moto: pip install \"moto[ec2,iam,rds,sts,budgets,resourcegroupstaggingapi]\"")
+
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        os.environ[name] = 'benchmark'  # Never let a benchmark reach a real account
+    os.environ['AWS_DEFAULT_REGION'] = REGION
+    os.environ['MOTO_IAM_LOAD_MANAGED_POLICIES'] = 'true'  # The IAM groups attach AWS managed policies
+
+    with open(args.config, 'r') as file:
+        base = yaml.safe_load(file)
+    clients.configure_clients(base)
+    retry.configure_rate_limits(base)
+    metadata_cache.configure_metadata_cache(base)
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+
+    startup = None
+    injector = FaultInjector(args.latency, dict(args.latency_op), args.throttle_rate, args.seed)
+    results = []
+    trace_dir = os.path.abspath(args.trace_dir) if args.trace_dir else None
+    if trace_dir:
+        os.makedirs(trace_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="qro-benchmark-")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Manifests, key files and templates stay out of the repository
+    try:
+        if not args.no_startup:
+            startup = measure_startup()
+        for environments, nodes, ports in itertools.product(args.environments, args.nodes, args.ports):
+            log(f"Benchmark: {environments} environment(s) x {nodes} node(s) x {ports} port(s)")
+            instrumentation.reset()
+            results.append(run_scenario(base, environments, nodes, ports, injector,
+                                        not args.no_rds, args.wave_timeout))
+            if trace_dir:
+                instrumentation.write_trace(os.path.join(trace_dir, f"{scenario_key(results[-1]).replace(' ', '')}.json"))
+    finally:
+        os.chdir(cwd)
+
+    log_results(results)
+    if startup:
+        log_startup(startup)
+    with open(output, 'w') as file:
+        json.dump({
+            'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'settings': {'latency': args.latency, 'latency_by_operation': dict(args.latency_op),
+                         'throttle_rate': args.throttle_rate, 'rds': not args.no_rds,
+                         'wave_timeout': args.wave_timeout, 'seed': args.seed},
+            'startup': startup,
+            'results': results,
+        }, file, indent=2)
+    log(f"Results written to {output}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.max_slowdown) + compare_startup(startup, baseline, args.max_slowdown)
+        for regression in regressions:
+            log(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Checkpoint journal for resumable provisioning, one JSON-lines file per customer.
+
+A deploy starts a fresh journal and the scheduler appends each stage's
+output the moment the stage completes (the VPC resources, launched
+instance IDs, database identifiers, ...).  If the run dies,
+
+    python Main.py deploy --resume
+
+skips the up-front teardown, feeds the journaled outputs to the stages
+that depend on them and runs only the stages that had not completed, so
+the slow steps (RDS, the TGW attachment) are not redone.  A stage that was
+interrupted half-way runs again from its start; anything it had already
+created is in the deployment manifest, so a later teardown still finds it.
+
+The journal records a fingerprint of the configuration and refuses to
+resume under a different one; use plan/apply to reconcile a changed
+configuration instead.  Teardown removes the journal.
+
+    {"time": "...", "event": "run_started", "config": "<sha256>"}
+    {"time": "...", "event": "stage_completed", "stage": "vpc", "output": {...}}
+    {"time": "...", "event": "run_completed"}
+"""
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+from logs import log
+
+CHECKPOINT_DIR = "checkpoints"
+
+_lock = threading.Lock()
+
+def checkpoint_path(customer_code):
+    return os.path.join(CHECKPOINT_DIR, f"{customer_code}.jsonl")
+
+def config_fingerprint(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+class Checkpoint:
+    """The journal of one customer's deploy; pass it to run_stages()."""
+
+    def __init__(self, customer_code, completed=None):
+        self.customer_code = customer_code
+        self.completed = dict(completed or {})  # Stage name -> output of the stages already done
+
+    def _append(self, entry):
+        entry = {"time": datetime.datetime.now().isoformat(timespec="seconds"), **entry}
+        line = json.dumps(entry, default=str) + "\n"
+        with _lock:
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            with open(checkpoint_path(self.customer_code), "a") as file:
+                file.write(line)
+                file.flush()
+
+    def record(self, stage, output):
+        """Journal a completed stage and its output."""
+        self.completed[stage] = output
+        self._append({"event": "stage_completed", "stage": stage, "output": output})
+
+    def finish(self):
+        self._append({"event": "run_completed"})
+
+def start_checkpoint(config):
+    """Start a new, empty journal for the customer, replacing any previous one."""
+    customer_code = config['customer_code']
+    with _lock:
+        if os.path.exists(checkpoint_path(customer_code)):
+            os.remove(checkpoint_path(customer_code))
+    checkpoint = Checkpoint(customer_code)
+    checkpoint._append({"event": "run_started", "config": config_fingerprint(config)})
+    return checkpoint
+
+def resume_checkpoint(config):
+    """Load the customer's journal to continue an interrupted deploy."""
+    customer_code = config['customer_code']
+    path = checkpoint_path(customer_code)
+    if not os.path.exists(path):
+        raise ValueError(f"No checkpoint for customer {customer_code} to resume; run a full deploy")
+
+    fingerprint, completed, finished = None, {}, False
+    with _lock, open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash mid-write
+            if entry.get("event") == "run_started":
+                fingerprint = entry.get("config")
+            elif entry.get("event") == "stage_completed":
+                completed[entry["stage"]] = entry.get("output")
+            elif entry.get("event") == "run_completed":
+                finished = True
+
+    if fingerprint != config_fingerprint(config):
+        raise ValueError(f"The configuration of customer {customer_code} changed since the checkpointed run; "
+                         f"use plan/apply to reconcile it")
+    if finished:
+        log(f"The checkpointed deploy of customer {customer_code} already completed")
+    else:
+        log(f"Resuming deploy of customer {customer_code}: {len(completed)} stage(s) already completed")
+    return Checkpoint(customer_code, completed)
+
+def clear_checkpoint(customer_code):
+    """Forget the customer's journal (its resources were torn down)."""
+    with _lock:
+        if os.path.exists(checkpoint_path(customer_code)):
+            os.remove(checkpoint_path(customer_code))
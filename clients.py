@@ -0,0 +1,98 @@
+"""
+Shared, thread-safe registry of boto3 clients.
+
+Every stage asks get_client() for its clients instead of calling
+boto3.client() itself, so each (service, region, credentials) combination
+is built once per run and its HTTP connection pool and TLS sessions are
+reused by every stage and worker thread.  Each client gets the shared
+rate limiter and retry handlers from retry.py and the per-call
+instrumentation from instrumentation.py.  boto3 clients are
+thread-safe; sessions are not, so client construction is serialized here.
+
+Clients for other AWS accounts are built from sessions registered under a
+credentials label (see accounts.py).  use_credentials() makes a label the
+default for get_client() in the current context, so code that runs for a
+customer in another account picks up that account's clients unchanged.
+"""
+import threading
+import contextlib
+import contextvars
+
+import boto3
+from botocore.config import Config
+
+import instrumentation
+import retry
+
+DEFAULT_CREDENTIALS = "default"
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+_lock = threading.Lock()
+_clients = {}
+_sessions = {}
+_max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+_credentials = contextvars.ContextVar('credentials', default=DEFAULT_CREDENTIALS)
+
+def configure_clients(config):
+    """Apply client settings from Config.yaml. Call before the first get_client()."""
+    global _max_pool_connections
+    with _lock:
+        _max_pool_connections = int(config.get('max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS))
+
+def register_session(credentials, session):
+    """Register a boto3 session under a credentials label (e.g. an assumed role ARN)."""
+    with _lock:
+        _sessions[credentials] = session
+        for key in [key for key in _clients if key[2] == credentials]:
+            del _clients[key]  # Rebuild clients from the new session on next use
+
+def get_session(credentials=DEFAULT_CREDENTIALS):
+    with _lock:
+        return _get_session(credentials)
+
+def _get_session(credentials):
+    if credentials not in _sessions:
+        if credentials != DEFAULT_CREDENTIALS:
+            raise KeyError(f"No session registered for credentials '{credentials}'")
+        _sessions[credentials] = boto3.session.Session()
+    return _sessions[credentials]
+
+def current_credentials():
+    """Return the credentials label get_client() uses by default in this context."""
+    return _credentials.get()
+
+@contextlib.contextmanager
+def use_credentials(credentials):
+    """Make a registered credentials label the default for get_client() in this context."""
+    token = _credentials.set(credentials)
+    try:
+        yield credentials
+    finally:
+        _credentials.reset(token)
+
+def get_client(service, region=None, credentials=None):
+    """Return the shared client for a service, region and credentials label.
+
+    credentials defaults to the label set by use_credentials(), if any.
+    """
+    credentials = credentials or _credentials.get()
+    key = (service, region, credentials)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            session = _get_session(credentials)
+            client = session.client(service, region_name=region,
+                                    config=Config(max_pool_connections=_max_pool_connections))
+            retry.install(client, scope=credentials)
+            instrumentation.install(client)
+            _clients[key] = client
+        return client
+
+def reset_clients():
+    """Drop every cached client and session (e.g. after credentials change)."""
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
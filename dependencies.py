@@ -0,0 +1,73 @@
+"""
+Fast in-process check of the Python packages the onboarding needs.
+
+ensure_dependencies() asks importlib.metadata for each package instead of
+spawning "pip show" per package, and remembers a successful check in
+.dependency_check.json under a fingerprint of the environment (interpreter,
+version and the modification times of the site-packages directories).  As
+long as nothing is installed into or removed from the environment, later
+runs skip the check entirely.  Missing packages are installed with the
+running interpreter's pip.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import importlib.metadata
+
+from logs import log
+
+REQUIRED_PACKAGES = ["boto3", "PyYAML"]
+CACHE_FILE = ".dependency_check.json"
+
+def environment_fingerprint(packages):
+    """Hash of everything that changes when packages are installed or removed."""
+    digest = hashlib.sha256()
+    digest.update(sys.executable.encode())
+    digest.update(sys.version.encode())
+    digest.update(",".join(sorted(packages)).encode())
+    for path in sys.path:
+        if path and os.path.isdir(path):
+            digest.update(f"{path}:{os.stat(path).st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+def _cached_fingerprint():
+    try:
+        with open(CACHE_FILE, "r") as file:
+            return json.load(file).get("fingerprint")
+    except (OSError, ValueError):
+        return None
+
+def _save_fingerprint(fingerprint):
+    try:
+        with open(CACHE_FILE, "w") as file:
+            json.dump({"fingerprint": fingerprint, "checked": time.time()}, file)
+    except OSError:
+        pass  # A read-only working directory only costs the cache
+
+def missing_packages(packages):
+    missing = []
+    for package in packages:
+        try:
+            importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            missing.append(package)
+    return missing
+
+def ensure_dependencies(packages=REQUIRED_PACKAGES):
+    """Install any missing package; a no-op when the environment is unchanged since the last check."""
+    started = time.perf_counter()
+    fingerprint = environment_fingerprint(packages)
+    if fingerprint == _cached_fingerprint():
+        return
+
+    missing = missing_packages(packages)
+    if missing:
+        import subprocess  # Only needed on the rare install path
+        log(f"Installing {', '.join(missing)}...")
+        subprocess.run([sys.executable, "-m", "pip", "install", *missing], check=True)
+        log(f"{', '.join(missing)} installed successfully.")
+        fingerprint = environment_fingerprint(packages)  # site-packages changed
+    _save_fingerprint(fingerprint)
+    log(f"Dependencies checked in {time.perf_counter() - started:.2f}s")
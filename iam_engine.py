@@ -0,0 +1,245 @@
+"""
+IAM provisioning for a customer: users, their groups and policies.
+
+Every environment has one user per account type (admin, service,
+promotion, restricted), named <customer>-<env code>-<account type>.
+Permissions are not attached to users.  Each account type has one IAM
+group per customer, <customer>-<account type>, holding the inline policy
+from group_policy_document() (when it grants anything) and the managed
+policy configured for the type under permissions in Config.yaml.  The
+group policy names the user's own environment through the Environment
+(and, for promotion, PromotesTo) tag of the calling user, so all
+environments share one group without any user reaching another
+environment.  A user costs create_user, create_login_profile and
+add_user_to_group; each group costs create_group plus one call per policy.
+
+provision_iam() computes the deduplicated set of users and groups once
+and finds the existing ones with two paginated list calls.  It creates
+the missing ones on a bounded pool, groups before their members, and
+repairs the existing ones: group policies are re-applied, and users get
+back a missing group membership or login profile.  The shared IAM rate
+limiter (retry.py) keeps the pool inside IAM's request rate:
+
+    provision_iam(config)  # {'groups': [...], 'users': [...], 'repaired': [...]}
+"""
+import json
+import string
+import secrets
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import manifest
+from clients import get_client
+from listing import iter_resources
+from logs import carry_context, log
+from tags import build_tags
+
+IAM_ACCOUNT_TYPES = ['admin', 'service', 'promotion', 'restricted']
+PASSWORD_SYMBOLS = "!@#$%^&*()-_+=<>?[]{}"
+PASSWORD_LENGTH = 16
+
+# Policy variables resolved from the tags of the user making the request
+ENVIRONMENT_VARIABLE = "${aws:PrincipalTag/Environment}"
+PROMOTES_TO_VARIABLE = "${aws:PrincipalTag/PromotesTo}"
+
+def create_secure_password():
+    """Return a random console password with upper and lower case letters, digits and symbols."""
+    characters = string.ascii_letters + string.digits + PASSWORD_SYMBOLS
+    while True:
+        password = ''.join(secrets.choice(characters) for _ in range(PASSWORD_LENGTH))
+        if (any(c.isupper() for c in password) and any(c.islower() for c in password)
+                and any(c.isdigit() for c in password) and any(c in PASSWORD_SYMBOLS for c in password)):
+            return password
+
+def next_environment_code(env_code):
+    """The environment a promotion account promotes into (the next higher one)."""
+    return f"{int(env_code) - 1:02}"
+
+@functools.lru_cache(maxsize=None)
+def _policy_document_json(account_type, env_code, next_env_code, customer_code):
+    s3_arn_prefix = f"arn:aws:s3:::{customer_code}"
+    file_server_arn_prefix = f"arn:aws:fsx:*:*:file-system/{customer_code}"
+
+    policy = {
+        "Version": "2012-10-17",
+        "Statement": []
+    }
+
+    if account_type == "promotion":
+        policy["Statement"].append({
+            "Effect": "Allow",
+            "Action": [
+                "s3:*",
+                "fsx:*"
+            ],
+            "Resource": [
+                f"{s3_arn_prefix}-{env_code}/*",
+                f"{file_server_arn_prefix}-{env_code}",
+                f"{s3_arn_prefix}-{next_env_code}/*",
+                f"{file_server_arn_prefix}-{next_env_code}"
+            ]
+        })
+
+    elif account_type == "admin":
+        policy["Statement"].append({
+            "Effect": "Allow",
+            "Action": "*",
+            "Resource": f"{s3_arn_prefix}-{env_code}/*"
+        })
+
+    elif account_type == "restricted":
+        policy["Statement"].append({
+            "Effect": "Allow",
+            "Action": [
+                "s3:Get*",
+                "s3:List*",
+                "fsx:DescribeFileSystems"
+            ],
+            "Resource": [
+                f"{s3_arn_prefix}-{env_code}/*",
+                f"{file_server_arn_prefix}-{env_code}"
+            ]
+        })
+
+    return json.dumps(policy)
+
+def group_policy_document(account_type, config):
+    """The policy document of an account type's group, for the environment of whichever user calls.
+
+    Documents are built once per customer and account type.
+    """
+    return json.loads(_policy_document_json(account_type, ENVIRONMENT_VARIABLE, PROMOTES_TO_VARIABLE,
+                                            config["customer_code"]))
+
+def group_name(customer_code, account_type):
+    return f"{customer_code}-{account_type}"
+
+def user_tags(customer_code, env_code, account_type):
+    """Tags of an IAM user; the group policies read the Environment and PromotesTo tags."""
+    tags = build_tags(customer_code, environment=env_code)
+    if account_type == 'promotion':
+        tags.append({'Key': 'PromotesTo', 'Value': next_environment_code(env_code)})
+    return tags
+
+def iam_principals(config):
+    """Return the customer's groups and users, deduplicated.
+
+    {'groups': {name: {'account_type', 'policy', 'managed_policy'}},
+     'users': {name: {'env_code', 'account_type', 'group'}}}
+    """
+    customer_code = config['customer_code']
+    groups, users = {}, {}
+    for account_type in IAM_ACCOUNT_TYPES:
+        policy = group_policy_document(account_type, config)
+        groups[group_name(customer_code, account_type)] = {
+            'account_type': account_type,
+            'policy': json.dumps(policy) if policy['Statement'] else None,  # IAM rejects empty policies
+            'managed_policy': (config.get('permissions') or {}).get(account_type),
+        }
+    for env in config['environments']:
+        for account_type in IAM_ACCOUNT_TYPES:
+            users[f"{customer_code}-{env['code']}-{account_type}"] = {
+                'env_code': env['code'],
+                'account_type': account_type,
+                'group': group_name(customer_code, account_type),
+            }
+    return {'groups': groups, 'users': users}
+
+def _apply_group_policies(iam, name, group):
+    # Both calls are idempotent, so an existing group is brought back in line the same way
+    if group['policy']:
+        iam.put_group_policy(GroupName=name, PolicyName=f"{name}-policy", PolicyDocument=group['policy'])
+    if group['managed_policy']:
+        iam.attach_group_policy(GroupName=name, PolicyArn=group['managed_policy'])
+
+def _create_group(iam, customer_code, name, group):
+    try:
+        iam.create_group(GroupName=name)
+        manifest.record(customer_code, 'iam_group', name)
+        log(f"Created IAM group {name}")
+    except iam.exceptions.EntityAlreadyExistsException:
+        pass  # Created concurrently by another run; its policies are brought in line all the same
+    _apply_group_policies(iam, name, group)
+
+def _repair_group(iam, customer_code, name, group):
+    _apply_group_policies(iam, name, group)
+
+def _create_login_profile(iam, name):
+    password = create_secure_password()
+    iam.create_login_profile(UserName=name, Password=password, PasswordResetRequired=True)
+    log(f"Password for {name}: {password}")
+
+def _create_user(iam, customer_code, name, user):
+    iam.create_user(UserName=name, Tags=user_tags(customer_code, user['env_code'], user['account_type']))
+    manifest.record(customer_code, 'iam_user', name)
+    _create_login_profile(iam, name)
+    iam.add_user_to_group(GroupName=user['group'], UserName=name)
+    log(f"Created IAM user {name} in group {user['group']}")
+
+def _repair_user(iam, customer_code, name, user):
+    """Give an existing user back whatever a failed or partial earlier run left out."""
+    repaired = False
+    if not user['member']:
+        iam.add_user_to_group(GroupName=user['group'], UserName=name)
+        repaired = True
+    try:
+        iam.get_login_profile(UserName=name)
+    except iam.exceptions.NoSuchEntityException:
+        _create_login_profile(iam, name)
+        repaired = True
+    if repaired:
+        log(f"Repaired IAM user {name}")
+    return repaired
+
+def _run_all(pool, func, iam, customer_code, principals):
+    """Run func for every principal on the pool; returns ({name: result}, names that failed)."""
+    jobs = {pool.submit(carry_context(func), iam, customer_code, name, principal): name
+            for name, principal in principals.items()}
+    results, failed = {}, []
+    for job, name in jobs.items():
+        try:
+            results[name] = job.result()
+        except iam.exceptions.EntityAlreadyExistsException:
+            pass  # Created concurrently by another run; nothing to do
+        except Exception as e:
+            log(f"Error provisioning IAM principal {name}: {e}")
+            failed.append(name)
+    return results, failed
+
+def provision_iam(config):
+    """Create the customer's missing IAM groups and users and repair the existing ones.
+
+    Returns the names of the groups and users created and of the users repaired.
+    """
+    iam = get_client('iam')
+    customer_code = config['customer_code']
+    principals = iam_principals(config)
+
+    # IAM cannot filter by name server-side; one streamed listing each finds what already exists
+    prefix = f"{customer_code}-"
+    existing_groups = {g['GroupName'] for g in iter_resources(iam, 'list_groups', 'Groups')
+                       if g['GroupName'].startswith(prefix)}
+    existing_users = {u['UserName'] for u in iter_resources(iam, 'list_users', 'Users')
+                      if u['UserName'].startswith(prefix)}
+    new_groups = {name: group for name, group in principals['groups'].items() if name not in existing_groups}
+    old_groups = {name: group for name, group in principals['groups'].items() if name in existing_groups}
+    new_users = {name: user for name, user in principals['users'].items() if name not in existing_users}
+    old_users = {name: user for name, user in principals['users'].items() if name in existing_users}
+
+    with ThreadPoolExecutor(max_workers=config.get('iam_workers', 4)) as pool:
+        _, failed = _run_all(pool, _create_group, iam, customer_code, new_groups)
+        failed += _run_all(pool, _repair_group, iam, customer_code, old_groups)[1]
+        if old_users:
+            # One listing per group tells which existing users still belong to it
+            members = {name: {u['UserName'] for u in iter_resources(iam, 'get_group', 'Users', GroupName=name)}
+                       for name in old_groups}
+            for name, user in old_users.items():
+                user['member'] = name in members.get(user['group'], set())
+        ready = lambda users: {name: user for name, user in users.items() if user['group'] not in failed}
+        _, failed_users = _run_all(pool, _create_user, iam, customer_code, ready(new_users))
+        repaired, failed_repairs = _run_all(pool, _repair_user, iam, customer_code, ready(old_users))
+        failed += failed_users + failed_repairs
+    if failed:
+        raise RuntimeError(f"Could not provision the IAM principals {', '.join(sorted(failed))}")
+    return {'groups': sorted(new_groups), 'users': sorted(new_users),
+            'repaired': sorted(name for name, done in repaired.items() if done)}
@@ -0,0 +1,174 @@
+"""
+Per-call AWS API instrumentation.
+
+install() hooks botocore's before-call, after-call and after-call-error
+events on a client (clients.py does this for every pooled client) and
+records one entry per API call:
+
+    service, operation, start, latency, retries, HTTP status, error code,
+    stage (scheduler.current_stage()), customer, thread
+
+Latency covers the whole call as the caller saw it, including botocore's
+retries and backoff; time spent waiting for a rate limit token is not
+included (see retry.py's counters for that).
+
+log_call_summary() logs a per-operation table (calls, errors, retries,
+average/p95/max latency) and write_trace() exports the calls and the
+scheduler's stage spans as Chrome trace JSON, which chrome://tracing and
+https://ui.perfetto.dev open directly: one process per customer, one
+track per thread, so concurrency and stalls are visible at a glance.
+"""
+import json
+import time
+import threading
+
+from logs import current_customer, log
+from scheduler import current_stage, stage_history
+
+_lock = threading.Lock()
+_calls = []
+_epoch = time.monotonic()
+
+def _before_call(model, context, **kwargs):
+    context['qro_call'] = {
+        'service': model.service_model.service_name,
+        'operation': model.name,
+        'started': time.monotonic(),
+        'stage': current_stage(),
+        'customer': current_customer(),
+    }
+
+def _finish(context, status, retries, error):
+    call = context.pop('qro_call', None)
+    if call is None:
+        return
+    call.update({
+        'seconds': time.monotonic() - call['started'],
+        'status': status,
+        'retries': retries,
+        'error': error,
+        'thread': threading.current_thread().name,
+    })
+    with _lock:
+        _calls.append(call)
+
+def _after_call(http_response, parsed, context, **kwargs):
+    metadata = (parsed or {}).get('ResponseMetadata', {})
+    error = (parsed or {}).get('Error', {}).get('Code')
+    status = http_response.status_code if http_response is not None else metadata.get('HTTPStatusCode')
+    _finish(context, status, metadata.get('RetryAttempts', 0), error)
+
+def _after_call_error(exception, context, **kwargs):
+    _finish(context, None, None, type(exception).__name__)
+
+def install(client):
+    """Record every API call the client makes."""
+    events = client.meta.events
+    events.register('before-call', _before_call, unique_id='qro-instrument-start')
+    events.register('after-call', _after_call, unique_id='qro-instrument-end')
+    events.register('after-call-error', _after_call_error, unique_id='qro-instrument-error')
+    return client
+
+def recorded_calls():
+    """Return a copy of every call recorded so far."""
+    with _lock:
+        return [dict(call) for call in _calls]
+
+def reset():
+    with _lock:
+        _calls.clear()
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def call_summary(calls=None):
+    """Aggregate calls per (service, operation)."""
+    calls = recorded_calls() if calls is None else calls
+    grouped = {}
+    for call in calls:
+        grouped.setdefault((call['service'], call['operation']), []).append(call)
+    summary = []
+    for (service, operation), group in grouped.items():
+        latencies = [call['seconds'] for call in group]
+        summary.append({
+            'service': service,
+            'operation': operation,
+            'calls': len(group),
+            'errors': sum(1 for call in group if call['error']),
+            'retries': sum(call['retries'] or 0 for call in group),
+            'total_seconds': sum(latencies),
+            'avg_seconds': sum(latencies) / len(latencies),
+            'p95_seconds': _percentile(latencies, 0.95),
+            'max_seconds': max(latencies),
+        })
+    return sorted(summary, key=lambda row: row['total_seconds'], reverse=True)
+
+def log_call_summary():
+    """Log the per-operation table, slowest total first."""
+    summary = call_summary()
+    if not summary:
+        return
+    log(f"{'API call':<46} {'Calls':>6} {'Errors':>6} {'Retries':>7} {'Total':>8} {'Avg':>7} {'p95':>7} {'Max':>7}")
+    for row in summary:
+        log(f"{row['service'] + ':' + row['operation']:<46} {row['calls']:>6} {row['errors']:>6} {row['retries']:>7} "
+            f"{row['total_seconds']:>7.1f}s {row['avg_seconds']:>6.2f}s {row['p95_seconds']:>6.2f}s "
+            f"{row['max_seconds']:>6.2f}s")
+    by_stage = {}
+    for call in recorded_calls():
+        stage = by_stage.setdefault(call['stage'] or '(no stage)', [0, 0.0])
+        stage[0] += 1
+        stage[1] += call['seconds']
+    for stage, (count, seconds) in sorted(by_stage.items(), key=lambda item: item[1][1], reverse=True):
+        log(f"Stage {stage}: {count} API call(s), {seconds:.1f}s in AWS")
+
+def _micros(monotonic):
+    return int((monotonic - _epoch) * 1_000_000)
+
+def write_trace(path):
+    """Write the recorded calls and stage spans as a Chrome/Perfetto trace."""
+    calls = recorded_calls()
+    pids, tids, events = {}, {}, []
+
+    def _pid(customer):
+        if customer not in pids:
+            pids[customer] = len(pids) + 1
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[customer], 'tid': 0,
+                           'args': {'name': customer or 'onboarding'}})
+        return pids[customer]
+
+    def _tid(pid, thread):
+        if (pid, thread) not in tids:
+            tids[(pid, thread)] = len(tids) + 1
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tids[(pid, thread)],
+                           'args': {'name': thread}})
+        return tids[(pid, thread)]
+
+    for call in calls:
+        pid = _pid(call['customer'])
+        events.append({
+            'name': f"{call['service']}:{call['operation']}",
+            'cat': call['service'],
+            'ph': 'X',
+            'ts': _micros(call['started']),
+            'dur': max(1, int(call['seconds'] * 1_000_000)),
+            'pid': pid,
+            'tid': _tid(pid, call['thread']),
+            'args': {key: call[key] for key in ('stage', 'status', 'retries', 'error')},
+        })
+    for stage in stage_history():
+        pid = _pid(stage.get('customer'))
+        events.append({
+            'name': stage['name'],
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': _micros(stage['started']),
+            'dur': max(1, int(stage['seconds'] * 1_000_000)),
+            'pid': pid,
+            'tid': _tid(pid, f"stage {stage['name']}"),  # Stages overlap, so one track each
+            'args': {'status': stage['status'], 'depends_on': stage['depends_on']},
+        })
+
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+    log(f"Trace of {len(calls)} API call(s) written to {path}")
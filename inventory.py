@@ -0,0 +1,94 @@
+"""
+Customer resource inventory built from the Resource Groups Tagging API.
+
+scan_tagged_resources() pulls every Customer-tagged ARN in the region in
+one paginated get_resources stream and indexes it in memory as
+{customer code: {resource kind: {resource id: arn}}}.  Teardown and
+reporting read from that index instead of issuing one tag-filtered
+describe call per resource type per customer.
+
+Resource kinds use the same names as teardown.RESOURCE_KINDS; ARN types
+the tool does not manage are indexed as "<service>:<type>".
+"""
+
+from clients import get_client
+from logs import log
+
+# (service, ARN resource type) -> resource kind
+ARN_KINDS = {
+    ('ec2', 'instance'): 'instance',
+    ('ec2', 'vpc'): 'vpc',
+    ('ec2', 'subnet'): 'subnet',
+    ('ec2', 'security-group'): 'security_group',
+    ('ec2', 'route-table'): 'route_table',
+    ('ec2', 'internet-gateway'): 'internet_gateway',
+    ('ec2', 'natgateway'): 'nat_gateway',
+    ('ec2', 'network-interface'): 'network_interface',
+    ('ec2', 'transit-gateway'): 'transit_gateway',
+    ('ec2', 'transit-gateway-attachment'): 'transit_gateway_attachment',
+    ('ec2', 'key-pair'): 'key_pair',
+    ('ec2', 'launch-template'): 'launch_template',
+    ('rds', 'db'): 'db_instance',
+    ('rds', 'subgrp'): 'db_subnet_group',
+    ('cloudformation', 'stack'): 'stack',
+}
+
+def parse_arn(arn):
+    """Split an ARN into (service, resource type, resource id)."""
+    parts = arn.split(':', 5)
+    service, resource = parts[2], parts[5]
+    if '/' in resource:
+        resource_type, resource_id = resource.split('/', 1)
+    elif ':' in resource:
+        resource_type, resource_id = resource.split(':', 1)
+    else:
+        resource_type, resource_id = resource, resource
+    return service, resource_type, resource_id
+
+def resource_kind(arn):
+    """Map an ARN to (resource kind, resource id)."""
+    service, resource_type, resource_id = parse_arn(arn)
+    if service == 'cloudformation':
+        resource_id = resource_id.split('/', 1)[0]  # stack/<name>/<uuid>
+    return ARN_KINDS.get((service, resource_type), f"{service}:{resource_type}"), resource_id
+
+def scan_tagged_resources(region, customer_codes=None, tagging=None):
+    """Index every Customer-tagged resource in a region by customer code and kind.
+
+    Pass customer_codes to restrict the scan server-side; by default every
+    customer in the account and region is returned.
+    """
+    tagging = tagging or get_client('resourcegroupstaggingapi', region)
+    tag_filter = {'Key': 'Customer'}
+    if customer_codes:
+        tag_filter['Values'] = list(customer_codes)
+
+    index = {}
+    count = 0
+    for page in tagging.get_paginator('get_resources').paginate(TagFilters=[tag_filter]):
+        for mapping in page.get('ResourceTagMappingList', []):
+            tags = {t['Key']: t['Value'] for t in mapping.get('Tags', [])}
+            customer_code = tags.get('Customer')
+            if not customer_code:
+                continue
+            kind, resource_id = resource_kind(mapping['ResourceARN'])
+            index.setdefault(customer_code, {}).setdefault(kind, {})[resource_id] = mapping['ResourceARN']
+            count += 1
+
+    log(f"Inventory found {count} tagged resource(s) for {len(index)} customer(s) in {region}")
+    return index
+
+def summarize(index):
+    """Return {customer code: {kind: count}} for reporting."""
+    return {
+        customer_code: {kind: len(resources) for kind, resources in sorted(kinds.items())}
+        for customer_code, kinds in sorted(index.items())
+    }
+
+if __name__ == "__main__":
+    import sys
+    import yaml
+    with open('config.yaml', 'r') as file:
+        REGION = yaml.safe_load(file)['region']
+    for customer, kinds in summarize(scan_tagged_resources(REGION, sys.argv[1:] or None)).items():
+        log(f"{customer}: {kinds}")
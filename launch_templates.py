@@ -0,0 +1,116 @@
+"""
+EC2 launch templates, one per customer and node type.
+
+Every setting an instance of a node type needs (AMI, instance type, key
+pair, the customer security group, root volume, user data and volume tags)
+lives in the launch template <customer>-<node type>, so run_instances only
+names the template version, the subnet and the instance tags:
+
+    template = ensure_launch_template(ec2, config, node, key_name, security_group_id)
+    ec2.run_instances(LaunchTemplate=template, SubnetId=subnet_id, MinCount=1, MaxCount=count, ...)
+
+Each version carries a hash of its launch data in its description.  A new
+version is only created when the configuration of the node type changes;
+otherwise the matching version is reused, found through the metadata cache
+so repeated runs make no launch template calls at all.  The templates can
+back Auto Scaling groups later.
+
+Config.yaml, globally or per node:
+
+    root_volume_gb: 100         # Size of the encrypted gp3 root volume (default: the AMI's)
+    root_device_name: /dev/sda1 # Root device of the AMIs (Windows: /dev/sda1)
+    user_data:                  # Script run at first boot, per node type
+      central: "<powershell>...</powershell>"
+"""
+import json
+import base64
+import hashlib
+import threading
+
+import botocore.exceptions
+
+import manifest
+import metadata_cache
+from logs import log
+from tags import build_tags, tag_specifications
+
+TEMPLATE_NAME_FORMAT = "{customer_code}-{node_type}"
+DEFAULT_ROOT_DEVICE = "/dev/sda1"
+
+_lock = threading.Lock()
+_name_locks = {}
+
+def template_name(customer_code, node_type):
+    return TEMPLATE_NAME_FORMAT.format(customer_code=customer_code, node_type=node_type)
+
+def _node_setting(config, node, key):
+    value = node.get(key, config.get(key))
+    if isinstance(value, dict):  # Keyed by node type
+        value = value.get(node['type'])
+    return value
+
+def launch_template_data(config, node, key_name, security_group_id):
+    """Return the LaunchTemplateData for a node type."""
+    data = {
+        'ImageId': node['ami_id'],
+        'InstanceType': node['instance_type'],
+        'KeyName': key_name,
+        'SecurityGroupIds': [security_group_id],
+        'TagSpecifications': [
+            {'ResourceType': 'volume', 'Tags': build_tags(config['customer_code'], node_type=node['type'])}
+        ],
+    }
+    root_volume_gb = _node_setting(config, node, 'root_volume_gb')
+    if root_volume_gb:
+        data['BlockDeviceMappings'] = [{
+            'DeviceName': _node_setting(config, node, 'root_device_name') or DEFAULT_ROOT_DEVICE,
+            'Ebs': {'VolumeSize': int(root_volume_gb), 'VolumeType': 'gp3', 'Encrypted': True,
+                    'DeleteOnTermination': True},
+        }]
+    user_data = _node_setting(config, node, 'user_data')
+    if user_data:
+        data['UserData'] = base64.b64encode(user_data.encode()).decode()
+    return data
+
+def data_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+def ensure_launch_template(ec2, config, node, key_name, security_group_id):
+    """Return the LaunchTemplate specification ({LaunchTemplateId, Version}) for a node's current settings."""
+    customer_code = config['customer_code']
+    region = ec2.meta.region_name
+    name = template_name(customer_code, node['type'])
+    data = launch_template_data(config, node, key_name, security_group_id)
+    description = f"config:{data_hash(data)}"
+
+    with _lock:
+        name_lock = _name_locks.setdefault((region, name), threading.Lock())
+    with name_lock:  # Environments sharing a node type must not race to create the template
+        template = metadata_cache.launch_template_version(region, name, description)
+        if template:
+            return template
+        try:
+            created = ec2.create_launch_template(
+                LaunchTemplateName=name,
+                VersionDescription=description,
+                LaunchTemplateData=data,
+                TagSpecifications=tag_specifications('launch-template', customer_code, node_type=node['type'])
+            )['LaunchTemplate']
+            template = {'LaunchTemplateId': created['LaunchTemplateId'],
+                        'Version': str(created['LatestVersionNumber'])}
+            manifest.record(customer_code, 'launch_template', created['LaunchTemplateId'], node=node['type'])
+            log(f"Created Launch Template {name}: {created['LaunchTemplateId']}",
+                resource_id=created['LaunchTemplateId'])
+        except botocore.exceptions.ClientError as e:
+            if 'AlreadyExists' not in e.response.get('Error', {}).get('Code', ''):
+                raise
+            version = ec2.create_launch_template_version(
+                LaunchTemplateName=name,
+                VersionDescription=description,
+                LaunchTemplateData=data
+            )['LaunchTemplateVersion']
+            template = {'LaunchTemplateId': version['LaunchTemplateId'], 'Version': str(version['VersionNumber'])}
+            log(f"Created version {template['Version']} of Launch Template {name}: the {node['type']} settings changed",
+                resource_id=version['LaunchTemplateId'])
+        metadata_cache.store('launch_template', region, f"{name}:{description}", template)
+        return template
@@ -0,0 +1,57 @@
+"""
+Streaming, paginated listing of AWS resources.
+
+iter_resources() walks every page of a describe/list operation and yields
+the matching items one by one, fetching the next page only when the
+caller gets to it:
+
+    for instance in iter_resources(ec2, 'describe_instances', 'Reservations[].Instances[]',
+                                   Filters=customer_filter(customer_code)):
+        ...
+    vpc = first_resource(ec2, 'describe_vpcs', 'Vpcs', Filters=customer_filter(customer_code))
+
+Results are never silently truncated at the first page, memory stays at
+one page however large the account is, and callers that only need the
+first match stop after one request.  Narrow every listing server-side
+(Filters, name prefixes, ...) instead of filtering in Python where the
+API allows it.
+"""
+
+# Page size per operation where the API's maximum is lower than the service default below
+PAGE_SIZES = {
+    ('ec2', 'describe_route_tables'): 100,
+    ('ec2', 'describe_instance_types'): 100,
+    ('ec2', 'describe_launch_templates'): 200,
+    ('ec2', 'describe_launch_template_versions'): 200,
+    ('rds', 'describe_db_instances'): 100,
+    ('budgets', 'describe_budgets'): 100,
+}
+
+# Largest page each service accepts for its list/describe operations
+SERVICE_PAGE_SIZES = {
+    'ec2': 1000,
+    'iam': 1000,
+}
+
+def customer_filter(customer_code):
+    """EC2 filter for resources tagged with the customer code."""
+    return [{'Name': 'tag:Customer', 'Values': [customer_code]}]
+
+def page_size(client, operation):
+    service = client.meta.service_model.service_name
+    return PAGE_SIZES.get((service, operation), SERVICE_PAGE_SIZES.get(service))
+
+def iter_resources(client, operation, expression, **params):
+    """Lazily yield the items selected by a JMESPath expression from every page of an operation."""
+    size = page_size(client, operation)
+    pages = client.get_paginator(operation).paginate(
+        PaginationConfig={'PageSize': size} if size else {},
+        **params
+    )
+    for item in pages.search(expression):
+        if item is not None:  # search() yields None for pages without the key
+            yield item
+
+def first_resource(client, operation, expression, **params):
+    """Return the first matching item, or None, without fetching further pages."""
+    return next(iter_resources(client, operation, expression, **params), None)
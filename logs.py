@@ -0,0 +1,205 @@
+"""
+Shared, non-blocking logging pipeline for the onboarding scripts.
+
+Every script and support module logs through log() (or the root logger).
+Records are put on an in-memory queue and a single listener thread does
+all of the I/O, so provisioning threads never wait on the disk or the
+terminal:
+
+* process.log: one JSON object per line with the time, level, message,
+  customer, environment, stage, resource_id and thread, rotated by size
+  and gzip-compressed (process.log.1.gz, ...).
+* logs/<customer>.log: the same lines for one customer, written while
+  that customer runs inside customer_log() (batch.py).
+* the console: the familiar "[timestamp] message" lines from log().
+
+Context fields are captured on the calling thread when the record is
+created: customer_log() and log_context() set them for a block of work,
+log(message, resource_id=..., environment=...) sets them for one line.
+Work handed to thread pools keeps its context when wrapped with
+carry_context().
+"""
+import os
+import sys
+import json
+import gzip
+import queue
+import atexit
+import shutil
+import logging
+import datetime
+import contextlib
+import contextvars
+import logging.handlers
+
+LOG_FILE = "process.log"
+LOG_DIR = "logs"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+CONTEXT_FIELDS = ('customer', 'environment', 'stage', 'resource_id')
+
+_context = {field: contextvars.ContextVar(field, default=None) for field in CONTEXT_FIELDS}
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON line with the context fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        entry['thread'] = record.threadName
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    """The "[timestamp] [customer] message" lines log() has always printed."""
+
+    def format(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S")
+        customer = getattr(record, 'customer', None)
+        prefix = f"[{customer}] " if customer else ""
+        return f"[{timestamp}] {prefix}{record.getMessage()}"
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as plain, gzip.open(dest, 'wb') as compressed:
+        shutil.copyfileobj(plain, compressed)
+    os.remove(source)
+
+def _rotating_json_handler(path):
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                   encoding='utf-8', delay=True)
+    handler.namer = _gzip_namer
+    handler.rotator = _gzip_rotator
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+class _ContextFilter(logging.Filter):
+    """Stamp the caller's context fields on a record before it crosses the queue."""
+
+    def filter(self, record):
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, _context[field].get())
+        return True
+
+class _CustomerRouter(logging.Handler):
+    """Copy records of customers running under customer_log() to logs/<customer>.log."""
+
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+
+    def handle(self, record):
+        command = getattr(record, 'customer_log', None)
+        if command == 'open':
+            os.makedirs(LOG_DIR, exist_ok=True)
+            self.handlers.setdefault(record.customer,
+                                     _rotating_json_handler(os.path.join(LOG_DIR, f"{record.customer}.log")))
+        elif command == 'close':
+            handler = self.handlers.pop(record.customer, None)
+            if handler:
+                handler.close()
+        elif record.customer in self.handlers:
+            self.handlers[record.customer].handle(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers.clear()
+        super().close()
+
+def _console_only(record):
+    return getattr(record, 'console', False)
+
+def _not_control(record):
+    return getattr(record, 'customer_log', None) is None
+
+_queue = queue.SimpleQueue()
+_file_handler = _rotating_json_handler(LOG_FILE)
+_file_handler.addFilter(_not_control)
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(ConsoleFormatter())
+_console_handler.addFilter(_console_only)
+_console_handler.addFilter(_not_control)
+_router = _CustomerRouter()
+
+_queue_handler = logging.handlers.QueueHandler(_queue)
+_queue_handler.addFilter(_ContextFilter())
+_listener = logging.handlers.QueueListener(_queue, _file_handler, _console_handler, _router,
+                                           respect_handler_level=True)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(_queue_handler)
+_listener.start()
+
+def flush_logs():
+    """Write out everything queued so far and stop the listener (runs at exit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        for handler in (_file_handler, _console_handler, _router):
+            handler.flush()
+
+atexit.register(flush_logs)
+
+def log(message, **fields):
+    """Log a message to the console and process.log without blocking.
+
+    Keyword fields (environment, resource_id, ...) are added to this line's
+    JSON record on top of the current context.
+    """
+    logger.info(message, extra={'console': True, **fields})
+
+def current_customer():
+    """Return the customer code of the current logging context, if any."""
+    return _context['customer'].get()
+
+def current_context(field):
+    """Return a context field (customer, environment, stage, resource_id) of the current context."""
+    return _context[field].get()
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Set context fields for everything logged in the enclosed block."""
+    tokens = [(_context[field], _context[field].set(value)) for field, value in fields.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+@contextlib.contextmanager
+def customer_log(customer_code):
+    """Tag everything logged in this context with the customer and copy it to logs/<customer>.log."""
+    logger.info("", extra={'customer_log': 'open', 'customer': customer_code})
+    try:
+        with log_context(customer=customer_code):
+            yield
+    finally:
+        # Queued behind the customer's last lines, so none of them are lost
+        logger.info("", extra={'customer_log': 'close', 'customer': customer_code})
+
+def carry_context(func):
+    """Wrap func so it runs with the caller's logging context on another thread."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)  # A copy per call: pools run it concurrently
+    return run
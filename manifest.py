@@ -0,0 +1,69 @@
+"""
+Append-only deployment manifest, one JSON-lines file per customer.
+
+Provisioning records every resource ID the moment it is created, and
+teardown reads the file back so it can delete exactly what was created
+without any list/describe discovery.  A completed teardown appends a
+marker naming the kinds it removed; load() drops entries of those kinds
+recorded before the marker.
+
+    {"time": "...", "event": "created", "kind": "vpc", "id": "vpc-0abc", ...}
+    {"time": "...", "event": "teardown_complete", "kinds": ["subnet", "vpc", ...]}
+"""
+import os
+import json
+import datetime
+import threading
+
+MANIFEST_DIR = "manifests"
+
+_lock = threading.Lock()
+
+def manifest_path(customer_code):
+    return os.path.join(MANIFEST_DIR, f"{customer_code}.jsonl")
+
+def _append(customer_code, entry):
+    entry = {"time": datetime.datetime.now().isoformat(timespec="seconds"), **entry}
+    line = json.dumps(entry, default=str) + "\n"
+    with _lock:
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        with open(manifest_path(customer_code), "a") as file:
+            file.write(line)
+            file.flush()
+
+def record(customer_code, kind, resource_id, **details):
+    """Record a resource that was just created for a customer."""
+    _append(customer_code, {"event": "created", "kind": kind, "id": resource_id, **details})
+
+def record_teardown_complete(customer_code, kinds):
+    """Mark every resource of the given kinds recorded so far as deleted."""
+    if os.path.exists(manifest_path(customer_code)):
+        _append(customer_code, {"event": "teardown_complete", "kinds": sorted(kinds)})
+
+def load(customer_code):
+    """Return {kind: {resource id: details}} for the customer's live resources.
+
+    Returns None when the customer has no manifest (e.g. it was created
+    before manifests existed), so callers can fall back to discovery.
+    """
+    path = manifest_path(customer_code)
+    if not os.path.exists(path):
+        return None
+
+    resources = {}
+    with _lock, open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash mid-write
+            if entry.get("event") == "teardown_complete":
+                for kind in entry.get("kinds", []):
+                    resources.pop(kind, None)
+            elif entry.get("event") == "created":
+                details = {k: v for k, v in entry.items() if k not in ("time", "event", "kind", "id")}
+                resources.setdefault(entry["kind"], {})[entry["id"]] = details
+    return resources
@@ -0,0 +1,313 @@
+"""
+TTL cache for slow-changing AWS metadata, shared across runs.
+
+Availability zones, the configured transit gateway, key pairs, launch
+template versions, AMIs, instance type architectures and the STS caller
+identity hardly ever change, yet every run (and every customer of a
+batch) used to fetch them again.  Lookups here are cached per account and
+region with a TTL per kind, persisted to .metadata_cache.json in the
+working directory so the next run starts warm, and single-flighted so a
+batch of customers starting together in one region makes one call:
+
+    zones = metadata_cache.availability_zones(region)
+    tgw = metadata_cache.transit_gateway(region, transit_gateway_id)
+
+Writes merge into the file as it stands, under a lock file, so processes
+sharing the working directory keep each other's entries.
+
+Entries are keyed by the account of the current credentials (clients.py),
+so assumed-role sessions never see another account's metadata.  Only
+found resources are cached; "not found" is always asked again.  Code that
+creates or deletes a cached resource updates it with store() or
+invalidate(); "python metadata_cache.py --clear" empties the cache.
+
+Config.yaml:
+
+    metadata_cache: true        # false disables the cache for the run
+    metadata_cache_ttl:         # seconds, per kind
+      availability_zones: 86400
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import contextlib
+
+import botocore.exceptions
+
+from clients import DEFAULT_CREDENTIALS, current_credentials, get_client, get_session
+from listing import iter_resources
+from logs import log
+
+CACHE_FILE = ".metadata_cache.json"
+LOCK_FILE = f"{CACHE_FILE}.lock"
+LOCK_TIMEOUT = 5  # Seconds to wait for another process's write
+STALE_LOCK_AGE = 30  # A lock file this old was left by a process that died
+
+DEFAULT_TTLS = {
+    'caller_identity': 24 * 3600,
+    'availability_zones': 24 * 3600,
+    'transit_gateway': 3600,
+    'key_pair': 600,  # Short: a key pair deleted outside these scripts would break launches
+    'launch_template': 600,  # Short for the same reason
+    'image': 3600,  # Name patterns and SSM parameters move to newer images
+    'instance_type': 7 * 24 * 3600,
+}
+
+_lock = threading.Lock()
+_write_lock = threading.Lock()  # One writer of CACHE_FILE per process
+_key_locks = {}
+_entries = None  # Loaded from CACHE_FILE on first use
+_pending = []  # Changes not yet written to CACHE_FILE: ('set', entry key, entry) or ('drop', kind, region, key)
+_enabled = True
+_ttls = dict(DEFAULT_TTLS)
+
+def configure_metadata_cache(config):
+    """Apply the cache settings from Config.yaml."""
+    global _enabled
+    with _lock:
+        _enabled = bool(config.get('metadata_cache', True))
+        _ttls.clear()
+        _ttls.update(DEFAULT_TTLS)
+        _ttls.update({kind: int(ttl) for kind, ttl in (config.get('metadata_cache_ttl') or {}).items()})
+
+def _load():
+    global _entries
+    if _entries is None:
+        try:
+            with open(CACHE_FILE, 'r') as file:
+                _entries = json.load(file)
+        except (OSError, ValueError):
+            _entries = {}
+    return _entries
+
+def _matches(entry_key, kind, region, key):
+    _, entry_region, entry_kind, entry_name = entry_key.split('|', 3)
+    return ((kind is None or kind == entry_kind) and (region is None or region == entry_region)
+            and (key is None or key == entry_name))
+
+def _apply(entries, change):
+    if change[0] == 'set':
+        _, entry_key, entry = change
+        current = entries.get(entry_key)
+        if current is None or current['expires'] <= entry['expires']:
+            entries[entry_key] = entry
+    else:
+        _, kind, region, key = change
+        for entry_key in [entry_key for entry_key in entries if _matches(entry_key, kind, region, key)]:
+            del entries[entry_key]
+
+@contextlib.contextmanager
+def _file_lock():
+    """Hold LOCK_FILE, so the read-merge-write of one process does not overwrite another's.
+
+    A lock file (not fcntl/msvcrt) so it works on Windows and Linux alike.
+    After LOCK_TIMEOUT the write goes ahead unlocked: the cache is only a cache.
+    """
+    deadline = time.time() + LOCK_TIMEOUT
+    while True:
+        try:
+            os.close(os.open(LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(LOCK_FILE) > STALE_LOCK_AGE:
+                    os.remove(LOCK_FILE)
+                    continue
+            except OSError:
+                continue  # Released meanwhile
+            if time.time() > deadline:
+                yield
+                return
+            time.sleep(0.01)
+        except OSError:
+            yield  # The directory is not writable; the write below reports it
+            return
+    try:
+        yield
+    finally:
+        try:
+            os.remove(LOCK_FILE)
+        except OSError:
+            pass
+
+def _save():
+    """Write this process's pending changes into the cache file; call without holding _lock.
+
+    The changes are merged into the file as it is now, not over it, so
+    entries written meanwhile by other processes (a batch runs customers
+    in parallel) are kept.  A writer that finds nothing pending returns:
+    another thread's write already carried its change.
+    """
+    with _write_lock:
+        with _lock:
+            changes = list(_pending)
+            _pending.clear()
+        if not changes:
+            return
+        with _file_lock():
+            try:
+                with open(CACHE_FILE, 'r') as file:
+                    entries = json.load(file)
+            except (OSError, ValueError):
+                entries = {}
+            for change in changes:
+                _apply(entries, change)
+            temporary = f"{CACHE_FILE}.{os.getpid()}.tmp"
+            try:
+                with open(temporary, 'w') as file:
+                    json.dump(entries, file)
+                os.replace(temporary, CACHE_FILE)  # Readers never see a half-written file
+            except OSError as e:
+                log(f"Could not write the metadata cache: {e}")
+
+def _entry_key(scope, region, kind, key):
+    return f"{scope}|{region or '-'}|{kind}|{key}"
+
+def _get(entry_key):
+    entry = _load().get(entry_key)
+    if entry and entry['expires'] > time.time():
+        return entry
+    return None
+
+def _put(entry_key, kind, value):
+    entry = {'value': value, 'expires': time.time() + _ttls[kind]}
+    with _lock:
+        _load()[entry_key] = entry
+        _pending.append(('set', entry_key, entry))
+    _save()
+
+def cached_value(kind, region, key, credentials=None):
+    """Return a cached value, or None when it is missing or expired, for callers that batch their lookups."""
+    if not _enabled:
+        return None
+    entry_key = _entry_key(account_id(credentials), region, kind, key)
+    with _lock:
+        entry = _get(entry_key)
+    return entry['value'] if entry else None
+
+def store(kind, region, key, value, credentials=None):
+    """Cache a value the caller already knows (e.g. a resource it just created)."""
+    if not _enabled:
+        return
+    _put(_entry_key(account_id(credentials), region, kind, key), kind, value)
+
+def invalidate(kind=None, region=None, key=None):
+    """Drop the matching entries in every account; no arguments empties the cache."""
+    with _lock:
+        _apply(_load(), ('drop', kind, region, key))
+        _pending.append(('drop', kind, region, key))
+    _save()
+
+def _cached(scope, region, kind, key, loader):
+    if not _enabled:
+        return loader()
+    entry_key = _entry_key(scope, region, kind, key)
+    with _lock:
+        entry = _get(entry_key)
+        if entry:
+            return entry['value']
+        key_lock = _key_locks.setdefault(entry_key, threading.Lock())
+    with key_lock:  # One lookup per entry; concurrent callers wait for its result
+        with _lock:
+            entry = _get(entry_key)
+        if entry:
+            return entry['value']
+        value = loader()
+        if value is not None:
+            _put(entry_key, kind, value)
+        return value
+
+def _identity_scope(credentials):
+    """Stable name for a set of credentials: the role ARN, or a hash of the ambient access key."""
+    if credentials != DEFAULT_CREDENTIALS:
+        return credentials
+    resolved = get_session(credentials).get_credentials()
+    access_key = resolved.access_key if resolved else ''
+    return f"default:{hashlib.sha256(access_key.encode()).hexdigest()[:16]}"
+
+def caller_identity(credentials=None):
+    """Return the STS caller identity (Account, Arn, UserId) of the current credentials."""
+    credentials = credentials or current_credentials()
+
+    def load():
+        identity = get_client('sts', credentials=credentials).get_caller_identity()
+        return {field: identity[field] for field in ('Account', 'Arn', 'UserId')}
+    return _cached(_identity_scope(credentials), None, 'caller_identity', 'self', load)
+
+def account_id(credentials=None):
+    """Return the account ID of the current credentials."""
+    return caller_identity(credentials)['Account']
+
+def availability_zones(region, credentials=None):
+    """Return the names of the region's availability zones."""
+    credentials = credentials or current_credentials()
+
+    def load():
+        zones = get_client('ec2', region, credentials).describe_availability_zones()['AvailabilityZones']
+        return [zone['ZoneName'] for zone in zones]
+    return _cached(account_id(credentials), region, 'availability_zones', 'all', load)
+
+def transit_gateway(region, transit_gateway_id, credentials=None):
+    """Return the transit gateway's ID, state and owner, or None if it does not exist."""
+    credentials = credentials or current_credentials()
+
+    def load():
+        ec2 = get_client('ec2', region, credentials)
+        gateways = ec2.describe_transit_gateways(TransitGatewayIds=[transit_gateway_id])['TransitGateways']
+        if not gateways:
+            return None
+        return {'TransitGatewayId': gateways[0]['TransitGatewayId'], 'State': gateways[0].get('State'),
+                'OwnerId': gateways[0].get('OwnerId')}
+    return _cached(account_id(credentials), region, 'transit_gateway', transit_gateway_id, load)
+
+def key_pair(region, key_name, credentials=None):
+    """Return the key pair's name and ID, or None if it does not exist."""
+    credentials = credentials or current_credentials()
+
+    def load():
+        ec2 = get_client('ec2', region, credentials)
+        try:
+            pairs = ec2.describe_key_pairs(KeyNames=[key_name])['KeyPairs']
+        except botocore.exceptions.ClientError as e:
+            if 'InvalidKeyPair.NotFound' in str(e):
+                return None
+            raise
+        return {'KeyName': pairs[0]['KeyName'], 'KeyPairId': pairs[0].get('KeyPairId')} if pairs else None
+    return _cached(account_id(credentials), region, 'key_pair', key_name, load)
+
+def launch_template_version(region, template_name, description, credentials=None):
+    """Return the ID and version number of the template version with this description, or None."""
+    credentials = credentials or current_credentials()
+
+    def load():
+        ec2 = get_client('ec2', region, credentials)
+        try:
+            for version in iter_resources(ec2, 'describe_launch_template_versions', 'LaunchTemplateVersions',
+                                          LaunchTemplateName=template_name):
+                if version.get('VersionDescription') == description:
+                    return {'LaunchTemplateId': version['LaunchTemplateId'],
+                            'Version': str(version['VersionNumber'])}
+        except botocore.exceptions.ClientError as e:
+            if 'NotFound' in e.response.get('Error', {}).get('Code', ''):
+                return None
+            raise
+        return None
+    return _cached(account_id(credentials), region, 'launch_template', f"{template_name}:{description}", load)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the AWS metadata cache")
+    parser.add_argument('--clear', action='store_true', help="Remove every cached entry")
+    parser.add_argument('--kind', choices=sorted(DEFAULT_TTLS), help="Only clear entries of this kind")
+    parser.add_argument('--region', help="Only clear entries of this region")
+    args = parser.parse_args()
+    if args.clear or args.kind or args.region:
+        invalidate(args.kind, args.region)
+        log("Metadata cache cleared.")
+    else:
+        now = time.time()
+        for entry_key, entry in sorted(_load().items()):
+            state = f"expires in {int(entry['expires'] - now)}s" if entry['expires'] > now else "expired"
+            log(f"{entry_key}: {state}")
@@ -0,0 +1,298 @@
+"""
+Plan step for incremental (day-2) changes.
+
+desired_state() reads what Config.yaml asks for, live_state() reads what
+is deployed for the customer (by Customer tag), and compute_plan()
+returns the minimal list of changes that turns one into the other:
+
+    {'action': 'launch', 'environment': 'production', 'node_type': 'worker', 'count': 2, ...}
+
+Main.py's apply step executes the changes in ACTION_ORDER, so adding one
+port or resizing one node no longer needs a full delete-and-rebuild.
+"""
+import botocore.exceptions
+
+from clients import get_client
+from iam_engine import IAM_ACCOUNT_TYPES
+from listing import customer_filter, first_resource, iter_resources
+from logs import log
+from sg_rules import allowed_ports, missing_port_ranges
+
+
+# Order in which apply executes the change types
+ACTION_ORDER = [
+    'create_customer',
+    'create_subnet',
+    'revoke_rules',
+    'authorize_ports',
+    'terminate',
+    'resize',
+    'launch',
+    'delete_database',
+    'update_db_subnet_group',
+    'delete_db_subnet_group',
+    'delete_subnet',
+    'create_iam_users',
+    'delete_iam_user',
+    'create_database',
+    'create_budget',
+]
+
+def desired_state(config):
+    """Describe the deployment Config.yaml asks for."""
+    customer_code = config['customer_code']
+    environments = {}
+    iam_users = {}
+    databases = {}
+    for env in config['environments']:
+        nodes = {}
+        for node in env['nodes']:
+            count = int(node.get('count', 1))
+            if node['type'] in nodes:
+                nodes[node['type']]['count'] += count
+            else:
+                nodes[node['type']] = {
+                    'count': count,
+                    'instance_type': node['instance_type'],
+                    'ami_id': node['ami_id'],
+                }
+        environments[env['name']] = {'code': env['code'], 'nodes': nodes}
+        for account_type in IAM_ACCOUNT_TYPES:
+            iam_users[f"{customer_code}-{env['code']}-{account_type}"] = env['name']
+        if config.get('use_aws_rds'):
+            databases[f"{customer_code}-{env['code']}-db"] = env['name']
+
+    return {
+        'environments': environments,
+        'ports': sorted(set(int(p) for p in config['allowed_ports'])),
+        'iam_users': iam_users,
+        'databases': databases,
+        'budget': f"{customer_code}-budget",
+    }
+
+def live_state(config):
+    """Describe what is currently deployed for the customer."""
+    customer_code = config['customer_code']
+    region = config['region']
+    ec2 = get_client('ec2', region)
+    iam = get_client('iam')
+    tagged = customer_filter(customer_code)
+
+    vpc = first_resource(ec2, 'describe_vpcs', 'Vpcs', Filters=tagged)
+    live = {
+        'vpc_id': vpc['VpcId'] if vpc else None,
+        'subnets': {},
+        'security_group_id': None,
+        'ip_permissions': [],
+        'instances': {},
+        'iam_users': [],
+        'databases': {},  # Identifier -> environment code
+        'db_subnet_group': None,
+        'budget': None,
+    }
+    if not live['vpc_id']:
+        return live
+
+    for subnet in iter_resources(ec2, 'describe_subnets', 'Subnets', Filters=tagged):
+        tags = {t['Key']: t['Value'] for t in subnet.get('Tags', [])}
+        if 'Environment' in tags:
+            live['subnets'][tags['Environment']] = {'subnet_id': subnet['SubnetId'], 'cidr': subnet['CidrBlock']}
+
+    group = first_resource(ec2, 'describe_security_groups', 'SecurityGroups', Filters=tagged + [
+        {'Name': 'group-name', 'Values': [f"{customer_code}-sg"]}
+    ])
+    if group:
+        live['security_group_id'] = group['GroupId']
+        live['ip_permissions'] = group.get('IpPermissions', [])
+
+    for instance in iter_resources(ec2, 'describe_instances', 'Reservations[].Instances[]', Filters=tagged + [
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+    ]):
+        tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+        key = (tags.get('Environment'), tags.get('Node'))
+        live['instances'].setdefault(key, []).append({
+            'instance_id': instance['InstanceId'],
+            'instance_type': instance['InstanceType'],
+            'ami_id': instance['ImageId'],
+        })
+
+    # IAM cannot filter users by name server-side; stream the pages instead of holding them
+    live['iam_users'] = [u['UserName'] for u in iter_resources(iam, 'list_users', 'Users')
+                         if u['UserName'].startswith(f"{customer_code}-")]
+
+    if config.get('use_aws_rds'):
+        rds = get_client('rds', region)
+        # Every database of the customer, so those of removed environments show up too
+        prefix = f"{customer_code.lower()}-"  # RDS lower-cases identifiers
+        for db in iter_resources(rds, 'describe_db_instances', 'DBInstances'):
+            identifier = db['DBInstanceIdentifier']
+            env_code = identifier[len(prefix):-len('-db')]
+            if identifier.startswith(prefix) and identifier.endswith('-db') and env_code.isdigit():
+                live['databases'][identifier] = env_code
+        try:
+            group = rds.describe_db_subnet_groups(
+                DBSubnetGroupName=f"{customer_code}_db_subnet_group")['DBSubnetGroups'][0]
+            live['db_subnet_group'] = {'name': group['DBSubnetGroupName'],
+                                       'subnet_ids': [s['SubnetIdentifier'] for s in group['Subnets']]}
+        except rds.exceptions.DBSubnetGroupNotFoundFault:
+            pass
+
+    budgets = get_client('budgets', region)
+    try:
+        budgets.describe_budget(AccountId=config['account_id'], BudgetName=f"{customer_code}-budget")
+        live['budget'] = f"{customer_code}-budget"
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NotFoundException':
+            raise
+
+    return live
+
+def _is_managed_iam_user(user_name, customer_code):
+    """True for <customer>-<env code>-<account type> users created by the onboarding."""
+    parts = user_name[len(customer_code) + 1:].split('-')
+    return len(parts) == 2 and parts[0].isdigit() and parts[1] in IAM_ACCOUNT_TYPES
+
+def compute_plan(config, desired, live):
+    """Return the minimal list of changes that brings the live state to the desired state."""
+    if not live['vpc_id']:
+        return [{'action': 'create_customer'}]
+
+    changes = []
+
+    # Subnets, one per environment
+    for env_name in desired['environments']:
+        if env_name not in live['subnets']:
+            changes.append({'action': 'create_subnet', 'environment': env_name})
+    for env_name, subnet in live['subnets'].items():
+        if env_name not in desired['environments']:
+            changes.append({'action': 'delete_subnet', 'environment': env_name, 'subnet_id': subnet['subnet_id']})
+
+    # Security group ingress: revoke rules that open unwanted ports, then add what is missing
+    if live['security_group_id']:
+        wanted = set(desired['ports'])
+        stale, kept = [], []
+        for permission in live['ip_permissions']:
+            ports = allowed_ports([permission])
+            if permission.get('IpProtocol') == 'tcp' and ports and not ports <= wanted:
+                # Revoke only the world-open range; rules for other CIDRs are left alone
+                stale.append({'IpProtocol': 'tcp', 'FromPort': permission['FromPort'], 'ToPort': permission['ToPort'],
+                              'IpRanges': [{'CidrIp': '0.0.0.0/0'}]})
+            else:
+                kept.append(permission)
+        if stale:
+            changes.append({'action': 'revoke_rules', 'security_group_id': live['security_group_id'],
+                            'permissions': stale,
+                            'ranges': [(p['FromPort'], p['ToPort']) for p in stale]})
+        missing = missing_port_ranges(desired['ports'], kept)
+        if missing:
+            changes.append({'action': 'authorize_ports', 'security_group_id': live['security_group_id'],
+                            'ranges': missing})
+
+    # Instances per (environment, node type)
+    for env_name, env in desired['environments'].items():
+        for node_type, node in env['nodes'].items():
+            running = live['instances'].get((env_name, node_type), [])
+            matching = [i for i in running if i['ami_id'] == node['ami_id']]
+            stale = [i['instance_id'] for i in running if i['ami_id'] != node['ami_id']]
+            if stale:
+                changes.append({'action': 'terminate', 'environment': env_name, 'node_type': node_type,
+                                'instance_ids': stale, 'reason': f"AMI changed to {node['ami_id']}"})
+            if len(matching) > node['count']:
+                extra = [i['instance_id'] for i in matching[node['count']:]]
+                matching = matching[:node['count']]
+                changes.append({'action': 'terminate', 'environment': env_name, 'node_type': node_type,
+                                'instance_ids': extra, 'reason': f"count reduced to {node['count']}"})
+            resize = [i['instance_id'] for i in matching if i['instance_type'] != node['instance_type']]
+            if resize:
+                changes.append({'action': 'resize', 'environment': env_name, 'node_type': node_type,
+                                'instance_ids': resize, 'instance_type': node['instance_type']})
+            if len(matching) < node['count']:
+                changes.append({'action': 'launch', 'environment': env_name, 'node_type': node_type,
+                                'count': node['count'] - len(matching), 'instance_type': node['instance_type'],
+                                'ami_id': node['ami_id']})
+    for (env_name, node_type), running in live['instances'].items():
+        env = desired['environments'].get(env_name)
+        if env is None or node_type not in env['nodes']:
+            changes.append({'action': 'terminate', 'environment': env_name, 'node_type': node_type,
+                            'instance_ids': [i['instance_id'] for i in running], 'reason': "no longer configured"})
+
+    # IAM users, grouped by environment for creation
+    customer_code = config['customer_code']
+    live_users = set(live['iam_users'])
+    for env_name in sorted({env for user, env in desired['iam_users'].items() if user not in live_users}):
+        changes.append({'action': 'create_iam_users', 'environment': env_name})
+    for user in sorted(live_users):
+        if user not in desired['iam_users'] and _is_managed_iam_user(user, customer_code):
+            changes.append({'action': 'delete_iam_user', 'user': user})
+
+    # Databases; a removed environment's database and its place in the DB subnet group go before its subnet
+    wanted_dbs = {db.lower() for db in desired['databases']}  # RDS lower-cases identifiers
+    for db_identifier, env_name in desired['databases'].items():
+        if db_identifier.lower() not in live['databases']:
+            changes.append({'action': 'create_database', 'environment': env_name, 'db_identifier': db_identifier})
+    removed_dbs = sorted(db for db in live['databases'] if db not in wanted_dbs)
+    for db_identifier in removed_dbs:
+        changes.append({'action': 'delete_database', 'db_identifier': db_identifier,
+                        'environment_code': live['databases'][db_identifier]})
+    group = live['db_subnet_group']
+    removed_subnets = {subnet['subnet_id'] for env_name, subnet in live['subnets'].items()
+                       if env_name not in desired['environments']}
+    if group and removed_subnets & set(group['subnet_ids']):
+        remaining = [subnet_id for subnet_id in group['subnet_ids'] if subnet_id not in removed_subnets]
+        if len(remaining) >= 2 or len(removed_dbs) < len(live['databases']):
+            changes.append({'action': 'update_db_subnet_group', 'name': group['name'], 'subnet_ids': remaining})
+        else:
+            # Too few subnets left for a subnet group and no database uses it; create_database recreates it
+            changes.append({'action': 'delete_db_subnet_group', 'name': group['name']})
+
+    if not live['budget']:
+        changes.append({'action': 'create_budget', 'budget': desired['budget']})
+
+    changes.sort(key=lambda change: ACTION_ORDER.index(change['action']))
+    return changes
+
+def describe_change(change):
+    """One-line, human readable description of a change."""
+    action = change['action']
+    if action == 'create_customer':
+        return "+ create the whole customer environment (nothing deployed yet)"
+    if action == 'create_subnet':
+        return f"+ create subnet for {change['environment']}"
+    if action == 'delete_subnet':
+        return f"- delete subnet {change['subnet_id']} ({change['environment']} is no longer configured)"
+    if action == 'revoke_rules':
+        return f"- revoke ingress {change['ranges']} on {change['security_group_id']}"
+    if action == 'authorize_ports':
+        return f"+ authorize ingress {change['ranges']} on {change['security_group_id']}"
+    if action == 'terminate':
+        return f"- terminate {change['node_type']} in {change['environment']}: {change['instance_ids']} ({change['reason']})"
+    if action == 'resize':
+        return f"~ resize {change['node_type']} in {change['environment']} to {change['instance_type']}: {change['instance_ids']}"
+    if action == 'launch':
+        return (f"+ launch {change['count']} x {change['instance_type']} {change['node_type']} "
+                f"in {change['environment']} from {change['ami_id']}")
+    if action == 'create_iam_users':
+        return f"+ create IAM users for {change['environment']}"
+    if action == 'delete_iam_user':
+        return f"- delete IAM user {change['user']}"
+    if action == 'create_database':
+        return f"+ create database {change['db_identifier']}"
+    if action == 'delete_database':
+        return (f"- delete database {change['db_identifier']} and its data "
+                f"(environment {change['environment_code']} is no longer configured)")
+    if action == 'update_db_subnet_group':
+        return f"~ set the subnets of DB subnet group {change['name']} to {change['subnet_ids']}"
+    if action == 'delete_db_subnet_group':
+        return f"- delete DB subnet group {change['name']}"
+    if action == 'create_budget':
+        return f"+ create budget {change['budget']}"
+    return f"? {change}"
+
+def print_plan(changes):
+    """Log the change set."""
+    if not changes:
+        log("Plan: no changes. The deployment matches Config.yaml.")
+        return
+    log(f"Plan: {len(changes)} change(s)")
+    for change in changes:
+        log(f"  {describe_change(change)}")
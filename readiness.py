@@ -0,0 +1,368 @@
+"""
+One readiness tracker for every resource the onboarding waits on.
+
+Instead of a blocking waiter per resource, callers register what they are
+waiting for with watch() and get a Future back:
+
+    tracker = get_tracker(region)
+    future = tracker.watch('db_instance', 'acme-1-db', READY_STATES['db_instance'],
+                           callback=lambda kind, resource_id, state: log(...))
+
+A single background thread polls on behalf of all watchers.  Each poll
+issues one filtered describe call per resource kind covering every pending
+ID of that kind, resolves the futures whose resource reached a target
+state (firing their callback first) and fails those that reached a failure
+state.  Every kind is polled on its own adaptive interval: it starts short,
+backs off while nothing changes and snaps back as soon as a state changes
+or a new resource is watched.
+
+A resource that the describe call no longer returns has the state None,
+so a target set containing None waits for deletion.
+"""
+import time
+import threading
+from concurrent.futures import Future, InvalidStateError, wait
+
+import botocore.exceptions
+
+from clients import current_credentials, get_client
+from listing import iter_resources
+from logs import carry_context, log
+
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 15
+POLL_BACKOFF = 1.5
+MAX_IDS_PER_CALL = 100
+
+# Kinds that are slow to change start further apart
+KIND_MIN_POLL_INTERVAL = {
+    'db_instance': 10,
+    'nat_gateway': 5,
+    'transit_gateway_attachment': 5,
+    'stack': 5,
+}
+
+# --- Probes: one describe call for many IDs, returning {resource id: state} ---
+
+def _probe_instances(client, ids):
+    instances = iter_resources(client, 'describe_instances', 'Reservations[].Instances[]',
+                               Filters=[{'Name': 'instance-id', 'Values': ids}])
+    return {i['InstanceId']: i['State']['Name'] for i in instances}
+
+def _probe_nat_gateways(client, ids):
+    nat_gateways = iter_resources(client, 'describe_nat_gateways', 'NatGateways',
+                                  Filter=[{'Name': 'nat-gateway-id', 'Values': ids}])
+    return {n['NatGatewayId']: n['State'] for n in nat_gateways}
+
+def _probe_transit_gateway_attachments(client, ids):
+    attachments = iter_resources(client, 'describe_transit_gateway_attachments', 'TransitGatewayAttachments',
+                                 Filters=[{'Name': 'transit-gateway-attachment-id', 'Values': ids}])
+    return {a['TransitGatewayAttachmentId']: a['State'] for a in attachments}
+
+def _probe_transit_gateways(client, ids):
+    tgws = iter_resources(client, 'describe_transit_gateways', 'TransitGateways',
+                          Filters=[{'Name': 'transit-gateway-id', 'Values': ids}])
+    return {tg['TransitGatewayId']: tg['State'] for tg in tgws}
+
+def _probe_network_interfaces(client, ids):
+    return {ni['NetworkInterfaceId']: ni['Status'] for ni in iter_resources(
+        client, 'describe_network_interfaces', 'NetworkInterfaces',
+        Filters=[{'Name': 'network-interface-id', 'Values': ids}])}
+
+def _probe_security_groups(client, ids):
+    return {sg['GroupId']: 'exists' for sg in iter_resources(
+        client, 'describe_security_groups', 'SecurityGroups', Filters=[{'Name': 'group-id', 'Values': ids}])}
+
+def _probe_route_tables(client, ids):
+    return {rt['RouteTableId']: 'exists' for rt in iter_resources(
+        client, 'describe_route_tables', 'RouteTables', Filters=[{'Name': 'route-table-id', 'Values': ids}])}
+
+def _probe_subnets(client, ids):
+    return {s['SubnetId']: s['State'] for s in iter_resources(
+        client, 'describe_subnets', 'Subnets', Filters=[{'Name': 'subnet-id', 'Values': ids}])}
+
+def _probe_internet_gateways(client, ids):
+    return {igw['InternetGatewayId']: 'exists' for igw in iter_resources(
+        client, 'describe_internet_gateways', 'InternetGateways',
+        Filters=[{'Name': 'internet-gateway-id', 'Values': ids}])}
+
+def _probe_vpcs(client, ids):
+    return {v['VpcId']: v['State'] for v in iter_resources(
+        client, 'describe_vpcs', 'Vpcs', Filters=[{'Name': 'vpc-id', 'Values': ids}])}
+
+def _probe_db_instances(client, ids):
+    requested = {i.lower(): i for i in ids}  # RDS stores identifiers in lower case
+    return {requested.get(db['DBInstanceIdentifier'], db['DBInstanceIdentifier']): db['DBInstanceStatus']
+            for db in iter_resources(client, 'describe_db_instances', 'DBInstances',
+                                     Filters=[{'Name': 'db-instance-id', 'Values': ids}])}
+
+def _probe_db_subnet_groups(client, ids):
+    # describe_db_subnet_groups takes one name and no filters
+    states = {}
+    for name in ids:
+        try:
+            group = client.describe_db_subnet_groups(DBSubnetGroupName=name)['DBSubnetGroups'][0]
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'DBSubnetGroupNotFoundFault':
+                continue
+            raise
+        states[name] = group.get('SubnetGroupStatus', 'Complete')
+    return states
+
+def _probe_stacks(client, ids):
+    # No filtered batch describe exists for stacks; ids are stack names
+    states = {}
+    for stack_name in ids:
+        try:
+            stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        except botocore.exceptions.ClientError as e:
+            if 'does not exist' in str(e):
+                continue  # Deleted
+            raise
+        states[stack_name] = stack['StackStatus']
+    return states
+
+def _probe_change_sets(client, ids):
+    return {change_set_id: client.describe_change_set(ChangeSetName=change_set_id)['Status'] for change_set_id in ids}
+
+# kind -> (service, probe)
+PROBES = {
+    'instance': ('ec2', _probe_instances),
+    'nat_gateway': ('ec2', _probe_nat_gateways),
+    'transit_gateway_attachment': ('ec2', _probe_transit_gateway_attachments),
+    'transit_gateway': ('ec2', _probe_transit_gateways),
+    'network_interface': ('ec2', _probe_network_interfaces),
+    'security_group': ('ec2', _probe_security_groups),
+    'route_table': ('ec2', _probe_route_tables),
+    'subnet': ('ec2', _probe_subnets),
+    'internet_gateway': ('ec2', _probe_internet_gateways),
+    'vpc': ('ec2', _probe_vpcs),
+    'db_instance': ('rds', _probe_db_instances),
+    'db_subnet_group': ('rds', _probe_db_subnet_groups),
+    'stack': ('cloudformation', _probe_stacks),
+    'change_set': ('cloudformation', _probe_change_sets),
+}
+
+# States that count as "deleted" for teardown
+GONE_STATES = {kind: {None} for kind in PROBES}
+GONE_STATES.update({
+    'instance': {'terminated', None},
+    'nat_gateway': {'deleted', None},
+    'transit_gateway_attachment': {'deleted', None},
+    'transit_gateway': {'deleted', None},
+    'stack': {'DELETE_COMPLETE', None},
+})
+
+# Target and failure states for resources being provisioned
+READY_STATES = {
+    'instance': {'running'},
+    'nat_gateway': {'available'},
+    'transit_gateway_attachment': {'available'},
+    'db_instance': {'available'},
+    'stack': {'CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE'},
+    'change_set': {'CREATE_COMPLETE'},
+}
+FAILED_STATES = {
+    'instance': {'shutting-down', 'terminated'},  # Not None: a new instance may not be listed yet
+    'nat_gateway': {'failed', 'deleting', 'deleted'},
+    'transit_gateway_attachment': {'failed', 'rejected', 'deleting', 'deleted'},
+    'db_instance': {'failed', 'incompatible-parameters', 'incompatible-network', 'incompatible-restore',
+                    'storage-full', 'inaccessible-encryption-credentials', 'deleting'},
+    # A rollback is a failure the moment it starts; CloudFormation finishes it on its own
+    'stack': {'CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+              'UPDATE_FAILED', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE',
+              'DELETE_IN_PROGRESS', 'DELETE_FAILED', 'DELETE_COMPLETE'},
+    'change_set': {'FAILED'},
+}
+
+class ResourceFailed(Exception):
+    """A watched resource reached one of its failure states."""
+
+class _Watch:
+    def __init__(self, kind, resource_id, targets, failures, callback, deadline):
+        self.kind = kind
+        self.resource_id = resource_id
+        self.targets = set(targets)
+        self.failures = set(failures) - self.targets
+        self.callback = carry_context(callback) if callback else None  # Log as the watcher's customer
+        self.deadline = deadline
+        self.state = ''  # Not polled yet
+        self.future = Future()
+
+class ReadinessTracker:
+    """Watch many resources of different kinds with batched, adaptive polling."""
+
+    def __init__(self, region, credentials):
+        self.region = region
+        self.credentials = credentials
+        self._condition = threading.Condition()
+        self._watches = {}    # kind -> [_Watch]
+        self._intervals = {}  # kind -> current poll interval
+        self._next_poll = {}  # kind -> monotonic time of the next poll
+        self._fresh = set()   # kinds with watches added since their last poll started
+        self._thread = None
+
+    def watch(self, kind, resource_id, targets, failures=(), callback=None, timeout=None):
+        """Start watching a resource and return a Future resolved with its target state.
+
+        callback(kind, resource_id, state) runs on the tracker thread the moment
+        the target state is seen, so it should only hand work off.  The future
+        fails with ResourceFailed on a failure state and TimeoutError after
+        timeout seconds.  Cancelling the future stops the watch.
+        """
+        if kind not in PROBES:
+            raise ValueError(f"No readiness probe for resource kind '{kind}'")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        entry = _Watch(kind, resource_id, targets, failures, callback, deadline)
+        with self._condition:
+            self._watches.setdefault(kind, []).append(entry)
+            self._intervals[kind] = KIND_MIN_POLL_INTERVAL.get(kind, MIN_POLL_INTERVAL)
+            self._next_poll[kind] = time.monotonic()  # Look right away; the resource may already be there
+            self._fresh.add(kind)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"readiness-{self.region}", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return entry.future
+
+    def pending(self):
+        """Return {kind: [resource id]} of the resources still being watched."""
+        with self._condition:
+            return {kind: [w.resource_id for w in watches] for kind, watches in self._watches.items() if watches}
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            # Never leave a waiter blocked on a watch that nothing polls any more
+            log(f"Readiness tracker for {self.region} stopped: {e}")
+            with self._condition:
+                watches = [w for kind_watches in self._watches.values() for w in kind_watches]
+                self._watches.clear()
+                self._intervals.clear()
+                self._next_poll.clear()
+                self._fresh.clear()
+                self._thread = None
+            for entry in watches:
+                _settle(entry.future, exception=e)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                self._drop_finished()
+                if not self._watches:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [kind for kind in self._watches if self._next_poll[kind] <= now]
+                if not due:
+                    self._condition.wait(min(self._next_poll[kind] for kind in self._watches) - now)
+                    continue
+                batches = {kind: list(self._watches[kind]) for kind in due}
+                self._fresh.difference_update(due)
+
+            for kind, watches in batches.items():
+                changed = self._poll(kind, watches)
+                with self._condition:
+                    if kind not in self._watches:
+                        continue
+                    minimum = KIND_MIN_POLL_INTERVAL.get(kind, MIN_POLL_INTERVAL)
+                    interval = minimum if changed else min(MAX_POLL_INTERVAL, self._intervals[kind] * POLL_BACKOFF)
+                    self._intervals[kind] = interval
+                    if kind not in self._fresh:  # A watch added during the poll wants an immediate look
+                        self._next_poll[kind] = time.monotonic() + interval
+
+    def _drop_finished(self):
+        for kind in list(self._watches):
+            self._watches[kind] = [w for w in self._watches[kind] if not w.future.done()]
+            if not self._watches[kind]:
+                del self._watches[kind]
+                self._intervals.pop(kind, None)
+                self._next_poll.pop(kind, None)
+                self._fresh.discard(kind)
+
+    def _poll(self, kind, watches):
+        """Describe every watched resource of one kind and settle the ones that are done."""
+        service, probe = PROBES[kind]
+        ids = sorted({w.resource_id for w in watches})
+        states = {}
+        try:
+            client = get_client(service, self.region, self.credentials)
+            for start in range(0, len(ids), MAX_IDS_PER_CALL):
+                states.update(probe(client, ids[start:start + MAX_IDS_PER_CALL]))
+        except Exception as e:
+            log(f"Readiness check for {kind} failed, will retry: {e}")
+            now = time.monotonic()
+            for entry in watches:  # A check that keeps failing must still time out
+                if not entry.future.done() and entry.deadline is not None and now >= entry.deadline:
+                    _settle(entry.future, exception=TimeoutError(
+                        f"Timed out waiting for {kind} {entry.resource_id} (last check failed: {e})"))
+            return False
+
+        changed = False
+        now = time.monotonic()
+        for entry in watches:
+            state = states.get(entry.resource_id)
+            if state != entry.state:
+                changed = True
+                entry.state = state
+            if entry.future.done():
+                continue
+            if state in entry.targets:
+                if entry.callback:
+                    try:
+                        entry.callback(kind, entry.resource_id, state)
+                    except Exception as e:
+                        log(f"Readiness callback for {kind} {entry.resource_id} failed: {e}")
+                _settle(entry.future, result=state)
+            elif state in entry.failures:
+                _settle(entry.future, exception=ResourceFailed(f"{kind} {entry.resource_id} is {state or 'gone'}"))
+            elif entry.deadline is not None and now >= entry.deadline:
+                _settle(entry.future, exception=TimeoutError(
+                    f"Timed out waiting for {kind} {entry.resource_id} (last state: {state or 'gone'})"))
+        return changed
+
+def _settle(future, result=None, exception=None):
+    """Resolve a watch's future unless it is already done; the waiter may cancel it at any time."""
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass  # Cancelled between the check and the set
+
+_lock = threading.Lock()
+_trackers = {}
+
+def get_tracker(region, credentials=None):
+    """Return the shared tracker for a region and credentials label (default: the current one)."""
+    credentials = credentials or current_credentials()
+    with _lock:
+        key = (region, credentials)
+        if key not in _trackers:
+            _trackers[key] = ReadinessTracker(region, credentials)
+        return _trackers[key]
+
+def wait_until(region, kind, resource_ids, targets=None, failures=None, timeout=None, credentials=None):
+    """Block until every resource reaches a target state; returns {resource id: state}.
+
+    Defaults to READY_STATES/FAILED_STATES for the kind.  Each resource is
+    logged the moment it is ready, not when the slowest one is.
+    """
+    if not resource_ids:
+        return {}
+    tracker = get_tracker(region, credentials)
+    targets = READY_STATES[kind] if targets is None else targets
+    failures = FAILED_STATES.get(kind, ()) if failures is None else failures
+    started = time.monotonic()
+
+    def _ready(kind, resource_id, state):
+        log(f"{kind} {resource_id} is {state or 'gone'} after {time.monotonic() - started:.0f}s")
+
+    futures = {tracker.watch(kind, resource_id, targets, failures, callback=_ready, timeout=timeout): resource_id
+               for resource_id in resource_ids}
+    wait(futures)
+    return {resource_id: future.result() for future, resource_id in futures.items()}
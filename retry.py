@@ -0,0 +1,213 @@
+"""
+Central rate-limit and retry layer for every AWS client.
+
+install() hooks three botocore events on a client:
+
+* before-call: take a token from the bucket of the call's API family
+  (EC2 mutating, EC2 describe, IAM, RDS, other) so concurrent stages
+  share the account's request budget instead of tripping it.
+* needs-retry: on Throttling/RequestLimitExceeded, halve that family's
+  rate and retry with exponential backoff and full jitter.  Eventual
+  consistency errors (a user or VPC that was created a moment ago and is
+  not visible yet) are retried separately with a short, bounded backoff.
+* after-call: let the family's rate creep back up after successes.
+
+Other errors fall through to botocore's own retry handler.  Counters of
+calls, throttles and time spent waiting are kept per family and logged
+by log_retry_report().
+
+Buckets are kept per scope (the client's credentials label) as well as per
+family, because every AWS account has its own request budget.
+"""
+import time
+import random
+import threading
+from functools import partial
+
+from logs import log
+
+THROTTLING_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "SlowDown",
+    "PriorRequestNotComplete",
+}
+
+# Codes that mean "the resource you just created is not visible yet" on a
+# call that uses it.  They are only retried for operations that build on an
+# existing resource, never for Get/Describe/List/Delete where they are real answers.
+EVENTUAL_CONSISTENCY_CODES = {
+    "NoSuchEntity",
+    "InvalidVpcID.NotFound",
+    "InvalidSubnetID.NotFound",
+    "InvalidGroup.NotFound",
+    "InvalidInstanceID.NotFound",
+    "InvalidKeyPair.NotFound",
+    "DBSubnetGroupNotFoundFault",
+}
+READ_OR_DELETE_PREFIXES = ("Get", "Describe", "List", "Delete", "Terminate", "Detach", "Disassociate", "Remove")
+
+# Requests per second (sustained) and burst per API family
+DEFAULT_RATE_LIMITS = {
+    "ec2-mutating": (5, 10),
+    "ec2-describe": (20, 50),
+    "iam": (10, 15),
+    "rds": (5, 10),
+    "other": (10, 20),
+}
+
+MAX_THROTTLE_ATTEMPTS = 8
+MAX_CONSISTENCY_ATTEMPTS = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+MIN_RATE_FRACTION = 0.1  # A throttled family never drops below this share of its configured rate
+
+class TokenBucket:
+    """Thread-safe token bucket whose refill rate adapts to throttling."""
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until it is available. Returns the seconds waited."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # Reserve the token now so waiting callers queue fairly
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+_lock = threading.Lock()
+_buckets = {}
+_counters = {}
+_rate_limits = dict(DEFAULT_RATE_LIMITS)
+
+def configure_rate_limits(config):
+    """Override per-family (rate, burst) limits from Config.yaml's rate_limits section."""
+    with _lock:
+        for family, limits in (config.get('rate_limits') or {}).items():
+            rate = limits['rate'] if isinstance(limits, dict) else limits
+            burst = limits.get('burst', rate * 2) if isinstance(limits, dict) else rate * 2
+            _rate_limits[family] = (rate, burst)
+            for key in [key for key in _buckets if key[1] == family]:
+                del _buckets[key]
+
+def api_family(service_name, operation_name):
+    if service_name == 'ec2':
+        return 'ec2-describe' if operation_name.startswith(('Describe', 'Get', 'List')) else 'ec2-mutating'
+    if service_name in ('iam', 'rds'):
+        return service_name
+    return 'other'
+
+def _bucket(scope, family):
+    with _lock:
+        if (scope, family) not in _buckets:
+            _buckets[(scope, family)] = TokenBucket(*_rate_limits.get(family, _rate_limits['other']))
+            _counters.setdefault((scope, family), {'calls': 0, 'throttled': 0, 'consistency_retries': 0, 'waited': 0.0})
+        return _buckets[(scope, family)]
+
+def _count(scope, family, key, amount=1):
+    with _lock:
+        _counters[(scope, family)][key] += amount
+
+def _backoff(attempts):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempts)))
+
+def _before_call(model, scope=None, **kwargs):
+    family = api_family(model.service_model.service_name, model.name)
+    waited = _bucket(scope, family).acquire()
+    _count(scope, family, 'calls')
+    if waited:
+        _count(scope, family, 'waited', waited)
+
+def _after_call(model, http_response, parsed, scope=None, **kwargs):
+    if http_response is not None and http_response.status_code < 400:
+        _bucket(scope, api_family(model.service_model.service_name, model.name)).succeeded()
+
+def _needs_retry(response=None, operation=None, attempts=None, scope=None, **kwargs):
+    if response is None or operation is None:
+        return None  # Connection errors are left to botocore
+    code = response[1].get('Error', {}).get('Code')
+    if not code:
+        return None
+    family = api_family(operation.service_model.service_name, operation.name)
+
+    if code in THROTTLING_CODES:
+        bucket = _bucket(scope, family)
+        bucket.throttled()
+        _count(scope, family, 'throttled')
+        if attempts >= MAX_THROTTLE_ATTEMPTS:
+            log(f"Giving up on {operation.name} after {attempts} throttled attempts")
+            return False
+        bucket.acquire()
+        return _backoff(attempts)
+
+    if code in EVENTUAL_CONSISTENCY_CODES and not operation.name.startswith(READ_OR_DELETE_PREFIXES):
+        if attempts >= MAX_CONSISTENCY_ATTEMPTS:
+            return False
+        _count(scope, family, 'consistency_retries')
+        return min(MAX_DELAY, BASE_DELAY * attempts) + random.uniform(0, BASE_DELAY)
+
+    return None
+
+def install(client, scope=None):
+    """Attach the rate limiter and retry handlers to a client.
+
+    scope names the request budget the client draws from, normally its
+    credentials label, so clients for different accounts never share one.
+    """
+    events = client.meta.events
+    events.register('before-call', partial(_before_call, scope=scope), unique_id='qro-rate-limit')
+    events.register('after-call', partial(_after_call, scope=scope), unique_id='qro-rate-adapt')
+    # Run ahead of botocore's retry handler: the first non-None answer wins
+    events.register_first('needs-retry', partial(_needs_retry, scope=scope), unique_id='qro-retry')
+    return client
+
+def retry_counters(by_scope=False):
+    """Return a copy of the per-family counters, summed over scopes unless by_scope is set."""
+    with _lock:
+        if by_scope:
+            return {key: dict(counters) for key, counters in _counters.items()}
+        totals = {}
+        for (_, family), counters in _counters.items():
+            total = totals.setdefault(family, {'calls': 0, 'throttled': 0, 'consistency_retries': 0, 'waited': 0.0})
+            for key, value in counters.items():
+                total[key] += value
+        return totals
+
+def log_retry_report():
+    """Log how often each API family was called, throttled and delayed."""
+    counters_by_scope = retry_counters(by_scope=True)
+    several_scopes = len({scope for scope, _ in counters_by_scope}) > 1
+    for (scope, family), counters in sorted(counters_by_scope.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+        label = f"{family} [{scope}]" if several_scopes else family
+        log(f"API {label}: {counters['calls']} call(s), {counters['throttled']} throttled, "
+            f"{counters['consistency_retries']} consistency retries, {counters['waited']:.1f}s rate-limited")
+
+def reset_counters():
+    """Forget all counters and adapted rates (e.g. between benchmark scenarios)."""
+    with _lock:
+        _buckets.clear()
+        _counters.clear()
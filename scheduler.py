@@ -0,0 +1,213 @@
+"""
+Dependency-graph scheduler for the provisioning stages.
+
+Each stage declares the outputs it consumes (requires) and the output it
+produces (provides).  run_stages() builds a DAG from those declarations and
+runs every stage whose inputs are ready on a bounded worker pool, so
+independent stages (IAM, budgets, the VPC) overlap while dependent ones
+(EC2 and RDS need the subnets and security group) still wait for them.
+
+Given a checkpoint (checkpoint.py), stages it lists as completed are not
+run again: their journaled outputs are handed to the stages that need
+them, and every stage that completes is journaled in turn.
+
+Every finished stage is recorded in stage_history() with its start and end
+time, and critical_path() walks that history back from the last stage to
+finish, so a run can report which chain of stages set its wall time.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from logs import carry_context, current_context, current_customer, log, log_context
+
+_history_lock = threading.Lock()
+_history = []
+def current_stage():
+    """Return the name of the stage the calling code runs in, if any."""
+    return current_context('stage')
+
+def stage_context(name):
+    """Attribute everything run in this context (API calls, logs) to a stage."""
+    return log_context(stage=name)
+
+def _run_stage(name, func, kwargs):
+    with stage_context(name):
+        return func(**kwargs)
+
+class Stage:
+    """A unit of provisioning work with its declared inputs and output."""
+
+    def __init__(self, name, func, requires=(), provides=None, after=()):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)  # Output names passed to func as keyword arguments
+        self.provides = provides        # Output name the return value is stored under
+        self.after = list(after)        # Stages that must finish first without passing data
+
+def build_graph(stages):
+    """Return {stage name: set of stage names it depends on}, validating the DAG."""
+    names = set()
+    providers = {}
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        names.add(stage.name)
+        if stage.provides:
+            if stage.provides in providers:
+                raise ValueError(f"Output '{stage.provides}' is provided by both {providers[stage.provides]} and {stage.name}")
+            providers[stage.provides] = stage.name
+
+    graph = {}
+    for stage in stages:
+        deps = set()
+        for key in stage.requires:
+            if key not in providers:
+                raise ValueError(f"Stage {stage.name} requires '{key}' but no stage provides it")
+            deps.add(providers[key])
+        for name in stage.after:
+            if name not in names:
+                raise ValueError(f"Stage {stage.name} runs after unknown stage {name}")
+            deps.add(name)
+        graph[stage.name] = deps
+
+    # Kahn's algorithm: anything left over sits on a cycle
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    while True:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            break
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    if remaining:
+        raise ValueError(f"Dependency cycle between stages: {', '.join(sorted(remaining))}")
+
+    return graph
+
+def run_stages(stages, max_workers=4, checkpoint=None):
+    """Run stages concurrently in dependency order and return their outputs.
+
+    A stage whose dependency failed, or whose required input came back as
+    None, is skipped.  Every independent stage still runs; if any stage
+    failed or was skipped a RuntimeError naming them is raised at the end,
+    so a run that provisioned nothing is never reported as a success.
+    Stages already completed in checkpoint are reused instead of run.
+    """
+    graph = build_graph(stages)
+    by_name = {stage.name: stage for stage in stages}
+    order = [stage.name for stage in stages]
+    outputs = {}
+    done, failed, skipped = set(), set(), set()
+    running = {}
+    started = {}
+    timeline = []
+
+    def _submit_ready(pool):
+        progressed = True
+        while progressed:
+            progressed = False
+            for name in order:
+                if name in done or name in failed or name in skipped or name in started:
+                    continue
+                if checkpoint is not None and name in checkpoint.completed:
+                    if by_name[name].provides:
+                        outputs[by_name[name].provides] = checkpoint.completed[name]
+                    done.add(name)
+                    log(f"Stage {name} already completed, reusing its checkpointed output")
+                    progressed = True
+                    continue
+                deps = graph[name]
+                blocked = deps & (failed | skipped)
+                if blocked:
+                    log(f"Skipping stage {name}: depends on {', '.join(sorted(blocked))}")
+                    skipped.add(name)
+                    progressed = True
+                    continue
+                if not deps <= done:
+                    continue
+                stage = by_name[name]
+                kwargs = {key: outputs.get(key) for key in stage.requires}
+                missing = [key for key, value in kwargs.items() if value is None]
+                if missing:
+                    log(f"Skipping stage {name}: input {', '.join(missing)} unavailable")
+                    skipped.add(name)
+                    progressed = True
+                    continue
+                log(f"Starting stage: {name}")
+                started[name] = time.monotonic()
+                running[pool.submit(carry_context(_run_stage), name, stage.func, kwargs)] = name
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        _submit_ready(pool)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                finished_at = time.monotonic()
+                elapsed = finished_at - started[name]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log(f"Stage {name} failed after {elapsed:.1f}s: {e}")
+                    failed.add(name)
+                    timeline.append(_record(name, started[name], finished_at, 'failed', graph[name]))
+                    continue
+                timeline.append(_record(name, started[name], finished_at, 'completed', graph[name]))
+                if by_name[name].provides:
+                    outputs[by_name[name].provides] = result
+                if checkpoint is not None:
+                    checkpoint.record(name, result)
+                done.add(name)
+                log(f"Stage {name} completed in {elapsed:.1f}s")
+            _submit_ready(pool)
+
+    path = critical_path(timeline)
+    if path:
+        log("Critical path: " + " -> ".join(f"{entry['name']} ({entry['seconds']:.1f}s)" for entry in path))
+    if failed or skipped:
+        problems = [f"{label}: {', '.join(sorted(names))}"
+                    for label, names in (("failed", failed), ("skipped", skipped)) if names]
+        raise RuntimeError(f"Provisioning stages {'; '.join(problems)}")
+    return outputs
+
+def _record(name, started, finished, status, depends_on):
+    entry = {
+        'name': name,
+        'started': started,
+        'finished': finished,
+        'seconds': finished - started,
+        'status': status,
+        'depends_on': sorted(depends_on),
+        'customer': current_customer(),
+    }
+    with _history_lock:
+        _history.append(entry)
+    return dict(entry)
+
+def stage_history():
+    """Return the timing record of every stage run in this process (monotonic clock)."""
+    with _history_lock:
+        return [dict(entry) for entry in _history]
+
+def clear_stage_history():
+    with _history_lock:
+        _history.clear()
+
+def critical_path(history):
+    """Return the chain of stages that determined when the last stage finished.
+
+    Starting from the stage that finished last, repeatedly step to the
+    dependency that finished last; stages off this chain had slack.
+    """
+    if not history:
+        return []
+    by_name = {entry['name']: entry for entry in history}
+    entry = max(history, key=lambda e: e['finished'])
+    path = []
+    while entry is not None:
+        path.append(entry)
+        dependencies = [by_name[name] for name in entry['depends_on'] if name in by_name]
+        entry = max(dependencies, key=lambda e: e['finished']) if dependencies else None
+    return path[::-1]
@@ -1,28 +1,20 @@
-import boto3
+import argparse
 import botocore.exceptions
-import subprocess
-import platform
-import os
-import time
-import logging
-from datetime import datetime
 
-# Configure logging
-logging.basicConfig(
-    filename="aws_connection_setup.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger()
+from clients import get_client
+from listing import first_resource
+from logs import log
 
-def log(message):
-    """Log messages with a timestamp."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
-    logger.info(message)
+METRICS_NAMESPACE = "QlikSenseOnboarding"
 
 def install_aws_cli():
-    """Install the AWS CLI if not already installed."""
+    """Install the AWS CLI if not already installed.
+
+    The onboarding scripts only use boto3, so this is opt-in (--install-cli)
+    for operators who want the CLI for manual work.
+    """
+    import platform
+    import subprocess
     try:
         subprocess.run(["aws", "--version"], check=True)
         log("AWS CLI is already installed.")
@@ -48,7 +40,7 @@ def install_aws_cli():
 def validate_aws_credentials():
     """Validate AWS credentials."""
     try:
-        sts = boto3.client('sts')
+        sts = get_client('sts')
         response = sts.get_caller_identity()
         log(f"Validated AWS credentials for account: {response['Account']}")
     except botocore.exceptions.NoCredentialsError:
@@ -60,9 +52,10 @@ def validate_aws_credentials():
 
 def validate_cloudwatch_connection(region):
     """Validate connection to CloudWatch."""
-    cloudwatch = boto3.client('cloudwatch', region_name=region)
+    cloudwatch = get_client('cloudwatch', region)
     try:
-        cloudwatch.list_metrics()
+        # One small page of our own namespace is enough to prove the connection
+        first_resource(cloudwatch, 'list_metrics', 'Metrics', Namespace=METRICS_NAMESPACE)
         log(f"Successfully connected to CloudWatch in region {region}.")
     except botocore.exceptions.EndpointConnectionError:
         log("Failed to connect to CloudWatch endpoint.")
@@ -71,13 +64,17 @@ def validate_cloudwatch_connection(region):
         log(f"Unexpected error while connecting to CloudWatch: {e}")
         raise
 
-def setup_aws_connection(region):
+def setup_aws_connection(region, install_cli=False):
     """Set up and validate all AWS connection requirements."""
-    install_aws_cli()
+    if install_cli:
+        install_aws_cli()
     validate_aws_credentials()
     validate_cloudwatch_connection(region)
     log("AWS connection setup complete.")
 
 if __name__ == "__main__":
-    REGION = "us-east-1"  # Specify your AWS region
-    setup_aws_connection(REGION)
+    parser = argparse.ArgumentParser(description="Validate the AWS connection used by the onboarding scripts")
+    parser.add_argument('--region', default="us-east-1", help="AWS region to validate")
+    parser.add_argument('--install-cli', action='store_true', help="Also install the AWS CLI if it is missing")
+    args = parser.parse_args()
+    setup_aws_connection(args.region, args.install_cli)
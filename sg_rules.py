@@ -0,0 +1,86 @@
+"""
+Security group ingress rule compiler.
+
+Turns the allowed_ports list from Config.yaml into the smallest set of
+port ranges, removes whatever the group already allows and authorizes
+the remainder in batched authorize_security_group_ingress calls, so a
+customer's 47 ports cost one API call instead of 47 and a re-run does not
+fail on duplicate rules.
+"""
+import botocore.exceptions
+
+from logs import log
+
+# Rules per authorize call; the default quota is 60 inbound rules per security group
+MAX_PERMISSIONS_PER_CALL = 60
+
+def merge_port_ranges(ports):
+    """Sort ports and merge contiguous ones into (from_port, to_port) ranges."""
+    ranges = []
+    for port in sorted(set(int(p) for p in ports)):
+        if ranges and port == ranges[-1][1] + 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    return [tuple(r) for r in ranges]
+
+def build_ip_permissions(port_ranges, cidr="0.0.0.0/0", protocol="tcp"):
+    """Build the IpPermissions payload for a list of port ranges."""
+    return [
+        {
+            'IpProtocol': protocol,
+            'FromPort': from_port,
+            'ToPort': to_port,
+            'IpRanges': [{'CidrIp': cidr}]
+        }
+        for from_port, to_port in port_ranges
+    ]
+
+def allowed_ports(ip_permissions, cidr="0.0.0.0/0", protocol="tcp"):
+    """Return the set of ports an existing rule set already opens to a CIDR."""
+    ports = set()
+    for permission in ip_permissions:
+        if permission.get('IpProtocol') == '-1' and any(r.get('CidrIp') == cidr for r in permission.get('IpRanges', [])):
+            return set(range(0, 65536))  # All traffic is already allowed
+        if permission.get('IpProtocol') != protocol:
+            continue
+        if not any(r.get('CidrIp') == cidr for r in permission.get('IpRanges', [])):
+            continue
+        ports.update(range(permission['FromPort'], permission['ToPort'] + 1))
+    return ports
+
+def missing_port_ranges(ports, ip_permissions, cidr="0.0.0.0/0", protocol="tcp"):
+    """Merged port ranges from ports that the existing rules do not already cover."""
+    covered = allowed_ports(ip_permissions, cidr, protocol)
+    return merge_port_ranges(p for p in ports if int(p) not in covered)
+
+def apply_ingress_rules(ec2, group_id, ports, cidr="0.0.0.0/0", protocol="tcp", existing=None):
+    """Authorize only the missing ingress ranges on a security group.
+
+    existing may carry the group's current IpPermissions to skip the
+    describe call (e.g. for a group that was just created and is empty).
+    Returns the port ranges that were added.
+    """
+    if existing is None:
+        existing = ec2.describe_security_groups(GroupIds=[group_id])['SecurityGroups'][0].get('IpPermissions', [])
+    delta = missing_port_ranges(ports, existing, cidr, protocol)
+    if not delta:
+        log(f"Security Group {group_id} already allows all configured ports.")
+        return []
+
+    permissions = build_ip_permissions(delta, cidr, protocol)
+    for start in range(0, len(permissions), MAX_PERMISSIONS_PER_CALL):
+        batch = permissions[start:start + MAX_PERMISSIONS_PER_CALL]
+        try:
+            ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=batch)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+                raise
+            # Someone added an overlapping rule since we looked; re-diff this batch and retry once
+            current = ec2.describe_security_groups(GroupIds=[group_id])['SecurityGroups'][0].get('IpPermissions', [])
+            batch_ports = [p for perm in batch for p in range(perm['FromPort'], perm['ToPort'] + 1)]
+            retry = build_ip_permissions(missing_port_ranges(batch_ports, current, cidr, protocol), cidr, protocol)
+            if retry:
+                ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=retry)
+    log(f"Authorized {len(delta)} port range(s) on Security Group {group_id}: {delta}")
+    return delta
@@ -0,0 +1,369 @@
+"""
+CloudFormation-native provisioning: the whole customer as one stack.
+
+With provisioning_mode: cloudformation in Config.yaml (or --mode
+cloudformation), deploy builds a single template from the configuration
+up front: VPC, subnets, the security group with merged port ranges, the
+TGW attachment, every instance, the RDS subnet group and databases, the
+IAM users and the budget.  That template is deployed with one change
+set, and CloudFormation does the dependency ordering and parallelism
+server-side, so provisioning is a handful of API calls.  Re-running deploy
+updates the stack in place through a change set, and teardown is a
+single delete_stack.
+
+    template = build_template(config)
+    outputs = deploy_stack(config)        # {'vpc_resources': ..., 'instances': ..., 'databases': ...}
+
+IAM passwords are generated into Secrets Manager (<customer>/<user>)
+instead of being logged, and the database password is passed as a NoEcho
+parameter, so neither ends up in the template.  The key pair stays outside
+the stack so its private key is written locally as in the API mode.
+"""
+import re
+import json
+import datetime
+
+import metadata_cache
+import manifest
+from clients import get_client
+from iam_engine import iam_principals, user_tags
+from logs import log
+from readiness import wait_until
+from sg_rules import merge_port_ranges
+from tags import build_tags
+
+STACK_NAME_FORMAT = "{customer_code}-onboarding"
+STACK_TIMEOUT = 3600  # Seconds; RDS instances dominate stack creation
+MAX_TEMPLATE_BODY = 51200  # Larger templates must be uploaded to S3
+CAPABILITIES = ['CAPABILITY_NAMED_IAM']  # The IAM users have fixed names
+NO_CHANGES_REASONS = ("didn't contain changes", "No updates are to be performed")
+
+def stack_name(config):
+    return STACK_NAME_FORMAT.format(customer_code=config['customer_code'])
+
+def logical_id(*parts):
+    """CloudFormation logical IDs are alphanumeric; build one from free-form names."""
+    return ''.join(re.sub(r'[^A-Za-z0-9]', '', str(part).title()) for part in parts)
+
+def subnet_id_key(env_name):
+    return logical_id('Subnet', env_name)
+
+def instance_key(env_name, node_type, index):
+    return logical_id('Instance', env_name, node_type, index)
+
+def database_key(env_code):
+    return logical_id('Database', env_code)
+
+def _network_resources(config, resources):
+    customer_code = config['customer_code']
+    zones = metadata_cache.availability_zones(config['region'])
+    resources['VPC'] = {
+        'Type': 'AWS::EC2::VPC',
+        'Properties': {
+            'CidrBlock': "192.168.0.0/16",
+            'Tags': build_tags(customer_code, name=f"{customer_code}-vpc"),
+        },
+    }
+    for i, env in enumerate(config['environments']):
+        resources[subnet_id_key(env['name'])] = {
+            'Type': 'AWS::EC2::Subnet',
+            'Properties': {
+                'VpcId': {'Ref': 'VPC'},
+                'CidrBlock': f"192.168.{i}.0/24",
+                'AvailabilityZone': zones[i % len(zones)],  # Round-robin, as in the API mode
+                'Tags': build_tags(customer_code, environment=env['name']),
+            },
+        }
+    subnets = [{'Ref': subnet_id_key(env['name'])} for env in config['environments']]
+    resources['TransitGatewayAttachment'] = {
+        'Type': 'AWS::EC2::TransitGatewayAttachment',
+        'Properties': {
+            'TransitGatewayId': config['transit_gateway_id'],
+            'VpcId': {'Ref': 'VPC'},
+            'SubnetIds': subnets,
+            'Tags': build_tags(customer_code),
+        },
+    }
+    resources['SecurityGroup'] = {
+        'Type': 'AWS::EC2::SecurityGroup',
+        'Properties': {
+            'GroupName': f"{customer_code}-sg",
+            'GroupDescription': "Customer Security Group",
+            'VpcId': {'Ref': 'VPC'},
+            'SecurityGroupIngress': [
+                {'IpProtocol': 'tcp', 'FromPort': from_port, 'ToPort': to_port, 'CidrIp': "0.0.0.0/0"}
+                for from_port, to_port in merge_port_ranges(config['allowed_ports'])
+            ],
+            'Tags': build_tags(customer_code),
+        },
+    }
+
+def _instance_resources(config, key_name, resources):
+    customer_code = config['customer_code']
+    for env in config['environments']:
+        for node in env['nodes']:
+            if 'instance_type' not in node or 'ami_id' not in node:
+                raise ValueError(f"Missing 'instance_type' or 'ami_id' for {node['type']} in {env['name']}")
+            for index in range(1, int(node.get('count', 1)) + 1):
+                resources[instance_key(env['name'], node['type'], index)] = {
+                    'Type': 'AWS::EC2::Instance',
+                    'Properties': {
+                        'ImageId': node['ami_id'],
+                        'InstanceType': node['instance_type'],
+                        'KeyName': key_name,
+                        'SubnetId': {'Ref': subnet_id_key(env['name'])},
+                        'SecurityGroupIds': [{'Ref': 'SecurityGroup'}],
+                        'Tags': build_tags(customer_code, environment=env['name'], node_type=node['type']),
+                    },
+                }
+
+def _database_resources(config, resources):
+    customer_code = config['customer_code']
+    resources['DBSubnetGroup'] = {
+        'Type': 'AWS::RDS::DBSubnetGroup',
+        'Properties': {
+            'DBSubnetGroupName': f"{customer_code}_db_subnet_group",
+            'DBSubnetGroupDescription': f"DB Subnet Group for {customer_code}",
+            'SubnetIds': [{'Ref': subnet_id_key(env['name'])} for env in config['environments']],
+            'Tags': build_tags(customer_code),
+        },
+    }
+    for env in config['environments']:
+        properties = {
+            'DBInstanceIdentifier': f"{customer_code}-{env['code']}-db",
+            'DBInstanceClass': config.get('db_instance_class', 'db.t3.micro'),
+            'MasterUserPassword': {'Ref': 'DBPassword'},
+            'VPCSecurityGroups': [{'Ref': 'SecurityGroup'}],
+            'DBSubnetGroupName': {'Ref': 'DBSubnetGroup'},
+            'Tags': build_tags(customer_code, environment=env['code']),
+        }
+        snapshot = env.get('db_snapshot_identifier', config.get('db_snapshot_identifier'))
+        if snapshot:
+            # Engine, storage and master user come from the pre-seeded repository snapshot
+            properties['DBSnapshotIdentifier'] = snapshot
+        else:
+            properties.update({'AllocatedStorage': '20', 'Engine': 'postgres', 'MasterUsername': {'Ref': 'DBUsername'}})
+        resources[database_key(env['code'])] = {
+            'Type': 'AWS::RDS::DBInstance',
+            'DeletionPolicy': 'Delete',  # Teardown removes customers completely, as in the API mode
+            'Properties': properties,
+        }
+
+def _iam_resources(config, resources):
+    # The same groups, policies and users as the API mode (iam_engine.py)
+    customer_code = config['customer_code']
+    principals = iam_principals(config)
+    group_ids = {}
+    for name, group in principals['groups'].items():
+        properties = {'GroupName': name}
+        if group['policy']:
+            properties['Policies'] = [{'PolicyName': f"{name}-policy", 'PolicyDocument': json.loads(group['policy'])}]
+        if group['managed_policy']:
+            properties['ManagedPolicyArns'] = [group['managed_policy']]
+        group_ids[name] = logical_id('Group', group['account_type'])
+        resources[group_ids[name]] = {'Type': 'AWS::IAM::Group', 'Properties': properties}
+    for user_name, user in principals['users'].items():
+        secret = logical_id('Password', user['env_code'], user['account_type'])
+        resources[secret] = {
+            'Type': 'AWS::SecretsManager::Secret',
+            'Properties': {
+                'Name': f"{customer_code}/{user_name}",
+                'Description': f"Console password of IAM user {user_name}",
+                'GenerateSecretString': {
+                    'SecretStringTemplate': json.dumps({'username': user_name}),
+                    'GenerateStringKey': 'password',
+                    'PasswordLength': 20,
+                },
+                'Tags': build_tags(customer_code, environment=user['env_code']),
+            },
+        }
+        resources[logical_id('User', user['env_code'], user['account_type'])] = {
+            'Type': 'AWS::IAM::User',
+            'Properties': {
+                'UserName': user_name,
+                'Groups': [{'Ref': group_ids[user['group']]}],
+                'LoginProfile': {
+                    'Password': {'Fn::Sub': f"{{{{resolve:secretsmanager:${{{secret}}}:SecretString:password}}}}"},
+                    'PasswordResetRequired': True,
+                },
+                'Tags': user_tags(customer_code, user['env_code'], user['account_type']),
+            },
+        }
+
+def _budget_resource(config, resources):
+    resources['Budget'] = {
+        'Type': 'AWS::Budgets::Budget',
+        'Properties': {
+            'Budget': {
+                'BudgetName': f"{config['customer_code']}-budget",
+                'BudgetLimit': {'Amount': 1000, 'Unit': 'USD'},
+                'TimeUnit': 'MONTHLY',
+                'BudgetType': 'COST',
+                'CostTypes': {'IncludeTax': True, 'IncludeSubscription': True, 'UseBlended': False},
+            },
+            'NotificationsWithSubscribers': [{
+                'Notification': {
+                    'NotificationType': 'ACTUAL',
+                    'ComparisonOperator': 'GREATER_THAN',
+                    'Threshold': 80,
+                    'ThresholdType': 'PERCENTAGE',
+                },
+                'Subscribers': [{'SubscriptionType': 'EMAIL', 'Address': 'billing@example.com'}],
+            }],
+        },
+    }
+
+def build_template(config, key_name=None):
+    """Build the CloudFormation template for the customer's whole deployment from the configuration."""
+    key_name = key_name or f"{config['customer_code']}-key"
+    resources = {}
+    _network_resources(config, resources)
+    _instance_resources(config, key_name, resources)
+    if config.get('use_aws_rds'):
+        _database_resources(config, resources)
+    _iam_resources(config, resources)
+    _budget_resource(config, resources)
+
+    outputs = {key: {'Value': {'Ref': key}} for key, resource in resources.items()
+               if resource['Type'] in ('AWS::EC2::VPC', 'AWS::EC2::Subnet', 'AWS::EC2::SecurityGroup',
+                                       'AWS::EC2::TransitGatewayAttachment', 'AWS::EC2::Instance',
+                                       'AWS::RDS::DBInstance')}
+    return {
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Description': f"Qlik Sense on-premise onboarding for customer {config['customer_code']}",
+        'Parameters': {
+            'DBUsername': {'Type': 'String', 'Default': str(config.get('db_username', 'admin'))},
+            'DBPassword': {'Type': 'String', 'NoEcho': True},
+        },
+        'Resources': resources,
+        'Outputs': outputs,
+    }
+
+def stack_outputs(config, outputs):
+    """Translate stack outputs back into the shapes the API mode's stages return."""
+    vpc_resources = {
+        'vpc_id': outputs.get('VPC'),
+        'subnets': {env['name']: outputs.get(subnet_id_key(env['name'])) for env in config['environments']},
+        'security_group_id': outputs.get('SecurityGroup'),
+        'transit_gateway_attachment_id': outputs.get('TransitGatewayAttachment'),
+    }
+    instances = {}
+    for env in config['environments']:
+        for node in env['nodes']:
+            for index in range(1, int(node.get('count', 1)) + 1):
+                instance_id = outputs.get(instance_key(env['name'], node['type'], index))
+                if instance_id:
+                    instances.setdefault(env['name'], {}).setdefault(node['type'], []).append(instance_id)
+    databases = [outputs[database_key(env['code'])] for env in config['environments']
+                 if database_key(env['code']) in outputs]
+    return {'vpc_resources': vpc_resources, 'instances': instances, 'databases': databases}
+
+def _template_source(config, template):
+    """TemplateBody for small templates; larger ones are uploaded to the customer's bucket."""
+    body = json.dumps(template, separators=(',', ':'))
+    if len(body) <= MAX_TEMPLATE_BODY:
+        return {'TemplateBody': body}
+    bucket = config['mainhost_bucket']
+    key = f"cloudformation/{stack_name(config)}.json"
+    get_client('s3', config['region']).put_object(Bucket=bucket, Key=key, Body=body.encode())
+    log(f"Template is {len(body)} bytes; uploaded to s3://{bucket}/{key}")
+    return {'TemplateURL': f"https://{bucket}.s3.{config['region']}.amazonaws.com/{key}"}
+
+def _describe_stack(cloudformation, name):
+    try:
+        return cloudformation.describe_stacks(StackName=name)['Stacks'][0]
+    except cloudformation.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            return None
+        raise
+
+def create_change_set(config, template):
+    """Create a change set for the customer's stack; returns (change set id, type, status reason)."""
+    cloudformation = get_client('cloudformation', config['region'])
+    name = stack_name(config)
+    stack = _describe_stack(cloudformation, name)
+    if stack and stack['StackStatus'] == 'ROLLBACK_COMPLETE':
+        # A stack whose creation failed can only be deleted
+        log(f"Stack {name} failed to create earlier; deleting it first")
+        delete_stack(config['region'], name, config.get('stack_timeout', STACK_TIMEOUT))
+        stack = None
+    change_set_type = 'UPDATE' if stack and stack['StackStatus'] != 'REVIEW_IN_PROGRESS' else 'CREATE'
+
+    change_set = cloudformation.create_change_set(
+        StackName=name,
+        ChangeSetName=f"{name}-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}",
+        ChangeSetType=change_set_type,
+        Parameters=[
+            {'ParameterKey': 'DBUsername', 'ParameterValue': str(config.get('db_username', 'admin'))},
+            {'ParameterKey': 'DBPassword', 'ParameterValue': str(config.get('db_password', ''))},
+        ],
+        Capabilities=CAPABILITIES,
+        Tags=build_tags(config['customer_code']),  # Propagated to every taggable resource in the stack
+        **_template_source(config, template)
+    )
+    if change_set_type == 'CREATE':
+        manifest.record(config['customer_code'], 'stack', name)
+
+    wait_until(config['region'], 'change_set', [change_set['Id']], targets={'CREATE_COMPLETE', 'FAILED'},
+               failures=(), timeout=config.get('readiness_timeout', STACK_TIMEOUT))
+    described = cloudformation.describe_change_set(ChangeSetName=change_set['Id'])
+    if described['Status'] == 'FAILED':
+        reason = described.get('StatusReason', '')
+        cloudformation.delete_change_set(ChangeSetName=change_set['Id'])
+        if any(text in reason for text in NO_CHANGES_REASONS):
+            return None, change_set_type, described
+        raise RuntimeError(f"Change set for stack {name} failed: {reason}")
+    return change_set['Id'], change_set_type, described
+
+def deploy_stack(config, key_name=None):
+    """Create or update the customer's stack and return its outputs in the API mode's shapes."""
+    cloudformation = get_client('cloudformation', config['region'])
+    name = stack_name(config)
+    if not metadata_cache.transit_gateway(config['region'], config['transit_gateway_id']):
+        raise ValueError(f"Transit Gateway {config['transit_gateway_id']} does not exist")
+
+    template = build_template(config, key_name)
+    log(f"Deploying stack {name} with {len(template['Resources'])} resources")
+    change_set_id, change_set_type, described = create_change_set(config, template)
+    if change_set_id is None:
+        log(f"Stack {name} is already up to date")
+    else:
+        log(f"Executing {change_set_type.lower()} change set with {len(described.get('Changes', []))} change(s)")
+        cloudformation.execute_change_set(ChangeSetName=change_set_id)
+        wait_until(config['region'], 'stack', [name], timeout=config.get('stack_timeout', STACK_TIMEOUT))
+        log(f"Stack {name} deployed")
+
+    stack = _describe_stack(cloudformation, name)
+    return stack_outputs(config, {o['OutputKey']: o['OutputValue'] for o in stack.get('Outputs', [])})
+
+def plan_stack(config, key_name=None):
+    """Show what a deploy would change, using a change set that is deleted afterwards."""
+    cloudformation = get_client('cloudformation', config['region'])
+    name = stack_name(config)
+    template = build_template(config, key_name)
+    stack = _describe_stack(cloudformation, name)
+    if not stack or stack['StackStatus'] in ('ROLLBACK_COMPLETE', 'REVIEW_IN_PROGRESS'):
+        log(f"Stack {name} does not exist; deploy would create {len(template['Resources'])} resources")
+        return [{'Action': 'Add', 'LogicalResourceId': key, 'ResourceType': resource['Type']}
+                for key, resource in template['Resources'].items()]
+
+    change_set_id, _, described = create_change_set(config, template)
+    if change_set_id is None:
+        log(f"Stack {name} is up to date; nothing to change.")
+        return []
+    changes = [change['ResourceChange'] for change in described.get('Changes', [])]
+    cloudformation.delete_change_set(ChangeSetName=change_set_id)
+    log(f"{len(changes)} change(s) to stack {name}:")
+    for change in changes:
+        replacement = " (replacement)" if change.get('Replacement') == 'True' else ""
+        log(f"  {change['Action']} {change['LogicalResourceId']} ({change['ResourceType']}){replacement}")
+    return changes
+
+def delete_stack(region, name, timeout=STACK_TIMEOUT):
+    """Delete a stack and wait until it is gone."""
+    cloudformation = get_client('cloudformation', region)
+    cloudformation.delete_stack(StackName=name)
+    log(f"Deleting stack {name}")
+    wait_until(region, 'stack', [name], targets={'DELETE_COMPLETE', None}, failures={'DELETE_FAILED'},
+               timeout=timeout)
+    log(f"Deleted stack {name}")
@@ -0,0 +1,28 @@
+"""
+Shared tag builder for every resource the onboarding creates.
+
+All resources carry a Customer tag (teardown finds them through
+tag:Customer), plus Environment, Node and Name where they apply.  Use
+tag_specifications() so the tags are applied by the create call itself
+and no resource ever exists untagged.
+"""
+
+def build_tags(customer_code, environment=None, node_type=None, name=None):
+    """Return the tag list for a resource owned by a customer."""
+    tags = [{'Key': 'Customer', 'Value': customer_code}]
+    if environment is not None:
+        tags.append({'Key': 'Environment', 'Value': environment})
+    if node_type is not None:
+        tags.append({'Key': 'Node', 'Value': node_type})
+    if name is not None:
+        tags.append({'Key': 'Name', 'Value': name})
+    return tags
+
+def tag_specifications(resource_type, customer_code, environment=None, node_type=None, name=None):
+    """Return a TagSpecifications list for an EC2 create call."""
+    return [
+        {
+            'ResourceType': resource_type,
+            'Tags': build_tags(customer_code, environment, node_type, name)
+        }
+    ]
@@ -0,0 +1,573 @@
+"""
+Dependency-ordered, parallel teardown of a customer's AWS resources.
+
+Resources are deleted in waves that follow the EC2 dependency chain:
+
+    TGW attachments / instances / NAT gateways / RDS instances
+      -> network interfaces
+      -> security groups / route tables / DB subnet groups
+      -> subnets / internet gateways / transit gateways
+      -> VPCs
+
+Resources come from the customer's deployment manifest (manifest.py) or,
+for customers without one, a single paginated tag inventory scan
+(inventory.py).  Every resource in a wave is deleted in parallel on a
+bounded pool.  The wave then watches its resources through the shared
+readiness tracker (readiness.py) until they are actually gone (terminated,
+deleted or no longer listed) and moves on the moment they are, retrying
+deletes that were rejected because something they depend on was still
+detaching.  IAM users and groups, budgets, launch templates and the key
+pair have no network dependencies and are removed alongside the first wave.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import botocore.exceptions
+
+import manifest
+import metadata_cache
+from checkpoint import clear_checkpoint
+from clients import get_client
+from iam_engine import IAM_ACCOUNT_TYPES, group_name
+from inventory import scan_tagged_resources
+from listing import customer_filter, iter_resources
+from logs import carry_context, log
+from readiness import GONE_STATES, get_tracker
+from stacks import STACK_TIMEOUT, delete_stack, stack_name
+from scheduler import stage_context
+
+# Error codes meaning "something still depends on this resource, try again shortly"
+RETRYABLE_CODES = {
+    "DependencyViolation",
+    "IncorrectState",
+    "InvalidNetworkInterface.InUse",
+    "InvalidTransitGatewayAttachment.State",
+    "InvalidDBInstanceState",
+    "InvalidDBSubnetGroupStateFault",
+    "ResourceInUse",
+}
+
+WAVES = [
+    ["transit_gateway_attachment", "instance", "nat_gateway", "db_instance"],
+    ["network_interface"],
+    ["security_group", "route_table", "db_subnet_group"],
+    ["subnet", "internet_gateway", "transit_gateway"],
+    ["vpc"],
+]
+
+# Manifest kinds a completed teardown removes
+MANIFEST_KINDS = (['stack'] + [kind for wave in WAVES for kind in wave]
+                  + ['key_pair', 'launch_template', 'budget', 'iam_user', 'iam_group'])
+
+# Workers for the account-level deletes (key pair, launch templates, budgets, IAM) beside the waves
+ACCOUNT_WORKERS = 2
+
+# Delay before re-trying deletes that were rejected as still in use
+INITIAL_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 10
+
+# Every transit gateway attachment state except deleting/deleted, for a server-side filter
+LIVE_ATTACHMENT_STATES = ['initiating', 'initiatingRequest', 'pendingAcceptance', 'pending', 'available',
+                          'modifying', 'rollingBack', 'failing', 'failed', 'rejecting', 'rejected']
+
+def _error_code(error):
+    return error.response.get('Error', {}).get('Code', '')
+
+# --- Discovery: return the customer's resources of one kind ---
+
+def _discover_transit_gateway_attachments(ec2, customer_code, vpc_ids):
+    attachments = iter_resources(ec2, 'describe_transit_gateway_attachments', 'TransitGatewayAttachments',
+                                 Filters=customer_filter(customer_code) + [
+                                     {'Name': 'state', 'Values': LIVE_ATTACHMENT_STATES}
+                                 ])
+    return {a['TransitGatewayAttachmentId']: a for a in attachments}
+
+def _discover_instances(ec2, customer_code, vpc_ids):
+    instances = iter_resources(ec2, 'describe_instances', 'Reservations[].Instances[]',
+                               Filters=customer_filter(customer_code) + [
+                                   {'Name': 'instance-state-name',
+                                    'Values': ['pending', 'running', 'stopping', 'stopped', 'shutting-down']}
+                               ])
+    return {i['InstanceId']: i for i in instances}
+
+def _discover_nat_gateways(ec2, customer_code, vpc_ids):
+    nat_gateways = iter_resources(ec2, 'describe_nat_gateways', 'NatGateways',
+                                  Filter=customer_filter(customer_code) + [
+                                      {'Name': 'state', 'Values': ['pending', 'available', 'failed']}
+                                  ])
+    return {n['NatGatewayId']: n for n in nat_gateways}
+
+def _discover_network_interfaces(ec2, customer_code, vpc_ids):
+    # ENIs left behind by instances and attachments are not tagged, so also sweep the customer VPCs
+    found = {ni['NetworkInterfaceId']: ni for ni in iter_resources(
+        ec2, 'describe_network_interfaces', 'NetworkInterfaces', Filters=customer_filter(customer_code))}
+    if vpc_ids:
+        for ni in _vpc_network_interfaces(ec2, vpc_ids):
+            found.setdefault(ni['NetworkInterfaceId'], ni)
+    return found
+
+def _vpc_network_interfaces(ec2, vpc_ids):
+    return iter_resources(ec2, 'describe_network_interfaces', 'NetworkInterfaces',
+                          Filters=[{'Name': 'vpc-id', 'Values': vpc_ids}])
+
+def _discover_security_groups(ec2, customer_code, vpc_ids):
+    groups = iter_resources(ec2, 'describe_security_groups', 'SecurityGroups', Filters=customer_filter(customer_code))
+    return {sg['GroupId']: sg for sg in groups if sg.get('GroupName') != 'default'}
+
+def _not_main(route_tables):
+    # The main route table goes away with its VPC and cannot be deleted directly
+    return {rt['RouteTableId']: rt for rt in route_tables
+            if not any(a.get('Main') for a in rt.get('Associations', []))}
+
+def _discover_route_tables(ec2, customer_code, vpc_ids):
+    return _not_main(iter_resources(ec2, 'describe_route_tables', 'RouteTables', Filters=customer_filter(customer_code)))
+
+def _discover_subnets(ec2, customer_code, vpc_ids):
+    subnets = iter_resources(ec2, 'describe_subnets', 'Subnets', Filters=customer_filter(customer_code))
+    return {s['SubnetId']: s for s in subnets}
+
+def _discover_internet_gateways(ec2, customer_code, vpc_ids):
+    igws = iter_resources(ec2, 'describe_internet_gateways', 'InternetGateways', Filters=customer_filter(customer_code))
+    return {igw['InternetGatewayId']: igw for igw in igws}
+
+def _discover_transit_gateways(ec2, customer_code, vpc_ids):
+    tgws = iter_resources(ec2, 'describe_transit_gateways', 'TransitGateways',
+                          Filters=customer_filter(customer_code) + [
+                              {'Name': 'state', 'Values': ['pending', 'available', 'modifying']}
+                          ])
+    return {tg['TransitGatewayId']: tg for tg in tgws}
+
+def _discover_db_instances(ec2, customer_code, vpc_ids):
+    # RDS has no tag filter; the tags come back with each instance
+    rds = get_client('rds', ec2.meta.region_name)
+    return {db['DBInstanceIdentifier']: db for db in iter_resources(rds, 'describe_db_instances', 'DBInstances')
+            if {'Key': 'Customer', 'Value': customer_code} in db.get('TagList', [])
+            and db.get('DBInstanceStatus') != 'deleting'}
+
+def _discover_db_subnet_groups(ec2, customer_code, vpc_ids):
+    rds = get_client('rds', ec2.meta.region_name)
+    try:
+        groups = rds.describe_db_subnet_groups(DBSubnetGroupName=f"{customer_code}_db_subnet_group")['DBSubnetGroups']
+    except rds.exceptions.DBSubnetGroupNotFoundFault:
+        return {}
+    return {group['DBSubnetGroupName']: group for group in groups}
+
+def _discover_vpcs(ec2, customer_code, vpc_ids):
+    return {v['VpcId']: v for v in iter_resources(ec2, 'describe_vpcs', 'Vpcs', Filters=customer_filter(customer_code))}
+
+def _delete_stacks(customer_code, region, stack_names, timeout, tagged):
+    """Delete the customer's CloudFormation stacks; returns the names of any that failed.
+
+    Everything a stack owned goes with it, so its resources are dropped
+    from tagged before the waves run.
+    """
+    cloudformation = get_client('cloudformation', region)
+    failed = []
+    for name in stack_names:
+        try:
+            owned = {r.get('PhysicalResourceId') for r in iter_resources(
+                cloudformation, 'list_stack_resources', 'StackResourceSummaries', StackName=name)}
+            delete_stack(region, name, timeout)
+        except Exception as e:
+            if 'does not exist' in str(e):
+                continue
+            log(f"Failed to delete stack {name} of customer {customer_code}: {e}")
+            failed.append(name)
+            continue
+        for resources in (tagged or {}).values():
+            for resource_id in owned & set(resources):
+                del resources[resource_id]
+    return failed
+
+# --- Deletion: issue the delete call(s) for one resource ---
+
+def _delete_transit_gateway_attachment(ec2, resource_id, resource):
+    ec2.delete_transit_gateway_vpc_attachment(TransitGatewayAttachmentId=resource_id)
+
+def _delete_instance(ec2, resource_id, resource):
+    ec2.terminate_instances(InstanceIds=[resource_id])
+
+def _delete_nat_gateway(ec2, resource_id, resource):
+    ec2.delete_nat_gateway(NatGatewayId=resource_id)
+
+def _delete_network_interface(ec2, resource_id, resource):
+    if not resource:
+        resource = ec2.describe_network_interfaces(NetworkInterfaceIds=[resource_id])['NetworkInterfaces'][0]
+    if resource.get('RequesterManaged') or resource.get('Status') == 'in-use':
+        return False  # Still owned by an instance, attachment or NAT gateway; it goes away with its owner
+    ec2.delete_network_interface(NetworkInterfaceId=resource_id)
+
+def _delete_security_group(ec2, resource_id, resource):
+    ec2.delete_security_group(GroupId=resource_id)
+
+def _delete_db_instance(ec2, resource_id, resource):
+    try:
+        get_client('rds', ec2.meta.region_name).delete_db_instance(
+            DBInstanceIdentifier=resource_id,
+            SkipFinalSnapshot=True,
+            DeleteAutomatedBackups=True
+        )
+    except botocore.exceptions.ClientError as e:
+        # Still creating or modifying is retried; a deletion already under way is what we want
+        if 'already being deleted' not in str(e):
+            raise
+
+def _delete_db_subnet_group(ec2, resource_id, resource):
+    rds = get_client('rds', ec2.meta.region_name)
+    try:
+        rds.delete_db_subnet_group(DBSubnetGroupName=resource_id)
+    except rds.exceptions.DBSubnetGroupNotFoundFault:
+        pass
+
+def _delete_route_table(ec2, resource_id, resource):
+    if not resource:
+        resource = ec2.describe_route_tables(RouteTableIds=[resource_id])['RouteTables'][0]
+    for association in resource.get('Associations', []):
+        if association.get('RouteTableAssociationId') and not association.get('Main'):
+            try:
+                ec2.disassociate_route_table(AssociationId=association['RouteTableAssociationId'])
+            except botocore.exceptions.ClientError as e:
+                if not _error_code(e).endswith('NotFound'):
+                    raise
+    ec2.delete_route_table(RouteTableId=resource_id)
+
+def _delete_subnet(ec2, resource_id, resource):
+    ec2.delete_subnet(SubnetId=resource_id)
+
+def _delete_internet_gateway(ec2, resource_id, resource):
+    if not resource:
+        resource = ec2.describe_internet_gateways(InternetGatewayIds=[resource_id])['InternetGateways'][0]
+    for attachment in resource.get('Attachments', []):
+        try:
+            ec2.detach_internet_gateway(InternetGatewayId=resource_id, VpcId=attachment['VpcId'])
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) != 'Gateway.NotAttached':
+                raise
+    ec2.delete_internet_gateway(InternetGatewayId=resource_id)
+
+def _delete_transit_gateway(ec2, resource_id, resource):
+    ec2.delete_transit_gateway(TransitGatewayId=resource_id)
+
+def _delete_vpc(ec2, resource_id, resource):
+    ec2.delete_vpc(VpcId=resource_id)
+
+RESOURCE_KINDS = {
+    "transit_gateway_attachment": ("Transit Gateway Attachment", _discover_transit_gateway_attachments,
+                                   _delete_transit_gateway_attachment),
+    "instance": ("EC2 Instance", _discover_instances, _delete_instance),
+    "nat_gateway": ("NAT Gateway", _discover_nat_gateways, _delete_nat_gateway),
+    "db_instance": ("RDS Instance", _discover_db_instances, _delete_db_instance),
+    "network_interface": ("Network Interface", _discover_network_interfaces, _delete_network_interface),
+    "security_group": ("Security Group", _discover_security_groups, _delete_security_group),
+    "route_table": ("Route Table", _discover_route_tables, _delete_route_table),
+    "db_subnet_group": ("DB Subnet Group", _discover_db_subnet_groups, _delete_db_subnet_group),
+    "subnet": ("Subnet", _discover_subnets, _delete_subnet),
+    "internet_gateway": ("Internet Gateway", _discover_internet_gateways, _delete_internet_gateway),
+    "transit_gateway": ("Transit Gateway", _discover_transit_gateways, _delete_transit_gateway),
+    "vpc": ("VPC", _discover_vpcs, _delete_vpc),
+}
+
+def _try_delete(ec2, kind, resource_id, resource):
+    """Delete one resource. Returns True when done, False when it should be retried."""
+    label, _, delete = RESOURCE_KINDS[kind]
+    try:
+        if delete(ec2, resource_id, resource) is False:
+            log(f"Waiting for {label} {resource_id} to be released by its owner.", resource_id=resource_id)
+        else:
+            log(f"Deleted {label}: {resource_id}", resource_id=resource_id)
+        return True
+    except botocore.exceptions.ClientError as e:
+        code = _error_code(e)
+        if code.endswith('NotFound'):
+            return True
+        if code in RETRYABLE_CODES:
+            log(f"{label} {resource_id} is still in use ({code}); will retry.")
+            return False
+        log(f"Failed to delete {label} {resource_id}: {e}")
+        return True
+    except Exception as e:
+        log(f"Failed to delete {label} {resource_id}: {e}")
+        return True
+
+def run_wave(ec2, pool, kinds, found, timeout):
+    """Delete every resource of a wave in parallel and wait until they are gone.
+
+    found maps kind -> {resource id: describe record}.  Every resource is
+    handed to the region's readiness tracker, which checks all of them with
+    one describe call per kind per poll.  Returns the IDs that were still
+    present when the timeout expired, keyed by kind.
+    """
+    pending = {kind: dict(found.get(kind, {})) for kind in kinds}
+    pending = {kind: resources for kind, resources in pending.items() if resources}
+    if not pending:
+        return {}
+
+    def _delete_all(targets):
+        jobs = [(kind, resource_id, resource) for kind, resources in targets.items()
+                for resource_id, resource in resources.items()]
+        results = pool.map(carry_context(lambda job: _try_delete(ec2, *job)), jobs)
+        return {(kind, resource_id) for (kind, resource_id, _), ok in zip(jobs, results) if not ok}
+
+    retry = _delete_all(pending)
+    tracker = get_tracker(ec2.meta.region_name)
+    watches = {tracker.watch(kind, resource_id, GONE_STATES[kind]): (kind, resource_id)
+               for kind, resources in pending.items() for resource_id in resources}
+    deadline = time.monotonic() + timeout
+    delay = INITIAL_RETRY_DELAY
+
+    while True:
+        _, not_done = wait(watches, timeout=min(delay, max(0, deadline - time.monotonic())))
+        if not not_done:
+            return {}
+        if time.monotonic() >= deadline:
+            leftovers = {}
+            for future in not_done:
+                future.cancel()
+                kind, resource_id = watches[future]
+                leftovers.setdefault(kind, []).append(resource_id)
+            leftovers = {kind: sorted(ids) for kind, ids in leftovers.items()}
+            log(f"Timed out waiting for deletion of: {leftovers}")
+            return leftovers
+
+        delay = min(delay * 2, MAX_RETRY_DELAY)
+        waiting = {watches[future] for future in not_done}
+        retry = {job for job in retry if job in waiting}
+        if retry:
+            targets = {}
+            for kind, resource_id in retry:
+                targets.setdefault(kind, {})[resource_id] = pending[kind][resource_id]
+            retry = _delete_all(targets)
+
+def _delete_key_pair(ec2, key_pair_name):
+    """Delete a key pair; returns the names that could not be deleted."""
+    try:
+        ec2.delete_key_pair(KeyName=key_pair_name)
+        metadata_cache.invalidate('key_pair', ec2.meta.region_name, key_pair_name)
+        log(f"Deleted Key Pair: {key_pair_name}")
+    except botocore.exceptions.ClientError as e:
+        log(f"Failed to delete Key Pair {key_pair_name}: {e}")
+        return [key_pair_name]
+    return []
+
+def _delete_launch_templates(ec2, customer_code, template_ids=None):
+    """Delete the customer's launch templates; returns the IDs that could not be deleted."""
+    if template_ids is None:
+        try:
+            template_ids = [t['LaunchTemplateId'] for t in iter_resources(
+                ec2, 'describe_launch_templates', 'LaunchTemplates', Filters=customer_filter(customer_code))]
+        except Exception as e:
+            log(f"Failed to list launch templates: {e}")
+            return [f"{customer_code}-*"]
+    failed = []
+    for template_id in template_ids:
+        try:
+            ec2.delete_launch_template(LaunchTemplateId=template_id)
+            log(f"Deleted Launch Template: {template_id}", resource_id=template_id)
+        except botocore.exceptions.ClientError as e:
+            if 'NotFound' not in _error_code(e):  # InvalidLaunchTemplateId.NotFound
+                log(f"Failed to delete Launch Template {template_id}: {e}", resource_id=template_id)
+                failed.append(template_id)
+    metadata_cache.invalidate('launch_template', ec2.meta.region_name)
+    return failed
+
+def _delete_budgets(budgets, customer_code, account_id, budget_names=None):
+    """Delete the customer's budgets; returns the names that could not be deleted."""
+    if budget_names is None:
+        try:
+            budget_names = [b['BudgetName'] for b in iter_resources(budgets, 'describe_budgets', 'Budgets',
+                                                                    AccountId=account_id)
+                            if b['BudgetName'].startswith(customer_code)]
+        except Exception as e:
+            log(f"Failed to list budgets: {e}")
+            return [f"{customer_code}*"]
+    failed = []
+    for budget_name in budget_names:
+        try:
+            budgets.delete_budget(AccountId=account_id, BudgetName=budget_name)
+            log(f"Deleted Budget: {budget_name}")
+        except budgets.exceptions.NotFoundException:
+            pass
+        except Exception as e:
+            log(f"Failed to delete Budget {budget_name}: {e}")
+            failed.append(budget_name)
+    return failed
+
+def delete_iam_user(iam, user):
+    """Detach/delete a user's policies, group memberships and login profile, then the user itself.
+
+    Returns the users that could not be deleted: [user] on failure, else [].
+    """
+    try:
+        for group in list(iter_resources(iam, 'list_groups_for_user', 'Groups', UserName=user)):
+            _remove_from_group(iam, group['GroupName'], user)
+        # Listed up front: deleting while paging would shift the pages
+        for policy in list(iter_resources(iam, 'list_attached_user_policies', 'AttachedPolicies', UserName=user)):
+            iam.detach_user_policy(UserName=user, PolicyArn=policy['PolicyArn'])
+        for policy in list(iter_resources(iam, 'list_user_policies', 'PolicyNames', UserName=user)):
+            iam.delete_user_policy(UserName=user, PolicyName=policy)
+        try:
+            iam.delete_login_profile(UserName=user)
+        except iam.exceptions.NoSuchEntityException:
+            pass
+        iam.delete_user(UserName=user)
+        log(f"Deleted IAM user: {user}")
+    except iam.exceptions.NoSuchEntityException:
+        pass
+    except Exception as e:
+        log(f"Failed to delete IAM user {user}: {e}")
+        return [user]
+    return []
+
+def _remove_from_group(iam, group, user):
+    try:
+        iam.remove_user_from_group(GroupName=group, UserName=user)
+    except iam.exceptions.NoSuchEntityException:
+        pass  # Removed by the teardown of the user or of the group
+
+def delete_iam_group(iam, group):
+    """Remove a group's members and policies, then the group itself; returns [group] on failure, else []."""
+    try:
+        for user in list(iter_resources(iam, 'get_group', 'Users', GroupName=group)):
+            _remove_from_group(iam, group, user['UserName'])
+        for policy in list(iter_resources(iam, 'list_attached_group_policies', 'AttachedPolicies', GroupName=group)):
+            iam.detach_group_policy(GroupName=group, PolicyArn=policy['PolicyArn'])
+        for policy in list(iter_resources(iam, 'list_group_policies', 'PolicyNames', GroupName=group)):
+            iam.delete_group_policy(GroupName=group, PolicyName=policy)
+        iam.delete_group(GroupName=group)
+        log(f"Deleted IAM group: {group}")
+    except iam.exceptions.NoSuchEntityException:
+        pass
+    except Exception as e:
+        log(f"Failed to delete IAM group {group}: {e}")
+        return [group]
+    return []
+
+def customer_iam_groups(customer_code, config):
+    """Names of the IAM groups the onboarding creates for a customer: one per account type."""
+    return [group_name(customer_code, account_type) for account_type in IAM_ACCOUNT_TYPES]
+
+def customer_iam_users(customer_code, config):
+    """Names of the IAM users the onboarding creates for a customer."""
+    environment_codes = config.get('environment_codes') or [env['code'] for env in config.get('environments', [])]
+    users = [f"{customer_code}-admin"]
+    for env_code in environment_codes:
+        for account_type in IAM_ACCOUNT_TYPES:
+            users.append(f"{customer_code}-{env_code}-{account_type}")
+    return users
+
+def _discover_wave(ec2, pool, wave, customer_code, vpc_ids, tagged):
+    """Return {kind: {resource id: describe record}} for the resources of one wave.
+
+    tagged is the customer's slice of the tag inventory; records taken
+    from it are empty and are described lazily by the delete functions
+    that need them.  Without an inventory each kind is described by tag.
+    """
+    if tagged is None:
+        discovered = pool.map(carry_context(lambda kind: RESOURCE_KINDS[kind][1](ec2, customer_code, vpc_ids)), wave)
+        return dict(zip(wave, discovered))
+
+    found = {kind: {resource_id: {} for resource_id in tagged.get(kind, {})} for kind in wave}
+    if 'network_interface' in found and vpc_ids:
+        # ENIs created by instances and attachments are untagged; sweep the customer VPCs for them
+        for ni in _vpc_network_interfaces(ec2, vpc_ids):
+            found['network_interface'][ni['NetworkInterfaceId']] = ni
+    if found.get('route_table'):
+        # Fetch associations up front so the main route table (deleted with its VPC) is left alone
+        found['route_table'] = _not_main(iter_resources(ec2, 'describe_route_tables', 'RouteTables', Filters=[
+            {'Name': 'route-table-id', 'Values': list(found['route_table'])}
+        ]))
+    return found
+
+def delete_customer_resources(customer_code, region, config, inventory=None):
+    """Delete all AWS resources associated with a specific customer tag.
+
+    The customer's deployment manifest (manifest.py) is used when one
+    exists, so teardown is a pure delete pass.  Otherwise inventory, an
+    index from inventory.scan_tagged_resources(), is used; when it is not
+    supplied the customer's resources are scanned in one paginated tagging
+    API call, falling back to per-type describe calls if that API is
+    unavailable.
+    """
+    ec2 = get_client('ec2', region)
+    iam = get_client('iam')
+    budgets = get_client('budgets', region)
+    timeout = config.get('teardown_wave_timeout', 600)
+    leftovers = {}
+
+    log(f"Deleting resources for customer: {customer_code}")
+    started = time.monotonic()
+    recorded = manifest.load(customer_code)
+    if recorded:
+        log(f"Using deployment manifest {manifest.manifest_path(customer_code)}")
+        tagged = recorded
+    else:
+        if inventory is None:
+            try:
+                inventory = scan_tagged_resources(region, [customer_code])
+            except Exception as e:
+                log(f"Tag inventory unavailable ({e}); discovering resources per type instead.")
+        tagged = inventory.get(customer_code, {}) if inventory is not None else None
+
+    # Names recorded in the manifest beat the naming-convention guesses.  A stack-managed
+    # customer's budget and IAM users are part of the stack, so there is nothing to guess.
+    recorded = recorded or {}
+    stack_names = list((tagged or {}).get('stack', {}))
+    if tagged is None:
+        stack_names = [stack_name({'customer_code': customer_code})]
+    guess = not stack_names or tagged is None
+    key_pairs = list(recorded.get('key_pair', {})) or ([f"{customer_code}-key"] if guess else [])
+    launch_templates = list(tagged.get('launch_template', {})) if tagged is not None else None
+    budget_names = list(recorded['budget']) if 'budget' in recorded else (None if guess else [])
+    iam_users = (list(recorded['iam_user']) if 'iam_user' in recorded
+                 else customer_iam_users(customer_code, config) if guess else [])
+    iam_groups = (list(recorded['iam_group']) if 'iam_group' in recorded
+                  else customer_iam_groups(customer_code, config) if guess else [])
+    if stack_names:
+        with stage_context("teardown:stack"):
+            failed = _delete_stacks(customer_code, region, stack_names,
+                                    config.get('stack_timeout', STACK_TIMEOUT), tagged)
+        if failed:
+            leftovers['stack'] = failed
+    try:
+        # Account-level resources have no network dependencies; clear them alongside the waves on
+        # their own workers, so rate-limited IAM deletes never hold up a wave
+        with ThreadPoolExecutor(max_workers=config.get('teardown_workers', 8)) as pool, \
+                ThreadPoolExecutor(max_workers=config.get('teardown_account_workers', ACCOUNT_WORKERS)) as side_pool:
+            with stage_context("teardown:account"):
+                # (manifest kind, job returning the resources of that kind it failed to delete)
+                side_jobs = [('key_pair', side_pool.submit(carry_context(_delete_key_pair), ec2, key_pair))
+                             for key_pair in key_pairs]
+                side_jobs.append(('launch_template', side_pool.submit(
+                    carry_context(_delete_launch_templates), ec2, customer_code, launch_templates)))
+                side_jobs.append(('budget', side_pool.submit(
+                    carry_context(_delete_budgets), budgets, customer_code, config['account_id'], budget_names)))
+                side_jobs += [('iam_user', side_pool.submit(carry_context(delete_iam_user), iam, user))
+                              for user in iam_users]
+                side_jobs += [('iam_group', side_pool.submit(carry_context(delete_iam_group), iam, group))
+                              for group in iam_groups]
+
+            if tagged is None:
+                vpc_ids = list(_discover_vpcs(ec2, customer_code, None))
+            else:
+                vpc_ids = list(tagged.get('vpc', {}))
+            for wave in WAVES:
+                with stage_context(f"teardown:{'+'.join(wave)}"):
+                    found = _discover_wave(ec2, pool, wave, customer_code, vpc_ids, tagged)
+                    leftovers.update(run_wave(ec2, pool, wave, found, timeout))
+
+            # Whatever failed stays in the manifest, so the next teardown tries it again
+            for kind, job in side_jobs:
+                failed = job.result()
+                if failed:
+                    leftovers[kind] = sorted(set(leftovers.get(kind, [])) | set(failed))
+    except Exception as e:
+        log(f"Error deleting resources for customer {customer_code}: {e}")
+        raise
+
+    manifest.record_teardown_complete(customer_code, [kind for kind in MANIFEST_KINDS if kind not in leftovers])
+    clear_checkpoint(customer_code)  # Nothing left to resume
+    if leftovers:
+        log(f"Teardown for customer {customer_code} finished with resources still present: {leftovers}")
+    else:
+        log(f"All resources for customer {customer_code} have been deleted in {time.monotonic() - started:.1f}s.")
+    return leftovers